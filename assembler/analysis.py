@@ -0,0 +1,277 @@
+# Static cycle-cost and call-depth analysis of assembled BatPU-2 programs.
+#
+# Nothing is run. The ROM is split into basic blocks and routines (pc 0 and
+# every CAL target) by disassembler.analyze, and every instruction costs one
+# cycle. For each routine:
+#   - best and worst case cycles from its entry to a RET or HLT over paths
+#     that take no loop back edge, including what its calls cost,
+#   - the best and worst cost of one iteration of each loop in it,
+#   - how many call stack entries it can use, against the 16 the hardware has,
+#   - which registers a call to it can change, through its callees too.
+# A JMP to another routine is a tail call: its cost is added and it uses no
+# stack entry. Routines on a recursive cycle have no bound. Costs are also
+# projected to wall time at the README's rates: 0.1 instructions per second
+# in vanilla Minecraft and 2.5 with Carpet at 500 ticks per second.
+#
+# Usage: python analysis.py program.as [--output FILE]
+
+import argparse
+from assembler import assemble_lines
+from disassembler import OP, BINARY_OPS, decode, analyze as control_flow
+from emulator import STACK_DEPTH
+
+RATES = [('vanilla', 0.1), ('carpet', 2.5)]  # instructions per second
+
+def analyze(rom, symbols=None):
+    # {entry pc: {'name', 'best', 'worst', 'loops': [(header name, best, worst)],
+    #  'depth', 'recursive', 'clobbers'}}; None means no bound or no path that returns
+    fields = decode(rom)
+    flow = control_flow(fields)
+    blocks, successors = flow['blocks'], flow['successors']
+    opcode, address = fields['opcode'], fields['address']
+    names = {}
+    for name, pc in (symbols or {}).items():
+        if name.startswith('.') and not name.startswith('.profile_'):
+            names.setdefault(pc, name)
+    entries = set(flow['routines'])
+
+    def name_of(pc):
+        return names.get(pc, '(entry)' if pc == 0 else f"pc {pc}")
+
+    def exits(start):
+        return int(opcode[blocks[start] - 1]) in (OP['ret'], OP['hlt'])
+
+    def call_of(start):
+        last = blocks[start] - 1
+        return int(address[last]) if int(opcode[last]) == OP['cal'] else None
+
+    # Calls and tail calls of each routine, and which routines are recursive
+    calls, tail_calls = {}, {}
+    for entry, routine in flow['routines'].items():
+        calls[entry] = {call_of(start) for start in routine['blocks']} - {None}
+        tail_calls[entry] = {successor for start in routine['blocks'] for successor in successors[start]
+                             if successor in entries and successor != entry}
+    recursive = set()
+    for entry in entries:
+        pending, seen = list(calls[entry] | tail_calls[entry]), set()
+        while pending:
+            callee = pending.pop()
+            if callee == entry:
+                recursive.add(entry)
+                break
+            if callee in seen or callee not in entries:
+                continue
+            seen.add(callee)
+            pending.extend(calls[callee] | tail_calls[callee])
+
+    results = {}
+
+    def routine_cost(entry):
+        if entry not in results:
+            results[entry] = None  # in progress
+            results[entry] = cost_of(entry)
+        return results[entry]
+
+    def callee_cost(callee):
+        if callee in recursive or callee not in entries:
+            return None, None
+        result = routine_cost(callee)
+        return (result['best'], result['worst']) if result else (None, None)
+
+    def cost_of(entry):
+        members = set(flow['routines'][entry]['blocks'])
+        local = {start: [successor for successor in successors[start]
+                         if successor in members and successor not in entries - {entry}]
+                 for start in members}
+        back_edges = find_back_edges(entry, local)
+        forward = {start: [successor for successor in local[start] if (start, successor) not in back_edges]
+                   for start in members}
+
+        def block_cost(start):
+            # (best, worst) cycles of the block and the routine it calls
+            size = blocks[start] - start
+            callee = call_of(start)
+            if callee is None:
+                return size, size
+            best, worst = callee_cost(callee)
+            return (None if best is None else size + best), (None if worst is None else size + worst)
+
+        def span(start, target, memo):
+            # (best, worst) over forward paths from start to target (None: to
+            # an exit of the routine), including both ends
+            if start in memo:
+                return memo[start]
+            memo[start] = (None, None)
+            own_best, own_worst = block_cost(start)
+            if own_best is None:
+                return memo[start]
+            options = []
+            if target is None:
+                if exits(start):
+                    options.append((0, 0))
+                for successor in successors[start]:
+                    if successor in entries and successor != entry:
+                        options.append(callee_cost(successor))
+            elif start == target:
+                options.append((0, 0))
+            if start != target:
+                options += [span(successor, target, memo) for successor in forward[start]]
+            bests = [best for best, worst in options if best is not None]
+            worsts = [worst for best, worst in options if best is not None]
+            if bests:
+                worst = None if None in worsts or own_worst is None else own_worst + max(worsts)
+                memo[start] = (own_best + min(bests), worst)
+            return memo[start]
+
+        best, worst = span(entry, None, {})
+        iterations = {}  # header -> (best, worst) over the blocks that jump back to it
+        for tail, header in back_edges:
+            # One iteration: from the header around to the block that jumps back
+            iteration = span(header, tail, {})
+            if header in iterations:
+                bests = [best for best in (iterations[header][0], iteration[0]) if best is not None]
+                worsts = [iterations[header][1], iteration[1]]
+                iteration = (min(bests) if bests else None, None if None in worsts else max(worsts))
+            iterations[header] = iteration
+        loops = [(name_of(header), *iterations[header]) for header in sorted(iterations)]
+        return {'best': best, 'worst': worst, 'loops': loops}
+
+    depths = {}
+
+    def depth(entry):
+        # Call stack entries in use at the deepest point below this routine
+        if entry in recursive:
+            return None
+        if entry not in depths:
+            deepest = 0
+            for callee in calls[entry] | tail_calls[entry]:
+                if callee not in entries:
+                    continue
+                below = depth(callee)
+                if below is None:
+                    deepest = None
+                    break
+                deepest = max(deepest, below + (callee in calls[entry]))
+            depths[entry] = deepest
+        return depths[entry]
+
+    # Registers written in each routine, then through its callees until nothing changes
+    written = {}
+    for entry, routine in flow['routines'].items():
+        registers = set()
+        for start in routine['blocks']:
+            for pc in range(start, blocks[start]):
+                register = written_register(fields, pc)
+                if register:
+                    registers.add(register)
+        written[entry] = registers
+    changed = True
+    while changed:
+        changed = False
+        for entry in entries:
+            for callee in (calls[entry] | tail_calls[entry]) & entries:
+                if not written[callee] <= written[entry]:
+                    written[entry] |= written[callee]
+                    changed = True
+
+    report = {}
+    for entry in sorted(entries):
+        cost = routine_cost(entry) if entry not in recursive else {'best': None, 'worst': None, 'loops': []}
+        report[entry] = {'name': name_of(entry), 'words': flow['routines'][entry]['words'],
+                         'recursive': entry in recursive, 'depth': depth(entry),
+                         'clobbers': sorted(written[entry]), **cost}
+    return report
+
+def written_register(fields, pc):
+    # Register number the instruction at pc writes, or None (r0 is never written)
+    op = int(fields['opcode'][pc])
+    if op in BINARY_OPS or op == OP['rsh']:
+        register = int(fields['c'][pc])
+    elif op in (OP['ldi'], OP['adi']):
+        register = int(fields['a'][pc])
+    elif op == OP['lod']:
+        register = int(fields['b'][pc])
+    else:
+        return None
+    return register or None
+
+def find_back_edges(entry, edges):
+    # Edges to a block still on the depth-first search stack
+    back, state = set(), {}
+    stack = [(entry, iter(edges[entry]))]
+    state[entry] = 'open'
+    while stack:
+        node, remaining = stack[-1]
+        successor = next(remaining, None)
+        if successor is None:
+            state[node] = 'done'
+            stack.pop()
+        elif state.get(successor) == 'open':
+            back.add((node, successor))
+        elif successor not in state:
+            state[successor] = 'open'
+            stack.append((successor, iter(edges[successor])))
+    return back
+
+def analyze_assembly(source):
+    rom, symbols = assemble_lines(source)
+    return analyze(rom, symbols)
+
+def duration(cycles, rate):
+    if cycles is None:
+        return "-"
+    seconds = cycles / rate
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    if seconds < 3600:
+        return f"{seconds / 60:.1f}m"
+    return f"{seconds / 3600:.1f}h"
+
+def bound(value):
+    return "-" if value is None else str(value)
+
+def format_report(report):
+    header = f"{'routine':<22}{'words':>6}{'best':>8}{'worst':>8}{'depth':>7}" + \
+        "".join(f"{'worst @' + str(rate) + '/s':>16}" for _, rate in RATES)
+    lines = [header]
+    for entry, routine in report.items():
+        depth = "rec" if routine['recursive'] else bound(routine['depth'])
+        lines.append(f"{routine['name']:<22}{routine['words']:>6}{bound(routine['best']):>8}{bound(routine['worst']):>8}"
+                     f"{depth:>7}" + "".join(f"{duration(routine['worst'], rate):>16}" for _, rate in RATES))
+        for header_name, best, worst in routine['loops']:
+            lines.append(f"  loop at {header_name}: {bound(best)}..{bound(worst)} cycles per iteration")
+        if routine['clobbers']:
+            lines.append("  clobbers " + " ".join(f"r{register}" for register in routine['clobbers']))
+    lines.append(format_summary(report))
+    return "\n".join(lines)
+
+def format_summary(report):
+    # One line about the program as a whole, from its entry routine
+    entry = report.get(0)
+    if entry is None:
+        return "Empty program"
+    depth = entry['depth']
+    stack = "unbounded (recursion)" if depth is None else f"{depth}/{STACK_DEPTH}" + (" OVERFLOW" if depth > STACK_DEPTH else "")
+    loops = sum(len(routine['loops']) for routine in report.values())
+    if entry['best'] is None:
+        cost = "no path to hlt without looping"
+    else:
+        times = ", ".join(f"{name} {duration(entry['worst'], rate)}" for name, rate in RATES)
+        cost = f"{entry['best']}..{bound(entry['worst'])} cycles without loop iterations ({times})"
+    return f"Static cost: {cost}, {loops} loops, call stack {stack}"
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate cycle costs and call depth of an assembly program")
+    parser.add_argument('file', help=".as file")
+    parser.add_argument('--output', help="write the report here instead of printing it")
+    args = parser.parse_args()
+    with open(args.file, 'r') as f:
+        text = format_report(analyze_assembly(f.read()))
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,71 @@
 import sys
 
-def assemble(assembly_filename, mc_filename):
-    assembly_file = open(assembly_filename, 'r')
-    machine_code_file = open(mc_filename, 'w')
-    lines = (line.strip() for line in assembly_file)
+OPCODES = ['nop', 'hlt', 'add', 'sub', 'nor', 'and', 'xor', 'rsh', 'ldi', 'adi', 'jmp', 'brh', 'cal', 'ret', 'lod', 'str']
+
+REGISTERS = ['r0', 'r1', 'r2', 'r3', 'r4', 'r5', 'r6', 'r7', 'r8', 'r9', 'r10', 'r11', 'r12', 'r13', 'r14', 'r15']
+
+# Each list spells the four branch conditions (zero, not zero, carry, not carry)
+CONDITIONS = [
+    ['eq', 'ne', 'ge', 'lt'],
+    ['=', '!=', '>=', '<'],
+    ['z', 'nz', 'c', 'nc'],
+    ['zero', 'notzero', 'carry', 'notcarry'],
+]
+
+PORTS = ['pixel_x', 'pixel_y', 'draw_pixel', 'clear_pixel', 'load_pixel', 'buffer_screen', 'clear_screen_buffer', 
+         'write_char', 'buffer_chars', 'clear_chars_buffer', 'show_number', 'clear_number', 'signed_mode', 'unsigned_mode', 'rng', 'controller_input']
+PORT_BASE = 240
+
+CHARACTERS = [' ', 'a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k', 'l', 'm', 'n', 'o', 'p', 'q', 'r', 's', 't', 'u', 'v', 'w', 'x', 'y', 'z', '.', '!', '?']
+
+def resolve_pseudo_instruction(words):
+    if words[0] == 'cmp':
+        words = ['sub', words[1], words[2], REGISTERS[0]] # sub A B r0
+    elif words[0] == 'mov':
+        words = ['add', words[1], REGISTERS[0], words[2], ] # add A r0 dest
+    elif words[0] == 'lsh':
+        words = ['add', words[1], words[1], words[2]] # add A A dest
+    elif words[0] == 'inc':
+        words = ['adi', words[1], '1'] # adi dest 1
+    elif words[0] == 'dec':
+        words = ['adi', words[1], '-1'] # adi dest -1
+    elif words[0] == 'not':
+        words = ['nor', words[1], REGISTERS[0], words[2]] # nor A r0 dest
+    elif words[0] == "neg":
+        words = ["sub", REGISTERS[0], words[1], words[2]] # sub r0 A dest
+    return words
+
+def assemble(assembly_filename, mc_filename, optimize=False):
+    # optimize: thread jumps and drop dead code first (optimizer.thread_jumps),
+    # printing each rewrite, then check the result against the source on many
+    # inputs (validate.py); meant for hand-written programs
+    with open(assembly_filename, 'r') as assembly_file:
+        if optimize:
+            from optimizer import parse, render, thread_jumps
+            from validate import validate, format_validation
+            source = assembly_file.read()
+            program, rewrites = thread_jumps(parse(source))
+            for rewrite in rewrites:
+                print(rewrite)
+            print(f'{len(rewrites)} jump rewrites')
+            result = validate(source, render(program))
+            if result['divergence']:
+                exit(format_validation(result))
+            print(format_validation(result))
+            machine_codes, symbols = assemble_lines(render(program))
+        else:
+            machine_codes, symbols = assemble_lines(assembly_file)
+    with open(mc_filename, 'w') as machine_code_file:
+        for machine_code in machine_codes:
+            as_string = bin(machine_code)[2:].rjust(16, '0')
+            machine_code_file.write(f'{as_string}\n')
+
+def assemble_lines(source):
+    # Assemble in memory: source is assembly text or an iterable of lines.
+    # Returns the machine code words and the symbol table (labels map to their pc).
+    if isinstance(source, str):
+        source = source.splitlines()
+    lines = (line.strip() for line in source)
 
     # Remove comments and blanklines
     for comment_symbol in ['/', ';', '#']:
@@ -13,33 +75,20 @@ def assemble(assembly_filename, mc_filename):
     # Populate symbol table
     symbols = {}
     
-    opcodes = ['nop', 'hlt', 'add', 'sub', 'nor', 'and', 'xor', 'rsh', 'ldi', 'adi', 'jmp', 'brh', 'cal', 'ret', 'lod', 'str']
-    for index, symbol in enumerate(opcodes):
+    for index, symbol in enumerate(OPCODES):
         symbols[symbol] = index
     
-    registers = ['r0', 'r1', 'r2', 'r3', 'r4', 'r5', 'r6', 'r7', 'r8', 'r9', 'r10', 'r11', 'r12', 'r13', 'r14', 'r15']
-    for index, symbol in enumerate(registers):
+    for index, symbol in enumerate(REGISTERS):
         symbols[symbol] = index
 
-    conditions1 = ['eq', 'ne', 'ge', 'lt']
-    conditions2 = ['=', '!=', '>=', '<']
-    conditions3 = ['z', 'nz', 'c', 'nc']
-    conditions4 = ['zero', 'notzero', 'carry', 'notcarry']
-    for index, symbol in enumerate(conditions1):
-        symbols[symbol] = index
-    for index, symbol in enumerate(conditions2):
-        symbols[symbol] = index
-    for index, symbol in enumerate(conditions3):
-        symbols[symbol] = index
-    for index, symbol in enumerate(conditions4):
-        symbols[symbol] = index
+    for conditions in CONDITIONS:
+        for index, symbol in enumerate(conditions):
+            symbols[symbol] = index
 
-    ports = ['pixel_x', 'pixel_y', 'draw_pixel', 'clear_pixel', 'load_pixel', 'buffer_screen', 'clear_screen_buffer', 
-             'write_char', 'buffer_chars', 'clear_chars_buffer', 'show_number', 'clear_number', 'signed_mode', 'unsigned_mode', 'rng', 'controller_input']
-    for index, symbol in enumerate(ports):
-        symbols[symbol] = index + 240
+    for index, symbol in enumerate(PORTS):
+        symbols[symbol] = index + PORT_BASE
 
-    for i, letter in enumerate([' ', 'a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k', 'l', 'm', 'n', 'o', 'p', 'q', 'r', 's', 't', 'u', 'v', 'w', 'x', 'y', 'z', '.', '!', '?']):
+    for i, letter in enumerate(CHARACTERS):
         symbols[f'"{letter}"'] = i
         symbols[f"'{letter}'"] = i
 
@@ -68,6 +117,8 @@ def assemble(assembly_filename, mc_filename):
             instructions.append(words)
 
     # Generate machine code
+    machine_codes = []
+
     def resolve(word):
         if word[0] in '-0123456789':
             return int(word, 0)
@@ -77,20 +128,7 @@ def assemble(assembly_filename, mc_filename):
 
     for pc, words in enumerate(instructions):
         # Resolve pseudo-instructions
-        if words[0] == 'cmp':
-            words = ['sub', words[1], words[2], registers[0]] # sub A B r0
-        elif words[0] == 'mov':
-            words = ['add', words[1], registers[0], words[2], ] # add A r0 dest
-        elif words[0] == 'lsh':
-            words = ['add', words[1], words[1], words[2]] # add A A dest
-        elif words[0] == 'inc':
-            words = ['adi', words[1], '1'] # adi dest 1
-        elif words[0] == 'dec':
-            words = ['adi', words[1], '-1'] # adi dest -1
-        elif words[0] == 'not':
-            words = ['nor', words[1], registers[0], words[2]] # nor A r0 dest
-        elif words[0] == "neg":
-            words = ["sub", registers[0], words[1], words[2]] # sub r0 A dest
+        words = resolve_pseudo_instruction(words)
 
         # lod/str optional offset
         if words[0] in ['lod', 'str'] and len(words) == 3:
@@ -161,11 +199,15 @@ def assemble(assembly_filename, mc_filename):
                 exit(f'Invalid offset for {opcode} on line {pc}')
             machine_code |= words[3] & (2 ** 4 - 1)
 
-        as_string = bin(machine_code)[2:].rjust(16, '0')
-        machine_code_file.write(f'{as_string}\n')
+        machine_codes.append(machine_code)
+
+    return machine_codes, symbols
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
+    # python assembler.py program.as [output.mc] [--optimize]
+    optimize = '--optimize' in sys.argv
+    arguments = [argument for argument in sys.argv[1:] if argument != '--optimize']
+    if len(arguments) < 1:
         exit("Not enough arguments.")
 
-    assemble(sys.argv[1], sys.argv[2] if len(sys.argv) >= 3 else 'output.mc')
\ No newline at end of file
+    assemble(arguments[0], arguments[1] if len(arguments) >= 2 else 'output.mc', optimize)
\ No newline at end of file
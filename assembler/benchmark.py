@@ -0,0 +1,281 @@
+# Benchmark suite over the showcase programs.
+#
+# The workloads are fixed: the hand-written programs in done/, the C# examples
+# in programs/ and VortexScript/main.vsc with its imports. For each one every
+# toolchain stage that applies is timed (best of --repeat runs): lexer, parser,
+# codegen, optimize, assemble and schematic. The ROM size and the number of
+# emulated cycles until the first frame is pushed to a display are recorded
+# as well, and for the compiled programs the memory the parsed AST occupies.
+# A generated VortexScript module with many methods measures the front end
+# and codegen at a larger scale; it is too big for the ROM, so it stops after
+# codegen. Each run is appended to a JSON history and compared with the
+# baseline entry: the last one recorded with --set-baseline, or the first
+# one. Comparing with a fixed run means a slow drift adds up until it shows,
+# and a regressed run does not become the new normal. A metric that grew by
+# more than its threshold is reported as a regression and the exit status is
+# 1. Timings depend on the machine, so the history is local and not committed.
+#
+# Usage: python benchmark.py [--repeat N] [--history FILE] [--no-record] [--set-baseline]
+
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from assembler import PORTS, PORT_BASE, assemble_lines
+from emulator import Emulator
+from optimizer import parse, optimize
+from schematic import make_schematic
+
+HISTORY = Path(__file__).with_name('benchmark_history.json')
+STAGES = ['lexer', 'parser', 'codegen', 'optimize', 'assemble', 'schematic']
+# Relative growth over the baseline allowed before a metric is a regression.
+# Timings are noisy, so they also need to grow by at least NOISE_FLOOR seconds.
+THRESHOLDS = {'seconds': 0.25, 'rom_words': 0.0, 'first_frame': 0.0, 'ast_bytes': 0.1}
+NOISE_FLOOR = 0.001
+# A frame is shown when the screen buffer or the character buffer is pushed
+FRAME_PORTS = [PORT_BASE + PORTS.index('buffer_screen'), PORT_BASE + PORTS.index('buffer_chars')]
+FIRST_FRAME_CYCLES = 200000
+# Size of the generated VortexScript module: classes x methods x statements
+GENERATED_MODULE = (10, 20, 16)
+
+def timed(function, repeat):
+    # (best wall time in seconds, result of the last call)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def ast_bytes(parse):
+    # Memory still allocated after parsing, i.e. the size of the tree itself
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        ast = parse()
+        return tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+def first_frame(rom, max_cycles=FIRST_FRAME_CYCLES):
+    # Cycles until the first frame, or None if there is none in max_cycles
+    emulator = Emulator(rom)
+    writes = 0
+    while not emulator.halted and emulator.cycles < max_cycles:
+        emulator.step()
+        if len(emulator.port_writes) != writes:
+            writes = len(emulator.port_writes)
+            if emulator.port_writes[-1][1] in FRAME_PORTS:
+                return emulator.cycles
+    return None
+
+def backend(assembly_code, stages, repeat, workdir):
+    # Optimize, assemble and write a schematic; returns the ROM words
+    stages['optimize'], program = timed(lambda: optimize(parse(assembly_code)), repeat)
+    return assemble_and_write(program, stages, repeat, workdir)
+
+def assemble_and_write(source, stages, repeat, workdir):
+    stages['assemble'], (rom, symbols) = timed(lambda: assemble_lines(source_lines(source)), repeat)
+    mc_file = workdir / 'benchmark.mc'
+    mc_file.write_text("".join(f"{bin(word)[2:].rjust(16, '0')}\n" for word in rom))
+    stages['schematic'], _ = timed(lambda: make_schematic(mc_file, workdir / 'benchmark.schem'), repeat)
+    return rom
+
+def source_lines(source):
+    # Assembly text, or a parsed program from the optimizer, as lines
+    if isinstance(source, str):
+        return source.splitlines()
+    return [" ".join(words) for words in source]
+
+def run_assembly(path, repeat, workdir):
+    stages = {}
+    rom = assemble_and_write(path.read_text(), stages, repeat, workdir)
+    return stages, rom, None
+
+def run_cs(path, repeat, workdir):
+    from compiler.lexer import tokenize
+    from compiler.parser import Parser
+    from compiler.codegen import CodeGenerator
+    source = path.read_text(encoding='utf-8-sig')
+    stages = {}
+    # The parser pulls tokens lazily, so its time includes scanning; the
+    # lexer stage times scanning alone
+    stages['lexer'], _ = timed(lambda: list(tokenize(source)), repeat)
+    stages['parser'], ast = timed(lambda: Parser(tokenize(source)).parse(), repeat)
+    stages['codegen'], assembly_code = timed(lambda: CodeGenerator().generate(ast), repeat)
+    size = ast_bytes(lambda: Parser(tokenize(source)).parse())
+    return stages, backend(assembly_code, stages, repeat, workdir), size
+
+def run_vsc(path, repeat, workdir):
+    stages, assembly_code, size = vsc_front_end(path, repeat)
+    return stages, backend(assembly_code, stages, repeat, workdir), size
+
+def run_generated_vsc(path, repeat, workdir):
+    stages, _, size = vsc_front_end(path, repeat)
+    return stages, None, size
+
+def vsc_front_end(path, repeat):
+    import mainVSC
+    from compilerVSC.lexer import tokenize
+    from compilerVSC.parser import Parser, Program
+    from compilerVSC.codegen import CodeGenerator
+    # The driver resolves imports; time the stages over every file it loaded
+    mainVSC.loaded_files.clear()
+    mainVSC.process_file(path, [])
+    sources = [file.read_text(encoding='utf-8-sig') for file in sorted(mainVSC.loaded_files)]
+
+    def parse_all():
+        namespaces = []
+        for source in sources:
+            namespaces.extend(Parser(tokenize(source)).parse().namespaces)
+        return Program(namespaces)
+
+    stages = {}
+    stages['lexer'], _ = timed(lambda: [list(tokenize(source)) for source in sources], repeat)
+    stages['parser'], ast = timed(parse_all, repeat)
+    stages['codegen'], assembly_code = timed(lambda: CodeGenerator().generate(ast), repeat)
+    return stages, assembly_code, ast_bytes(parse_all)
+
+def generated_vsc(classes, methods, statements):
+    # A large module in the subset the VortexScript compiler handles. Variables
+    # live in registers, so the names are drawn from a small pool.
+    names = "abcdefgh"
+    lines = ["public class Main {", "    public static void main() {", "    }", "}"]
+    for c in range(classes):
+        lines.append(f"public class Generated{c} {{")
+        for m in range(methods):
+            lines.append(f"    public static void method{m}() {{")
+            for i in range(statements):
+                name, operand = names[i % len(names)], names[(i + m) % len(names)]
+                if i < len(names):
+                    lines.append(f"        byte {name} = {i + m};")
+                else:
+                    lines.append(f"        byte {name} = {operand} + {i};")
+            lines.append(f"        Generated{c}.method{(m + 1) % methods}();")
+            lines.append("    }")
+        lines.append("}")
+    return "\n".join(lines) + "\n"
+
+def workloads(workdir):
+    # (name, path, runner)
+    for path in sorted(Path('done').glob('*.as')):
+        yield path.name, path, run_assembly
+    for path in sorted(Path('programs').glob('*.cs')):
+        yield path.name, path, run_cs
+    yield 'main.vsc', Path('VortexScript/main.vsc'), run_vsc
+    generated = workdir / 'generated.vsc'
+    generated.write_text(generated_vsc(*GENERATED_MODULE))
+    yield generated.name, generated, run_generated_vsc
+
+def run_benchmarks(repeat):
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, path, runner in workloads(Path(workdir)):
+            result = {'lines': len(path.read_text(encoding='utf-8-sig').splitlines())}
+            try:
+                stages, rom, size = runner(path, repeat, Path(workdir))
+                result['stages'] = stages
+                if rom is not None:
+                    result['rom_words'] = len(rom)
+                    result['first_frame'] = first_frame(rom)
+                if size is not None:
+                    result['ast_bytes'] = size
+            except (SyntaxError, NotImplementedError, ValueError, KeyError, IndexError, SystemExit) as error:
+                # SystemExit: the assembler reports bad source with exit()
+                result['error'] = f"{type(error).__name__}: {error}"
+            results[name] = result
+    return results
+
+def compare(baseline, results):
+    # Regressions of results against a baseline run, as printable lines
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if not old or 'error' in old or 'error' in result:
+            continue
+        for stage, seconds in result['stages'].items():
+            before = old['stages'].get(stage)
+            if before is not None and seconds > before * (1 + THRESHOLDS['seconds']) and seconds - before > NOISE_FLOOR:
+                regressions.append(f"{name} {stage}: {before * 1000:.2f} ms -> {seconds * 1000:.2f} ms")
+        for metric in ['rom_words', 'first_frame', 'ast_bytes']:
+            before, after = old.get(metric), result.get(metric)
+            if before is None:
+                continue
+            if after is None or after > before * (1 + THRESHOLDS[metric]):
+                regressions.append(f"{name} {metric}: {before} -> {after}")
+    return regressions
+
+def baseline_entry(history):
+    # The entry runs are judged against, or None for an empty history
+    marked = [entry for entry in history if entry.get('baseline')]
+    return marked[-1] if marked else (history[0] if history else None)
+
+def format_results(results):
+    header = f"{'workload':<18}" + "".join(f"{stage:>11}" for stage in STAGES) + f"{'ROM':>7}{'1st frame':>11}{'AST KiB':>9}"
+    lines = [header, f"{'':<18}" + f"{'(ms)':>11}" * len(STAGES)]
+    totals = {stage: [0, 0.0] for stage in STAGES}  # source lines, seconds
+    for name, result in results.items():
+        if 'error' in result:
+            lines.append(f"{name:<18}  {result['error']}")
+            continue
+        row = f"{name:<18}"
+        for stage in STAGES:
+            seconds = result['stages'].get(stage)
+            row += f"{seconds * 1000:>11.2f}" if seconds is not None else f"{'-':>11}"
+            if seconds is not None:
+                totals[stage][0] += result['lines']
+                totals[stage][1] += seconds
+        rom, frame, size = result.get('rom_words'), result.get('first_frame'), result.get('ast_bytes')
+        lines.append(row + f"{rom if rom is not None else '-':>7}{frame if frame is not None else '-':>11}"
+                     + (f"{size / 1024:>9.1f}" if size is not None else f"{'-':>9}"))
+    lines.append("Throughput (source lines/s): " + ", ".join(
+        f"{stage} {count / seconds:,.0f}" for stage, (count, seconds) in totals.items() if seconds))
+    return "\n".join(lines)
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the toolchain over the showcase programs")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per stage, the best one counts")
+    parser.add_argument('--history', type=Path, default=HISTORY)
+    parser.add_argument('--no-record', action='store_true', help="compare without appending to the history")
+    parser.add_argument('--set-baseline', action='store_true', help="record this run as the baseline later runs are compared with")
+    args = parser.parse_args()
+    if args.no_record and args.set_baseline:
+        parser.error("--set-baseline records the run, so it cannot be combined with --no-record")
+
+    results = run_benchmarks(args.repeat)
+    print(format_results(results))
+
+    history = json.loads(args.history.read_text()) if args.history.exists() else []
+    baseline = baseline_entry(history)
+    regressions = compare(baseline['results'], results) if baseline else []
+    if baseline:
+        print(f"\nCompared with the baseline of {baseline['timestamp']} ({baseline['commit'] or 'no commit'}):")
+        print("\n".join(f"  REGRESSION {line}" for line in regressions) or "  no regressions")
+
+    if not args.no_record:
+        history.append({
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'results': results,
+            **({'baseline': True} if args.set_baseline else {}),
+        })
+        args.history.write_text(json.dumps(history, indent=1))
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# Per-method code generation cache shared by both compilers.
+#
+# A build stores, next to the program, the code each method generated and a
+# key over everything that code depends on: the method's AST and those of the
+# methods it can reach (inlining copies them in), how often each is called,
+# the addresses and registers of the names they use and the unroll factors of
+# their loops, plus a digest of the code generator's own source. The next
+# build reuses the text of every method whose key is unchanged and only
+# generates the others.
+#
+# Reuse needs the inputs to stay put, so the data layout and the VortexScript
+# register assignment are stored as well and passed back to the planners,
+# which keep every name that is still in use where it was. Labels inside a
+# method are numbered per method for the same reason. A build with --fresh
+# ignores the stored state and plans everything from scratch.
+
+import hashlib
+import json
+from pathlib import Path
+
+VERSION = 1
+
+def source_digest(*paths):
+    # Digest of the files a code generator is made of; an edited generator misses
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(Path(path).read_bytes())
+    return digest.hexdigest()
+
+class CodeCache:
+    def __init__(self, path=None, fresh=False):
+        # fresh: start empty but still save to path
+        self.path = Path(path) if path else None
+        self.layout = {}     # name -> (address, size)
+        self.registers = {}  # name -> register, VortexScript only
+        self.entries = {}    # method label -> {'key', 'code', 'helpers'}
+        self.used = {}       # entries of this build, the only ones saved
+        self.hits = self.misses = 0
+        if self.path and self.path.exists() and not fresh:
+            try:
+                stored = json.loads(self.path.read_text())
+            except ValueError:
+                stored = {}
+            if stored.get('version') == VERSION:
+                self.layout = {name: tuple(place) for name, place in stored['layout'].items()}
+                self.registers = stored['registers']
+                self.entries = stored['methods']
+
+    def key(self, *parts):
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    def get(self, label, key):
+        # The stored entry for the method if its key matches, else None
+        entry = self.entries.get(label)
+        if entry is None or entry['key'] != key:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used[label] = entry
+        return entry
+
+    def put(self, label, key, code, helpers=()):
+        self.used[label] = {'key': key, 'code': list(code), 'helpers': sorted(helpers)}
+
+    def save(self):
+        if self.path:
+            stored = {'version': VERSION, 'layout': self.layout, 'registers': self.registers, 'methods': self.used}
+            self.path.write_text(json.dumps(stored, indent=1) + "\n")
+
+    def summary(self):
+        return f"Code cache: {self.hits} of {self.hits + self.misses} methods reused"
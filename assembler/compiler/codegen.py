@@ -1,13 +1,86 @@
+import memory_layout
 from compiler.parser import VariableDeclaration, IfStatement, WhileStatement, Program, Namespace, Class, Method, FunctionCall
+from compiler import evaluator
+from compiler.evaluator import Evaluator, COMPARISONS
+from codecache import source_digest
+from memory_layout import DataLayout
+from nodes import fingerprint, strings
+from optimizer import ROM_SIZE
+
+# Part of every cache key, so cached code never outlives the generator that wrote it
+SOURCE_DIGEST = source_digest(__file__, memory_layout.__file__, evaluator.__file__)
 
 class CodeGenerator:
-    def __init__(self):
+    # Registers holding hoisted loop condition operands, two per loop nesting level
+    HOIST_REGISTERS = ["r5", "r6", "r7", "r8"]
+    # Arguments are passed in r9..r12 (see registerUsecases.txt), so loading them
+    # leaves the value and hoist registers alone
+    ARGUMENT_REGISTERS = ["r9", "r10", "r11", "r12"]
+    # Values, addresses and condition operands; any statement may write these
+    SCRATCH_REGISTERS = {"r1", "r2", "r3", "r4", "r14"}
+    # Methods whose body generates at most this many instructions are always inlined
+    INLINE_MAX_SIZE = 8
+    # Accesses inside a loop count this many times more when placing variables
+    LOOP_WEIGHT = 8
+    # Share of the unused ROM that unrolling may grow into, and the largest partial
+    # unroll factor; beyond it each extra copy saves little of the loop overhead
+    UNROLL_ROM_SHARE = 0.5
+    UNROLL_MAX_FACTOR = 16
+    # With a profile, calls that ran at least this often are inlined up to this size
+    INLINE_HOT_CALLS = 16
+    INLINE_HOT_SIZE = 32
+    # Flag condition for "left OP right" after cmp, and whether the cmp swaps its
+    # operands. The carry flag only gives >= and <, so > and <= compare right to left.
+    CONDITIONS = {
+        "==": ("eq", False),
+        "!=": ("ne", False),
+        "<": ("lt", False),
+        ">=": ("ge", False),
+        ">": ("lt", True),
+        "<=": ("ge", True),
+    }
+    INVERTED_CONDITIONS = {"eq": "ne", "ne": "eq", "lt": "ge", "ge": "lt"}
+
+    def __init__(self, unroll=True, profile=None, instrument=False, cache=None):
+        self.unroll = unroll
+        self.profile = profile       # AST node -> times it ran in an emulator run, or None
+        self.markers = {} if instrument else None  # marker label -> AST node
+        # Profiles and markers key on AST nodes, which a cache cannot; such builds skip it
+        self.cache = cache if profile is None and not instrument else None
         self.code = []
-        self.memory_map = {}
-        self.next_free_address = 0
+        self.layout = DataLayout()
+        self.memory_map = self.layout.addresses
         self.label_count = 0
+        self.method_name = None      # labels are numbered per method
+        self.hoist_depth = 0
+        self.methods = {}
+        self.call_sites = {}
+        self.inline_stack = []
+        self.recursive = {}          # method name -> whether it can reach itself
+        self.clobber_sets = {}       # method name -> registers a call to it may change
+        self.constants = {}          # variable -> value known at this point of the code
+        self.deferred_stores = {}    # variable -> known value not yet stored, in a fully unrolled loop
+        self.deferring = 0
+        self.evaluator = Evaluator(self.methods)
+        self.measuring = 0
+        self.unroll_candidates = {}  # WhileStatement -> (trips, body size, test size, copies)
+        self.unroll_factors = {}     # WhileStatement -> iterations emitted per test
+        self.fingerprints = {}       # method name -> fingerprint of its AST
+        # Statement node type -> generator; ReturnStatement has none yet
+        self.statement_generators = {
+            VariableDeclaration: self.generate_variable_declaration,
+            IfStatement: self.generate_if_statement,
+            WhileStatement: self.generate_while_statement,
+            FunctionCall: self.generate_function_call,
+        }
 
     def generate(self, ast):
+        self.collect_methods(ast)
+        if self.unroll:
+            self.plan_unrolling(ast)
+        self.plan_data_layout()
+        for reg, base in self.layout.pinned_registers():
+            self.code.append(f"ldi {reg} {base}")
         self.code.append("cal .Main")
         self.code.append("hlt")
         for namespace in ast.namespaces:
@@ -22,105 +95,608 @@ class CodeGenerator:
         for method in klass.methods:
             self.generate_method(method)
 
+    def collect_methods(self, ast):
+        for namespace in ast.namespaces:
+            for klass in namespace.classes:
+                for method in klass.methods:
+                    if len(method.parameters) > len(self.ARGUMENT_REGISTERS):
+                        raise ValueError(f"{method.name} has more than {len(self.ARGUMENT_REGISTERS)} parameters")
+                    self.methods[method.name] = method
+        for method in self.methods.values():
+            for name in self.called_names(method.body):
+                self.call_sites[name] = self.call_sites.get(name, 0) + 1
+
+    def plan_data_layout(self):
+        counts = {}
+        for method in self.methods.values():
+            for param_type, param_name in method.parameters:
+                counts[param_name] = counts.get(param_name, 0) + 1
+            self.count_accesses(method.body, counts, 1)
+        if self.cache is None:
+            self.layout.plan(counts)
+        else:
+            self.layout.plan(counts, previous=self.cache.layout)
+            self.cache.layout = self.layout.assignments()
+
+    def count_accesses(self, statements, counts, weight):
+        def add(operand):
+            if isinstance(operand, str):
+                counts[operand] = counts.get(operand, 0) + weight
+        for stmt in statements:
+            if self.profile is not None:
+                # Measured counts replace the static loop weighting; a loop
+                # condition runs once per entry plus once per iteration
+                weight = self.executions(stmt)
+                if isinstance(stmt, WhileStatement) and stmt.body:
+                    weight += self.executions(stmt.body[0])
+            if isinstance(stmt, VariableDeclaration):
+                add(stmt.name)
+                if isinstance(stmt.value, tuple):
+                    add(stmt.value[1])
+                    add(stmt.value[2])
+            elif isinstance(stmt, IfStatement):
+                add(stmt.condition[1])
+                add(stmt.condition[2])
+                self.count_accesses(stmt.body, counts, weight)
+                self.count_accesses(stmt.else_body, counts, weight)
+            elif isinstance(stmt, WhileStatement):
+                add(stmt.condition[1])
+                add(stmt.condition[2])
+                self.count_accesses(stmt.body, counts, weight * self.LOOP_WEIGHT)
+            elif isinstance(stmt, FunctionCall):
+                for arg in stmt.arguments:
+                    add(arg)
+
+    def plan_unrolling(self, ast):
+        # Generate once without unrolling to learn the program size and which loops
+        # have a known trip count, then spend the ROM left over on the loops that
+        # save the most test-and-branch cycles per extra word. A profile weights each
+        # loop by how often it was entered and leaves out loops that never ran.
+        baseline = CodeGenerator(unroll=False, profile=self.profile)
+        size = len([line for line in baseline.generate(ast).split("\n") if not line.startswith(".")])
+        budget = int((ROM_SIZE - size) * self.UNROLL_ROM_SHARE)
+        candidates = [(stmt, info) for stmt, info in baseline.unroll_candidates.items()
+                      if info and (self.profile is None or self.executions(stmt))]
+        entries = (lambda stmt: 1) if self.profile is None else self.executions
+        candidates.sort(key=lambda item: -entries(item[0]) * (item[1][2] + 1) / max(item[1][1], 1))
+        for stmt, (trips, body, test, copies) in candidates:
+            for factor in range(trips, 1, -1):
+                if trips % factor or (factor != trips and factor > self.UNROLL_MAX_FACTOR):
+                    continue
+                # A full unroll also drops the test, the branch and the entry jump
+                extra = copies * ((factor - 1) * body - (test + 2 if factor == trips else 0))
+                if extra <= budget:
+                    self.unroll_factors[stmt] = factor
+                    budget -= max(extra, 0)
+                    break
+
     def generate_method(self, method):
+        key = self.method_key(method) if self.cache is not None else None
+        cached = key and self.cache.get(method.name, key)
+        if cached:
+            self.code.extend(cached['code'])
+            return
+        start = len(self.code)
+        self.method_name, self.label_count = method.name, 0
         self.code.append(f".{method.name}")
-        for statement in method.body:
+        self.constants = {}
+        self.store_parameters(method)
+        body = method.body
+        # A call in tail position jumps straight to the callee, whose ret returns for us
+        tail = body[-1] if body and isinstance(body[-1], FunctionCall) and not self.should_inline(body[-1].name, body[-1]) else None
+        for statement in (body[:-1] if tail else body):
             self.generate_statement(statement)
-        self.code.append("ret")
+        if tail:
+            self.mark(tail)
+        if tail and not self.evaluate_call(tail):
+            self.load_arguments(tail.arguments)
+            self.code.append(f"jmp .{tail.name}")
+        else:
+            self.code.append("ret")
+        if key:
+            self.cache.put(method.name, key, self.code[start:])
+
+    def method_key(self, method):
+        # Everything the method's code depends on: its AST and those of the methods
+        # it reaches, their call counts, the addresses of the names they use and the
+        # unroll factors of their loops
+        closure = sorted(self.reachable(method.name))
+        trees = []
+        for name in closure:
+            if name not in self.fingerprints:
+                self.fingerprints[name] = fingerprint(self.methods[name])
+            trees.append((self.fingerprints[name], self.call_sites.get(name, 0)))
+        names = set().union(*(strings(self.methods[name]) for name in closure))
+        loops = [loop for name in closure for loop in self.loops(self.methods[name].body)]
+        addresses = sorted((name, self.memory_map[name]) for name in names if name in self.memory_map)
+        return self.cache.key(SOURCE_DIGEST, self.unroll, trees, addresses,
+                              [self.unroll_factors.get(loop, 1) for loop in loops])
+
+    def loops(self, statements):
+        # While statements in source order, nested ones after the loop holding them
+        found = []
+        for stmt in statements:
+            if isinstance(stmt, WhileStatement):
+                found.append(stmt)
+                found += self.loops(stmt.body)
+            elif isinstance(stmt, IfStatement):
+                found += self.loops(stmt.body) + self.loops(stmt.else_body)
+        return found
+
+    def store_parameters(self, method):
+        for reg, (param_type, param_name) in zip(self.ARGUMENT_REGISTERS, method.parameters):
+            self.store_variable(param_name, reg, "r14")
+
+    def mark(self, node):
+        # Profiling build: the pc of this label tells how often the node ran
+        if self.markers is not None and not self.measuring:
+            label = f".profile_{len(self.markers)}"
+            self.markers[label] = node
+            self.code.append(label)
 
     def generate_statement(self, statement):
-        if isinstance(statement, VariableDeclaration):
-            self.generate_variable_declaration(statement)
-        elif isinstance(statement, IfStatement):
-            self.generate_if_statement(statement)
-        elif isinstance(statement, WhileStatement):
-            self.generate_while_statement(statement)
-        elif isinstance(statement, FunctionCall):
-            self.generate_function_call(statement.name, statement.arguments)
+        self.mark(statement)
+        generator = self.statement_generators.get(type(statement))
+        if generator is None:
+            raise NotImplementedError(f"Unknown statement type: {statement.kind}")
+        generator(statement)
+
+    def allocate_variable(self, name):
+        return self.layout.allocate(name)
+
+    def store_variable(self, name, reg, address_reg="r2"):
+        # Variables in a pinned window are one str; the rest need their address loaded
+        self.deferred_stores.pop(name, None)
+        address = self.allocate_variable(name)
+        reach = self.layout.access(address)
+        if reach:
+            self.code.append(f"str {reach[0]} {reg} {reach[1]}")
         else:
-            raise NotImplementedError(f"Unknown statement type: {type(statement)}")
+            self.code.append(f"ldi {address_reg} {address}")
+            self.code.append(f"str {address_reg} {reg} 0")
 
     def generate_variable_declaration(self, declaration):
-        if declaration.name not in self.memory_map:
-            self.memory_map[declaration.name] = self.next_free_address
-            self.next_free_address += 1
-        if isinstance(declaration.value, tuple):
+        value = self.constant_value(declaration.value)
+        if value is not None and self.deferring:
+            # Reads of it fold to the value, so only the last store is needed
+            self.deferred_stores[declaration.name] = value
+            self.constants[declaration.name] = value
+            return
+        if value is not None:
+            self.code.append(f"ldi r1 {value}")
+        elif isinstance(declaration.value, tuple):
             self.generate_expression(declaration.value)
-            self.code.append(f"ldi r2 {self.memory_map[declaration.name]}")
-            self.code.append(f"str r2 r1 0")
         else:
-            self.code.append(f"ldi r1 {declaration.value}")
-            self.code.append(f"ldi r2 {self.memory_map[declaration.name]}")
-            self.code.append(f"str r2 r1 0")
+            self.load_operand(declaration.value, "r1")
+        self.store_variable(declaration.name, "r1")
+        if value is None:
+            self.constants.pop(declaration.name, None)
+        else:
+            self.constants[declaration.name] = value
+
+    def flush_stores(self):
+        # Store what a fully unrolled loop held back, before anything may read
+        # it from RAM: a call, a branch, another loop, or the end of the loop
+        pending, self.deferred_stores = self.deferred_stores, {}
+        loaded = None
+        for name, value in pending.items():
+            if value != loaded:
+                self.code.append(f"ldi r1 {value}")
+                loaded = value
+            self.store_variable(name, "r1")
+
+    def constant_value(self, value):
+        # Value of an expression when every operand is known here, else None
+        return self.evaluator.value(value, self.constants)
 
     def generate_if_statement(self, stmt):
         operator, left, right = stmt.condition
-        self.generate_condition(operator, left, right)
+        if not stmt.body and not stmt.else_body:
+            return
+        left_value, right_value = self.constant_value(left), self.constant_value(right)
+        if left_value is not None and right_value is not None:
+            # Known outcome, e.g. inside an unrolled loop: only the taken branch is emitted
+            taken = stmt.body if COMPARISONS[operator](left_value, right_value) else stmt.else_body
+            for s in taken:
+                self.generate_statement(s)
+            return
+        # Each branch starts from what is known before the if; afterwards only
+        # what neither branch writes is still known
+        self.flush_stores()
+        entry = dict(self.constants)
+        assigned = self.assigned_names(stmt.body) | self.assigned_names(stmt.else_body)
+        self.generate_if_branches(stmt, entry)
+        self.constants = {name: value for name, value in entry.items() if name not in assigned}
+
+    def generate_if_branches(self, stmt, entry):
+        operator, left, right = stmt.condition
         end_label = self.get_new_label("end")
-        self.code.append(f"brh {self.invert_condition(operator)} {end_label}")
+        self.generate_condition(operator, left, right)
+        if not stmt.body:
+            # Only the else branch does work, so branch past it when the condition holds
+            self.code.append(f"brh {self.branch_condition(operator)} {end_label}")
+            for s in stmt.else_body:
+                self.generate_statement(s)
+            self.code.append(end_label)
+            return
+        if not stmt.else_body:
+            self.code.append(f"brh {self.invert_condition(operator)} {end_label}")
+            for s in stmt.body:
+                self.generate_statement(s)
+            self.code.append(end_label)
+            return
+        if self.profile is not None and self.executions(stmt.else_body[0]) > self.executions(stmt.body[0]):
+            # The else branch ran more often, so it gets the fall-through
+            then_label = self.get_new_label("then")
+            self.code.append(f"brh {self.branch_condition(operator)} {then_label}")
+            for s in stmt.else_body:
+                self.generate_statement(s)
+            self.code.append(f"jmp {end_label}")
+            self.code.append(then_label)
+            self.constants = dict(entry)
+            for s in stmt.body:
+                self.generate_statement(s)
+            self.code.append(end_label)
+            return
+        else_label = self.get_new_label("else")
+        self.code.append(f"brh {self.invert_condition(operator)} {else_label}")
         for s in stmt.body:
             self.generate_statement(s)
+        self.code.append(f"jmp {end_label}")
+        self.code.append(else_label)
+        self.constants = dict(entry)
+        for s in stmt.else_body:
+            self.generate_statement(s)
         self.code.append(end_label)
 
     def generate_while_statement(self, stmt):
-        start_label = self.get_new_label("while_start")
-        end_label = self.get_new_label("while_end")
-        self.code.append(start_label)
+        # Rotated loop: jump to the test once, then test at the bottom so each
+        # iteration only pays for the compare and a single taken branch
+        operator, left, right = stmt.condition
+        self.flush_stores()
+        trips = self.loop_trip_count(stmt)
+        factor = self.unroll_factors.get(stmt, 1)
+        if trips is not None and not self.measuring and not self.unroll:
+            self.record_unroll_candidate(stmt, trips)
+        if trips is not None and factor == trips:
+            # Fully unrolled: the body repeats with no test at all, and each
+            # variable it sets to a known value is stored once, at the end
+            self.deferring += 1
+            for _ in range(trips):
+                for s in stmt.body:
+                    self.generate_statement(s)
+            self.deferring -= 1
+            if not self.deferring:
+                self.flush_stores()
+            return
+        if trips is None or trips % factor:
+            factor = 1
+        for name in self.assigned_names(stmt.body):
+            self.constants.pop(name, None)
+        body_label = self.get_new_label("while_body")
+        cond_label = self.get_new_label("while_cond")
+        left_reg, right_reg = self.hoist_condition_operands(left, right, stmt.body)
+        if factor == 1:
+            self.code.append(f"jmp {cond_label}")
+        # else the loop is known to run at least once, so it starts with the body
+        self.code.append(body_label)
+        self.hoist_depth += 1
+        for _ in range(factor):
+            for s in stmt.body:
+                self.generate_statement(s)
+        self.hoist_depth -= 1
+        self.code.append(cond_label)
+        self.generate_condition(operator, left, right, left_reg, right_reg)
+        self.code.append(f"brh {self.branch_condition(operator)} {body_label}")
+        for name in self.assigned_names(stmt.body):
+            self.constants.pop(name, None)
+
+    def loop_trip_count(self, stmt):
+        # Iterations of an innermost loop whose counter starts at a known value
+        # and steps by a constant exactly once per iteration, else None
+        operator, left, right = stmt.condition
+        if left not in self.constants or not isinstance(right, int):
+            return None
+        if any(isinstance(s, WhileStatement) for s in stmt.body):
+            return None
+        steps = [s for s in stmt.body if isinstance(s, VariableDeclaration) and s.name == left]
+        if len(steps) != 1 or left in self.assigned_names([s for s in stmt.body if s is not steps[0]]):
+            return None
+        step = steps[0].value
+        if not (isinstance(step, tuple) and step[0] in "+-" and step[1] == left and isinstance(step[2], int)):
+            return None
+        if any(left in self.method_assigns(name) for name in self.called_names(stmt.body)):
+            return None
+        value, trips = self.constants[left], 0
+        while COMPARISONS[operator](value, right):
+            trips += 1
+            if trips > 255:
+                return None
+            value = (value + step[2] if step[0] == "+" else value - step[2]) & 255
+        return trips
+
+    def record_unroll_candidate(self, stmt, trips):
+        body = self.measure(stmt.body)
+        test = self.measure_condition(stmt)
+        if stmt in self.unroll_candidates:
+            # Reached again, e.g. through inlining; only keep it if it agrees
+            info = self.unroll_candidates[stmt]
+            self.unroll_candidates[stmt] = info and (trips, body, test, info[3] + 1) if info and info[0] == trips else None
+        else:
+            self.unroll_candidates[stmt] = (trips, body, test, 1)
+
+    def measure(self, statements, method=None):
+        # Instructions the statements would generate here, without emitting them
+        state = self.code, self.label_count, dict(self.constants), self.hoist_depth, dict(self.deferred_stores)
+        self.code = []
+        self.measuring += 1
+        if method:
+            self.inline_stack.append(method.name)
+            self.store_parameters(method)
+        for statement in statements:
+            self.generate_statement(statement)
+        if method:
+            self.inline_stack.pop()
+        self.measuring -= 1
+        size = len([line for line in self.code if not line.startswith(".")])
+        self.code, self.label_count, self.constants, self.hoist_depth, self.deferred_stores = state
+        return size
+
+    def measure_condition(self, stmt):
+        code = self.code
+        self.code = []
         operator, left, right = stmt.condition
         self.generate_condition(operator, left, right)
-        self.code.append(f"brh {self.invert_condition(operator)} {end_label}")
-        for s in stmt.body:
-            self.generate_statement(s)
-        self.code.append(f"jmp {start_label}")
-        self.code.append(end_label)
+        size = len(self.code)
+        self.code = code
+        return size
+
+    def hoist_condition_operands(self, left, right, body):
+        # Condition operands the body never writes are loaded into registers once,
+        # before the loop. A call in the body must leave both hoist registers alone,
+        # and neither it nor its callees may assign the operands.
+        first = self.hoist_depth * 2
+        if first + 2 > len(self.HOIST_REGISTERS):
+            return None, None
+        calls = self.called_names(body)
+        if set(self.HOIST_REGISTERS[first:first + 2]) & set().union(*map(self.clobbers, calls)):
+            return None, None
+        left_reg = right_reg = None
+        assigned = self.assigned_names(body).union(*map(self.method_assigns, calls))
+        if left in self.memory_map and left not in assigned:
+            left_reg = self.HOIST_REGISTERS[first]
+            self.load_operand(left, left_reg)
+        if right == 0:
+            right_reg = "r0"
+        elif isinstance(right, int) or (right in self.memory_map and right not in assigned):
+            right_reg = self.HOIST_REGISTERS[first + 1]
+            self.load_operand(right, right_reg)
+        return left_reg, right_reg
 
-    def generate_function_call(self, name, arguments):
-        for i, arg in enumerate(arguments):
+    def assigned_names(self, statements):
+        names = set()
+        for stmt in statements:
+            if isinstance(stmt, VariableDeclaration):
+                names.add(stmt.name)
+            elif isinstance(stmt, IfStatement):
+                names |= self.assigned_names(stmt.body) | self.assigned_names(stmt.else_body)
+            elif isinstance(stmt, WhileStatement):
+                names |= self.assigned_names(stmt.body)
+        return names
+
+    def generate_function_call(self, call):
+        name, arguments = call.name, call.arguments
+        if self.evaluate_call(call):
+            return
+        self.flush_stores()
+        self.load_arguments(arguments)
+        if self.should_inline(name, call):
+            method = self.methods[name]
+            self.store_parameters(method)
+            for (param_type, param_name), arg in zip(method.parameters, arguments):
+                value = self.constant_value(arg)
+                if value is None:
+                    self.constants.pop(param_name, None)
+                else:
+                    self.constants[param_name] = value
+            self.inline_stack.append(name)
+            for statement in method.body:
+                self.generate_statement(statement)
+            self.inline_stack.pop()
+        else:
+            self.code.append(f"cal .{name}")
+            # What the callee and its callees may write is no longer known
+            for assigned in self.method_assigns(name):
+                self.constants.pop(assigned, None)
+
+    def evaluate_call(self, call):
+        # A call whose inputs are all known here runs at compile time: what it
+        # assigns is stored directly, each variable once with its final value.
+        # Calls that can reach a recursive method stay, since how deep they go
+        # is up to the call stack.
+        if call.name not in self.methods or any(self.is_recursive(name) for name in self.reachable(call.name)):
+            return False
+        results = self.evaluator.call(call.name, call.arguments, self.constants)
+        if results is None:
+            return False
+        loaded = None
+        for name, value in results.items():
+            if self.constants.get(name) == value:
+                continue
+            if value != loaded:
+                self.code.append(f"ldi r1 {value}")
+                loaded = value
+            self.store_variable(name, "r1")
+        self.constants.update(results)
+        return True
+
+    def load_arguments(self, arguments):
+        if len(arguments) > len(self.ARGUMENT_REGISTERS):
+            raise ValueError(f"More than {len(self.ARGUMENT_REGISTERS)} arguments in a call")
+        for reg, arg in zip(self.ARGUMENT_REGISTERS, arguments):
             if isinstance(arg, int):
-                self.code.append(f"ldi r{i+1} {arg}")
+                self.code.append(f"ldi {reg} {arg}")
             elif isinstance(arg, str) and arg in self.memory_map:
-                self.code.append(f"ldi r{i+1} {self.memory_map[arg]}")
-                self.code.append(f"lod r{i+1} r{i+1} 0")
-        self.code.append(f"cal .{name}")
+                self.load_operand(arg, reg, reg)
+
+    def should_inline(self, name, call=None):
+        # Inlining saves the cal/ret pair and a call stack slot. Small bodies are
+        # always worth it, and a single call site means no code is duplicated.
+        # Calls the profile shows are hot may grow the code a little more.
+        if name not in self.methods or name in self.inline_stack or self.is_recursive(name):
+            return False
+        if self.call_sites.get(name, 0) == 1:
+            return True
+        size = self.method_size(self.methods[name])
+        if size <= self.INLINE_MAX_SIZE:
+            return True
+        return call is not None and self.executions(call) >= self.INLINE_HOT_CALLS and size <= self.INLINE_HOT_SIZE
+
+    def executions(self, node):
+        # Times the node ran in the profiling run, 0 without a profile
+        return self.profile.get(node, 0) if self.profile is not None else 0
+
+    def method_size(self, method):
+        return self.measure(method.body, method)
+
+    def method_assigns(self, name, seen=None):
+        # Variables a call to the method may write, including through its callees
+        seen = seen if seen is not None else set()
+        if name in seen or name not in self.methods:
+            return set()
+        seen.add(name)
+        method = self.methods[name]
+        names = self.assigned_names(method.body) | {param_name for param_type, param_name in method.parameters}
+        for callee in self.called_names(method.body):
+            names |= self.method_assigns(callee, seen)
+        return names
+
+    def clobbers(self, name):
+        # Registers a call to the method may change: the scratch registers, the
+        # argument registers of the calls it makes, and the hoist registers its
+        # loops use, counting the loops of its callees as nested inside them
+        if name not in self.methods:
+            return set(self.SCRATCH_REGISTERS)
+        if name not in self.clobber_sets:
+            self.clobber_sets[name] = set(self.SCRATCH_REGISTERS) | set(self.HOIST_REGISTERS) | set(self.ARGUMENT_REGISTERS)
+            registers = set(self.SCRATCH_REGISTERS) | set(self.HOIST_REGISTERS[:2 * self.loop_depth(self.methods[name].body)])
+            for stmt in self.calls(self.methods[name].body):
+                registers |= set(self.ARGUMENT_REGISTERS[:len(stmt.arguments)]) | self.clobbers(stmt.name)
+            self.clobber_sets[name] = registers
+        return self.clobber_sets[name]
+
+    def loop_depth(self, statements, seen=()):
+        # Deepest loop nesting the statements reach, through the methods they call
+        depth = 0
+        for stmt in statements:
+            if isinstance(stmt, WhileStatement):
+                depth = max(depth, 1 + self.loop_depth(stmt.body, seen))
+            elif isinstance(stmt, IfStatement):
+                depth = max(depth, self.loop_depth(stmt.body, seen), self.loop_depth(stmt.else_body, seen))
+            elif isinstance(stmt, FunctionCall) and stmt.name in self.methods:
+                # A recursive cycle could nest arbitrarily deep
+                if stmt.name in seen:
+                    return len(self.HOIST_REGISTERS) // 2
+                depth = max(depth, self.loop_depth(self.methods[stmt.name].body, seen + (stmt.name,)))
+        return depth
+
+    def calls(self, statements):
+        # FunctionCall nodes anywhere in the statements
+        found = []
+        for stmt in statements:
+            if isinstance(stmt, FunctionCall):
+                found.append(stmt)
+            elif isinstance(stmt, IfStatement):
+                found += self.calls(stmt.body) + self.calls(stmt.else_body)
+            elif isinstance(stmt, WhileStatement):
+                found += self.calls(stmt.body)
+        return found
+
+    def is_recursive(self, name):
+        # The AST is immutable, so each method is only walked once
+        if name not in self.recursive:
+            self.recursive[name] = self.reaches(name, name)
+        return self.recursive[name]
+
+    def reachable(self, start):
+        # Methods a call to start may run, start included
+        seen = {start}
+        pending = list(self.called_names(self.methods[start].body))
+        while pending:
+            callee = pending.pop()
+            if callee in seen or callee not in self.methods:
+                continue
+            seen.add(callee)
+            pending.extend(self.called_names(self.methods[callee].body))
+        return seen
+
+    def reaches(self, start, name):
+        seen = set()
+        pending = list(self.called_names(self.methods[start].body))
+        while pending:
+            callee = pending.pop()
+            if callee == name:
+                return True
+            if callee in seen or callee not in self.methods:
+                continue
+            seen.add(callee)
+            pending.extend(self.called_names(self.methods[callee].body))
+        return False
+
+    def called_names(self, statements):
+        names = []
+        for stmt in statements:
+            if isinstance(stmt, FunctionCall):
+                names.append(stmt.name)
+            elif isinstance(stmt, IfStatement):
+                names += self.called_names(stmt.body) + self.called_names(stmt.else_body)
+            elif isinstance(stmt, WhileStatement):
+                names += self.called_names(stmt.body)
+        return names
 
     def generate_expression(self, expr):
         operator, left, right = expr
-        if left in self.memory_map:
-            self.code.append(f"ldi r2 {self.memory_map[left]}")
-            self.code.append(f"lod r2 r3 0")
-        else:
-            self.code.append(f"ldi r3 {left}")
+        self.load_operand(left, "r3")
         if operator == "+":
             self.code.append(f"adi r3 {right}")
         elif operator == "-":
             adjusted = 255 - right + 1
             self.code.append(f"adi r3 {adjusted}")
-        self.code.append("mov r1 r3")
+        self.code.append("mov r3 r1")
 
-    def generate_condition(self, operator, left, right):
-        if left in self.memory_map:
-            self.code.append(f"ldi r2 {self.memory_map[left]}")
-            self.code.append(f"lod r2 r3 0")
+    def load_operand(self, operand, reg, address_reg="r2"):
+        if operand in self.memory_map:
+            reach = self.layout.access(self.memory_map[operand])
+            if reach:
+                self.code.append(f"lod {reach[0]} {reg} {reach[1]}")
+            else:
+                self.code.append(f"ldi {address_reg} {self.memory_map[operand]}")
+                self.code.append(f"lod {address_reg} {reg} 0")
         else:
-            self.code.append(f"ldi r3 {left}")
-        if isinstance(right, int):
-            self.code.append(f"ldi r4 {right}")
-        elif right in self.memory_map:
-            self.code.append(f"ldi r2 {self.memory_map[right]}")
-            self.code.append(f"lod r2 r4 0")
-        self.code.append("cmp r3 r4")
+            self.code.append(f"ldi {reg} {operand}")
+
+    def generate_condition(self, operator, left, right, left_reg=None, right_reg=None):
+        if left_reg is None:
+            left_reg = "r3"
+            self.load_operand(left, left_reg)
+        if right_reg is None:
+            # Comparing against zero needs no load, and lets the flags of the
+            # instruction that produced the left operand stand in for the cmp
+            right_reg = "r0" if right == 0 else "r4"
+            if right_reg != "r0":
+                self.load_operand(right, right_reg)
+        if self.CONDITIONS[operator][1]:
+            left_reg, right_reg = right_reg, left_reg
+        self.code.append(f"cmp {left_reg} {right_reg}")
+
+    def branch_condition(self, operator):
+        return self.CONDITIONS[operator][0]
 
     def invert_condition(self, operator):
-        return {
-            "==": "ne",
-            "!=": "eq",
-            ">": "le",
-            "<": "ge",
-            ">=": "lt",
-            "<=": "gt"
-        }[operator]
+        return self.INVERTED_CONDITIONS[self.branch_condition(operator)]
 
     def get_new_label(self, base):
-        label = f".{base}_{self.label_count}"
+        # Per-method numbering keeps the labels of one method independent of the others
+        label = f".{self.method_name}_{base}_{self.label_count}"
         self.label_count += 1
         return label
@@ -0,0 +1,108 @@
+from compiler.parser import VariableDeclaration, IfStatement, WhileStatement, FunctionCall
+
+# "left OP right" on the 8-bit values in RAM; the right operand is a number
+COMPARISONS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    ">=": lambda a, b: a >= b,
+    ">": lambda a, b: a > b,
+    "<=": lambda a, b: a <= b,
+}
+
+class Unknown(Exception):
+    # The evaluation read something not known at compile time, or gave up
+    pass
+
+class Evaluator:
+    # Runs calls at compile time. Nothing in the language reaches a port, so a
+    # call is pure and its effect is the variables it assigns; when everything
+    # it reads is known at the call site, those values can be loaded directly
+    # instead. Values wrap at 8 bits like the generated code.
+    MAX_STEPS = 4096  # statements one evaluation may run; loops may not terminate
+    MAX_DEPTH = 16    # nested calls, as deep as the hardware call stack goes
+
+    def __init__(self, methods):
+        self.methods = methods  # name -> Method
+        self.steps = 0
+        self.depth = 0
+
+    def call(self, name, arguments, known):
+        # {variable: value} a call assigns, parameters included, in the order
+        # they are first assigned; None when it cannot be evaluated. known:
+        # variable -> value at the call site.
+        self.steps = 0
+        self.depth = 0
+        values = dict(known)
+        assigned = {}
+        try:
+            self.run_call(name, arguments, values, assigned)
+        except Unknown:
+            return None
+        return {variable: values[variable] for variable in assigned}
+
+    def value(self, expression, known):
+        # Value of an expression, or None when an operand is not known
+        try:
+            return self.evaluate(expression, known)
+        except Unknown:
+            return None
+
+    def evaluate(self, expression, values):
+        if isinstance(expression, int):
+            if not -128 <= expression <= 255:
+                raise Unknown()  # no LDI can load it
+            return expression & 255
+        if isinstance(expression, str):
+            if expression not in values:
+                raise Unknown()
+            return values[expression]
+        operator, left, right = expression
+        if operator not in "+-":
+            raise Unknown()
+        left, right = self.evaluate(left, values), self.evaluate(right, values)
+        return (left + right if operator == "+" else left - right) & 255
+
+    def run_call(self, name, arguments, values, assigned):
+        method = self.methods.get(name)
+        if method is None:
+            raise Unknown()
+        if self.depth == self.MAX_DEPTH:
+            raise Unknown()
+        arguments = [self.evaluate(argument, values) for argument in arguments]
+        for (param_type, param_name), argument in zip(method.parameters, arguments):
+            self.assign(param_name, argument, values, assigned)
+        self.depth += 1
+        try:
+            self.run(method.body, values, assigned)
+        finally:
+            self.depth -= 1
+
+    def run(self, statements, values, assigned):
+        for stmt in statements:
+            self.steps += 1
+            if self.steps > self.MAX_STEPS:
+                raise Unknown()
+            if isinstance(stmt, VariableDeclaration):
+                self.assign(stmt.name, self.evaluate(stmt.value, values), values, assigned)
+            elif isinstance(stmt, IfStatement):
+                taken = stmt.body if self.test(stmt.condition, values) else stmt.else_body
+                self.run(taken, values, assigned)
+            elif isinstance(stmt, WhileStatement):
+                while self.test(stmt.condition, values):
+                    self.run(stmt.body, values, assigned)
+                    self.steps += 1
+                    if self.steps > self.MAX_STEPS:
+                        raise Unknown()
+            elif isinstance(stmt, FunctionCall):
+                self.run_call(stmt.name, stmt.arguments, values, assigned)
+            else:
+                raise Unknown()  # e.g. return, which nothing generates yet
+
+    def test(self, condition, values):
+        operator, left, right = condition
+        return COMPARISONS[operator](self.evaluate(left, values), self.evaluate(right, values))
+
+    def assign(self, name, value, values, assigned):
+        values[name] = value
+        assigned.setdefault(name, value)
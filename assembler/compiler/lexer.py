@@ -1,7 +1,8 @@
-import re
+from scanner import Scanner
 
+# int, string and bool lex as DATATYPE, void and the other reserved words as KEYWORD
 TOKEN_SPECIFICATION = [
-    ('KEYWORD', r'\b(?:int|string|void|if|else|while|for|return|bool|class|namespace|public|private|static|new|using)\b'),
+    ('KEYWORD', r'\b(?:void|if|else|while|for|return|class|namespace|public|private|static|new|using)\b'),
     ('DATATYPE', r'\b(?:int|string|bool)\b'),
     ('IDENTIFIER', r'[a-zA-Z_][a-zA-Z0-9_]*'),
     ('NUMBER', r'\d+(\.\d+)?'),
@@ -15,28 +16,26 @@ TOKEN_SPECIFICATION = [
     ('COLON', r':'),
     ('DOT', r'\.'),
     ('ARROW', r'=>'),
+    ('COMMENT', r'//.*'),
+    ('MULTILINE_COMMENT', r'/\*[\s\S]*?\*/'),
     ('OPERATOR', r'[+\-*/%]'),
-    ('COMPARISON', r'[<>!=]=?|==|>=|<='),
+    ('COMPARISON', r'==|!=|<=|>=|<|>'),
     ('LOGICAL', r'&&|\|\|'),
     ('ASSIGN', r'='),
-    ('COMMENT', r'//.*'),
-    ('MULTILINE_COMMENT', r'/\*.*?\*/'),
-    ('SKIP', r'[ \t]+'),
+    ('SKIP', r'[ \t\r]+'),
     ('NEWLINE', r'\n'),
 ]
 
-TOKEN_REGEX = '|'.join(f'(?P<{pair[0]}>{pair[1]})' for pair in TOKEN_SPECIFICATION)
+SCANNER = Scanner(
+    TOKEN_SPECIFICATION,
+    skip={'NEWLINE', 'SKIP', 'COMMENT', 'MULTILINE_COMMENT'},
+    convert={
+        'NUMBER': lambda text: int(text) if '.' not in text else float(text),
+        'STRING': lambda text: text[1:-1],
+    },
+    intern={'KEYWORD', 'DATATYPE', 'IDENTIFIER'},
+)
 
 def tokenize(code):
-    tokens = []
-    for match in re.finditer(TOKEN_REGEX, code):
-        kind = match.lastgroup
-        value = match.group()
-        if kind in {'NEWLINE', 'SKIP', 'COMMENT', 'MULTILINE_COMMENT'}:
-            continue
-        elif kind == 'NUMBER':
-            value = int(value) if '.' not in value else float(value)
-        elif kind == 'STRING':
-            value = value[1:-1]
-        tokens.append((kind, value))
-    return tokens
+    # Tokens are produced lazily as the parser consumes them
+    return SCANNER.tokens(code)
@@ -1,91 +1,91 @@
-class Program:
-    def __init__(self):
-        self.namespaces = []
-
-class Namespace:
-    def __init__(self, name):
-        self.name = name
-        self.classes = []
-
-class Class:
-    def __init__(self, name):
-        self.name = name
-        self.methods = []
-
-class Method:
-    def __init__(self, name, return_type, is_static=False):
-        self.name = name
-        self.return_type = return_type
-        self.is_static = is_static
-        self.parameters = []
-        self.body = []
-
-class VariableDeclaration:
-    def __init__(self, var_type, name, value):
-        self.var_type = var_type
-        self.name = name
-        self.value = value
-
-class IfStatement:
-    def __init__(self, condition, body):
-        self.condition = condition
-        self.body = body
+from nodes import Node
+from scanner import TokenStream, error_at
+
+class Program(Node):
+    __slots__ = ('namespaces',)
+
+    def __init__(self, namespaces=()):
+        super().__init__(tuple(namespaces))
+
+class Namespace(Node):
+    __slots__ = ('name', 'classes')
+
+    def __init__(self, name, classes=()):
+        super().__init__(name, tuple(classes))
+
+class Class(Node):
+    __slots__ = ('name', 'methods')
+
+    def __init__(self, name, methods=()):
+        super().__init__(name, tuple(methods))
+
+class Method(Node):
+    __slots__ = ('name', 'return_type', 'is_static', 'parameters', 'body')
+
+    def __init__(self, name, return_type, is_static=False, parameters=(), body=()):
+        super().__init__(name, return_type, is_static, tuple(parameters), tuple(body))
+
+class VariableDeclaration(Node):
+    __slots__ = ('var_type', 'name', 'value')
+
+class IfStatement(Node):
+    __slots__ = ('condition', 'body', 'else_body')
+
+    def __init__(self, condition, body, else_body=()):
+        super().__init__(condition, tuple(body), tuple(else_body))
+
+class WhileStatement(Node):
+    __slots__ = ('condition', 'body')
 
-class WhileStatement:
     def __init__(self, condition, body):
-        self.condition = condition
-        self.body = body
+        super().__init__(condition, tuple(body))
+
+class FunctionCall(Node):
+    __slots__ = ('name', 'arguments')
 
-class FunctionCall:
     def __init__(self, name, arguments):
-        self.name = name
-        self.arguments = arguments
+        super().__init__(name, tuple(arguments))
 
-class ReturnStatement:
-    def __init__(self, value):
-        self.value = value
+class ReturnStatement(Node):
+    __slots__ = ('value',)
 
 class Parser:
     def __init__(self, tokens):
-        self.tokens = tokens
-        self.current = 0
+        # tokens: any iterable of scanner.Token, pulled as the parser advances
+        self.tokens = TokenStream(tokens)
 
     def parse(self):
-        program = Program()
+        # Top-level methods all go into a Global class in a Global namespace
+        methods = []
         while not self.is_at_end():
-            if self.check("KEYWORD"):
-                namespace = Namespace("Global")
-                if not program.namespaces or program.namespaces[-1].name != "Global":
-                    program.namespaces.append(namespace)
-                self.parse_global_declaration(namespace)
+            if self.check("KEYWORD") or self.check("DATATYPE"):
+                methods.append(self.parse_global_declaration())
             else:
-                raise SyntaxError(f"Unknown top-level token: {self.peek()}")
-        return program
+                raise error_at("Expected a method declaration", self.peek())
+        if not methods:
+            return Program()
+        return Program([Namespace("Global", [Class("Global", methods)])])
 
-    def parse_global_declaration(self, namespace):
-        return_type = self.consume("KEYWORD")[1]
+    def parse_global_declaration(self):
+        return_type = self.consume("KEYWORD", "void")[1] if self.check("KEYWORD", "void") else self.consume("DATATYPE")[1]
         name = self.consume("IDENTIFIER")[1]
         self.consume("LPAREN")
         parameters = []
         while not self.check("RPAREN"):
-            param_type = self.consume("KEYWORD")[1]
+            param_type = self.consume("DATATYPE")[1]
             param_name = self.consume("IDENTIFIER")[1]
             parameters.append((param_type, param_name))
             if self.check("COMMA"):
                 self.consume("COMMA")
         self.consume("RPAREN")
         self.consume("LBRACE")
-        method = Method(name, return_type)
-        method.parameters = parameters
-        klass = Class("Global")
-        klass.methods.append(method)
-        if not namespace.classes:
-            namespace.classes.append(klass)
+        body = []
         while not self.check("RBRACE"):
             stmt = self.parse_statement()
             if stmt:
-                method.body.append(stmt)
+                body.append(stmt)
         self.consume("RBRACE")
+        return Method(name, return_type, parameters=parameters, body=body)
 
     def parse_statement(self):
         if self.check("KEYWORD", "if"):
@@ -94,25 +94,25 @@ class Parser:
             return self.parse_while_statement()
         elif self.check("KEYWORD", "return"):
             return self.parse_return_statement()
-        elif self.check("KEYWORD"):
+        elif self.check("DATATYPE"):
             return self.parse_variable_declaration()
         elif self.check("IDENTIFIER") and self.check_next("LPAREN"):
             return self.parse_function_call()
-        elif self.check("IDENTIFIER") and self.check_next("COMPARISON", "="):
+        elif self.check("IDENTIFIER") and self.check_next("ASSIGN"):
             return self.parse_assignment()
-        raise SyntaxError(f"Unknown statement: {self.peek()}")
+        raise error_at("Expected a statement", self.peek())
 
     def parse_variable_declaration(self):
-        var_type = self.consume("KEYWORD")[1]
+        var_type = self.consume("DATATYPE")[1]
         name = self.consume("IDENTIFIER")[1]
-        self.consume("COMPARISON", "=")
+        self.consume("ASSIGN")
         value = self.consume_expression()
         self.consume("SEMICOLON")
         return VariableDeclaration(var_type, name, value)
 
     def parse_assignment(self):
         name = self.consume("IDENTIFIER")[1]
-        self.consume("COMPARISON", "=")
+        self.consume("ASSIGN")
         value = self.consume_expression()
         self.consume("SEMICOLON")
         return VariableDeclaration(None, name, value)
@@ -133,7 +133,17 @@ class Parser:
         while not self.check("RBRACE"):
             body.append(self.parse_statement())
         self.consume("RBRACE")
-        return IfStatement(condition, body)
+        else_body = []
+        if self.check("KEYWORD", "else"):
+            self.consume("KEYWORD", "else")
+            if self.check("KEYWORD", "if"):
+                else_body.append(self.parse_if_statement())
+            else:
+                self.consume("LBRACE")
+                while not self.check("RBRACE"):
+                    else_body.append(self.parse_statement())
+                self.consume("RBRACE")
+        return IfStatement(condition, body, else_body)
 
     def parse_while_statement(self):
         self.consume("KEYWORD", "while")
@@ -175,27 +185,24 @@ class Parser:
 
     def consume(self, token_type, value=None):
         if self.check(token_type, value):
-            self.current += 1
-            return self.previous()
-        raise SyntaxError(f"Expected {token_type} {value}, found {self.peek()}")
+            return self.tokens.advance()
+        raise error_at(f"Expected {token_type} {value}" if value is not None else f"Expected {token_type}", self.peek())
 
     def check(self, token_type, value=None):
-        if self.is_at_end():
-            return False
-        token = self.peek()
-        return token[0] == token_type and (value is None or token[1] == value)
+        return self.matches(self.peek(), token_type, value)
 
     def check_next(self, token_type, value=None):
-        if self.is_at_end() or self.current + 1 >= len(self.tokens):
-            return False
-        next_token = self.tokens[self.current + 1]
-        return next_token[0] == token_type and (value is None or next_token[1] == value)
+        return self.matches(self.tokens.peek(1), token_type, value)
+
+    @staticmethod
+    def matches(token, token_type, value):
+        return token is not None and token.kind == token_type and (value is None or token.value == value)
 
     def peek(self):
-        return self.tokens[self.current]
+        return self.tokens.peek()
 
     def previous(self):
-        return self.tokens[self.current - 1]
+        return self.tokens.previous
 
     def is_at_end(self):
-        return self.current >= len(self.tokens)
+        return self.tokens.at_end()
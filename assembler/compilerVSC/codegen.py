@@ -1,15 +1,99 @@
+import memory_layout
+from codecache import CodeCache, source_digest
+from memory_layout import DataLayout
+from nodes import fingerprint, strings
+from . import evaluator
+from .evaluator import Evaluator
 from .parser import Program, Namespace, Class, Method, VariableDeclaration, FunctionCall
 
+# Part of every cache key, so cached code never outlives the generator that wrote it
+SOURCE_DIGEST = source_digest(__file__, memory_layout.__file__, evaluator.__file__)
+
+# `display.print_str()` prints the string declared last before it in the same method,
+# whether or not the methods it calls are inlined. The call goes to
+# the shared PRINT_STR routine; the Display class in display.vsc is a placeholder.
+PRINT_CALL = "display_print_str"
+STRING_END = 255  # ends a string in RAM; no character has this code
+
+# Variables live in a home register and every assignment is also stored to RAM,
+# so a register a call overwrites can always be reloaded. Operator -> (runtime
+# helper, register holding its result); operands go in r1 and r2.
+HELPER_OPERATORS = {'*': ("MUL", "r3"), '/': ("DIV", "r3"), '%': ("MOD", "r4")}
+# Registers each runtime helper writes
+HELPER_CLOBBERS = {
+    "MUL": {"r1", "r2", "r3"},
+    "DIV": {"r1", "r3", "r4"},
+    "MOD": {"r1", "r4"},
+    "PRINT_STR": {"r1", "r14", "r15"},
+}
+OPERAND_REGISTERS = {"r1", "r2"}
+SCRATCH_REGISTERS = {"r14", "r15"}  # address and literal scratch, never a home
+# Registers that any helper call can overwrite; variables read after one prefer others
+CALL_CLOBBERED = OPERAND_REGISTERS.union(*HELPER_CLOBBERS.values()) - SCRATCH_REGISTERS
+
+def display_codes(text: str) -> list:
+    # Character display codes of a string literal, in the assembler's CHARACTERS order
+    codes = []
+    for ch in text.upper():
+        if ch == ' ':
+            codes.append(0)
+        elif 'A' <= ch <= 'Z':
+            codes.append(ord(ch) - 64)
+        elif ch == '.':
+            codes.append(27)
+        elif ch == '!':
+            codes.append(28)
+        elif ch == '?':
+            codes.append(29)
+        else:
+            raise ValueError(f"Unsupported char: {ch}")
+    return codes
+
 class CodeGenerator:
-    def __init__(self):
+    INLINE_MAX_SIZE = 8        # bodies up to this many instructions are always inlined
+    INLINE_HOT_CALLS = 16      # with a profile, calls that ran this often...
+    INLINE_HOT_SIZE = 32       # ...are inlined up to this many instructions
+
+    def __init__(self, profile: dict = None, instrument: bool = False, cache: CodeCache = None):
         self.code = []
+        self.profile = profile     # AST node -> times it ran in an emulator run, or None
+        self.markers = {} if instrument else None  # marker label -> AST node
+        # Profiles and markers key on AST nodes, which a cache cannot; such builds skip it
+        self.cache = cache if profile is None and not instrument else None
+        self.measuring = 0
         self.register_map = {}     # var name -> register
-        self.mem_map = {}          # var name -> memory address
-        self.next_reg = 1          # r0 is reserved
-        self.next_mem = 0          # RAM address allocation
+        self.layout = DataLayout()
+        self.mem_map = self.layout.addresses  # var name -> memory address
+        self.methods = {}          # lowercase label -> Method
+        self.call_sites = {}       # lowercase label -> number of calls
+        self.inline_stack = []
+        self.callees = {}          # lowercase label -> lowercase labels it calls
+        self.recursive = {}        # lowercase label -> whether it can reach itself
+        self.helpers_used = set()  # runtime helpers referenced by generated code
+        self.strings = {}          # interned literal name -> display codes
+        self.current_string = None # literal name of the string declared last, for print_str
+        self.declared = set()      # names of number variables
+        self.live = set()          # variables read after the statement being generated
+        self.entry_live = {}       # lowercase label -> variables it reads before assigning them
+        self.assigns = {}          # lowercase label -> variables every call assigns
+        self.clobber_sets = {}     # lowercase label -> registers a call may overwrite
+        self.known = {}            # variable -> value it is known to have here
+        self.evaluator = Evaluator(self.methods, lambda call: self.call_label(call).lower(), [PRINT_CALL])
+        # Statement node type -> generator
+        self.statement_generators = {
+            FunctionCall: self.generate_call,
+            VariableDeclaration: self.generate_variable_declaration,
+        }
 
     def generate(self, ast: Program) -> str:
-        # Entry point: call Main_main
+        self.collect_methods(ast)
+        self.plan_data_layout()
+        self.plan_registers(ast)
+
+        # Entry point: set up pinned base registers and the string literals, then call Main_main
+        for reg, base in self.layout.pinned_registers():
+            self.code.append(f"LDI {reg} {base}")
+        self.emit_strings()
         self.code.append("CAL .Main_main")
         self.code.append("HLT")
 
@@ -17,62 +101,341 @@ class CodeGenerator:
         for ns in ast.namespaces:
             for cls in ns.classes:
                 for m in cls.methods:
-                    label = f".{cls.name}_{m.name}"
-                    self.code.append(label)
-                    for stmt in m.body:
-                        self.generate_statement(stmt)
-                    self.code.append("RET")
+                    self.generate_method(f"{cls.name}_{m.name}", m)
 
-        # Emit helper routines for mul, div, mod
+        # Emit the helper routines for mul, div, mod and printing that are actually called
         self.emit_helpers()
         return "\n".join(self.code)
 
-    def generate_statement(self, stmt):
+    def collect_methods(self, ast: Program):
+        # Labels are case-insensitive in the assembler, so `math.add()` calls `.Math_add`
+        for ns in ast.namespaces:
+            for cls in ns.classes:
+                for m in cls.methods:
+                    self.methods[f"{cls.name}_{m.name}".lower()] = m
+        for label, m in self.methods.items():
+            self.callees[label] = [self.call_label(stmt).lower() for stmt in m.body if isinstance(stmt, FunctionCall)]
+            for key in self.callees[label]:
+                self.call_sites[key] = self.call_sites.get(key, 0) + 1
+
+    def plan_data_layout(self):
+        # Hot variables go where a single LOD/STR reaches them; strings are buffers.
+        # A profile weights each access by how often its statement ran.
+        counts, buffers = {}, {}
+        for m in self.methods.values():
+            for stmt in m.body:
+                if isinstance(stmt, FunctionCall):
+                    continue
+                weight = 1 if self.profile is None else self.executions(stmt)
+                if stmt.var_type == "string":
+                    # One region per distinct literal, shared by every declaration of it
+                    name = self.literal(stmt.value)
+                    self.strings[name] = display_codes(stmt.value)
+                    buffers[name] = len(self.strings[name]) + 1
+                    continue
+                operands = [stmt.name] + (list(stmt.value[1:]) if isinstance(stmt.value, tuple) else [stmt.value])
+                for operand in operands:
+                    if isinstance(operand, str):
+                        counts[operand] = counts.get(operand, 0) + weight
+        if self.cache is None:
+            self.layout.plan(counts, buffers)
+        else:
+            self.layout.plan(counts, buffers, self.cache.layout)
+            self.cache.layout = self.layout.assignments()
+
+    def plan_registers(self, ast: Program):
+        # Every declared number gets its register up front, in declaration order,
+        # so a method's code does not depend on which methods were generated first.
+        # With a cache, names keep the register they had in the previous build.
+        # Variables read after a call get a register the helpers leave alone, if one is free.
+        declared = []
+        for ns in ast.namespaces:
+            for cls in ns.classes:
+                for m in cls.methods:
+                    for stmt in m.body:
+                        if isinstance(stmt, VariableDeclaration) and stmt.var_type != "string" and stmt.name not in declared:
+                            declared.append(stmt.name)
+        self.declared = set(declared)
+        crossing = self.live_across_calls()
+        previous = self.cache.registers if self.cache is not None else {}
+        for name in declared:
+            if name in previous and previous[name] not in self.register_map.values():
+                self.register_map[name] = previous[name]
+        for name in sorted(declared, key=lambda name: name not in crossing):
+            self.alloc_reg(name, CALL_CLOBBERED if name in crossing else ())
+        if self.cache is not None:
+            self.cache.registers = dict(self.register_map)
+
+    def generate_method(self, label: str, method: Method):
+        key = self.method_key(label) if self.cache is not None else None
+        cached = key and self.cache.get(label, key)
+        if cached:
+            self.code.extend(cached['code'])
+            self.helpers_used.update(cached['helpers'])
+            return
+        start, helpers = len(self.code), self.helpers_used
+        self.helpers_used = set()
+        self.current_string = None
+        self.known = {}
+        self.code.append(f".{label}")
+        body = method.body
+        # A call in tail position becomes a jump; the callee's RET returns for us
+        last = body[-1] if body and isinstance(body[-1], FunctionCall) else None
+        prints = last is not None and self.call_label(last).lower() == PRINT_CALL
+        tail = last if prints or (last and not self.should_inline(last)) else None
+        # Before a tail call, whatever the callee reads must be in its register
+        self.generate_body(body[:-1] if tail else body,
+                           self.uses(self.call_label(tail).lower()) if tail and not prints else set())
+        if tail:
+            self.mark(tail)
+        if prints:
+            self.generate_print(tail=True)
+        elif tail and not self.evaluate_call(tail):
+            self.code.append(f"JMP .{self.call_label(tail)}")
+        else:
+            self.code.append("RET")
+        if key:
+            self.cache.put(label, key, self.code[start:], self.helpers_used)
+        self.helpers_used |= helpers
+
+    def method_key(self, label: str) -> str:
+        # Everything the method's code depends on: its AST and those of the methods
+        # it reaches, their call counts and where the names they use live
+        closure = [label.lower()]
+        for key in closure:
+            closure += [callee for callee in self.callees[key] if callee in self.methods and callee not in closure]
+        trees = [(fingerprint(self.methods[key]), self.call_sites.get(key, 0)) for key in sorted(closure)]
+        names = set().union(*(strings(self.methods[key]) for key in closure))
+        names |= {self.literal(stmt.value) for key in closure for stmt in self.methods[key].body
+                  if isinstance(stmt, VariableDeclaration) and stmt.var_type == "string"}
+        places = sorted((name, self.mem_map.get(name), self.register_map.get(name)) for name in names)
+        return self.cache.key(SOURCE_DIGEST, label, trees, places)
+
+    def literal(self, text: str) -> str:
+        # Layout name of an interned literal; quotes keep it apart from variable names
+        return f'"{text.upper()}"'
+
+    def call_label(self, call: FunctionCall) -> str:
+        return call.name.replace('.', '_')  # Convert dot to underscore
+
+    def should_inline(self, call: FunctionCall) -> bool:
+        # Inlining saves the CAL/RET pair and a hardware stack slot. Small bodies
+        # always pay off; a single call site never duplicates code. Calls the
+        # profile shows are hot may grow the code a little more.
+        key = self.call_label(call).lower()
+        if key not in self.methods or key in self.inline_stack or self.is_recursive(key):
+            return False
+        if self.call_sites.get(key, 0) == 1:
+            return True
+        size = self.method_size(key)
+        if size <= self.INLINE_MAX_SIZE:
+            return True
+        return self.executions(call) >= self.INLINE_HOT_CALLS and size <= self.INLINE_HOT_SIZE
+
+    def executions(self, node) -> int:
+        # Times the node ran in the profiling run, 0 without a profile
+        return self.profile.get(node, 0) if self.profile is not None else 0
+
+    def method_size(self, key: str) -> int:
+        code, current_string, live, known = self.code, self.current_string, self.live, dict(self.known)
+        self.code, self.current_string = [], None
+        self.measuring += 1
+        self.inline_stack.append(key)
+        self.generate_body(self.methods[key].body, set())
+        self.inline_stack.pop()
+        self.measuring -= 1
+        size = len([line for line in self.code if not line.startswith(".")])
+        self.code, self.current_string, self.live, self.known = code, current_string, live, known
+        return size
+
+    # Liveness and clobber sets. Method bodies are straight-line code, so one
+    # backward pass per body gives what is read after each statement; a call
+    # reads what its callee reads before assigning it and kills what it always
+    # assigns. Recursive cycles are assumed to read everything and assign nothing.
+
+    def generate_body(self, statements, live_out: set):
+        # Each statement is generated knowing which variables are read after it
+        for stmt, live in zip(statements, self.liveness(statements, live_out)):
+            self.live = live
+            self.generate_statement(stmt)
+
+    def liveness(self, statements, live_out: set) -> list:
+        # Variables read after each statement, from their home registers
+        after = []
+        live = set(live_out)
+        for stmt in reversed(statements):
+            after.append(live)
+            live = self.live_before(stmt, live)
+        return after[::-1]
+
+    def live_before(self, stmt, live: set) -> set:
         if isinstance(stmt, FunctionCall):
-            label = stmt.name.replace('.', '_')  # Convert dot to underscore
-            self.code.append(f"CAL .{label}")
+            key = self.call_label(stmt).lower()
+            if key == PRINT_CALL or key not in self.methods:
+                return live
+            return (live - self.defines(key)) | self.uses(key)
+        if stmt.var_type == "string":
+            return live
+        # Only + and - read registers; the other operators and copies load from RAM
+        reads = set(stmt.value[1:]) if isinstance(stmt.value, tuple) and stmt.value[0] in "+-" else set()
+        return (live - {stmt.name}) | {name for name in reads if isinstance(name, str)}
+
+    def uses(self, key: str) -> set:
+        if key not in self.entry_live:
+            self.entry_live[key] = set(self.declared)
+            live = set()
+            for stmt in reversed(self.methods[key].body):
+                live = self.live_before(stmt, live)
+            self.entry_live[key] = live
+        return self.entry_live[key]
+
+    def defines(self, key: str) -> set:
+        if key not in self.assigns:
+            self.assigns[key] = set()
+            names = set()
+            for stmt in self.methods[key].body:
+                if isinstance(stmt, FunctionCall):
+                    callee = self.call_label(stmt).lower()
+                    names |= self.defines(callee) if callee in self.methods else set()
+                elif stmt.var_type != "string":
+                    names.add(stmt.name)
+            self.assigns[key] = names
+        return self.assigns[key]
+
+    def clobbers(self, key: str) -> set:
+        # Registers a call may overwrite, other than the homes of the variables it assigns
+        if key == PRINT_CALL:
+            return {"r14"} | HELPER_CLOBBERS["PRINT_STR"]
+        if key not in self.clobber_sets:
+            self.clobber_sets[key] = set(SCRATCH_REGISTERS)
+            registers = set(SCRATCH_REGISTERS)
+            for stmt in self.methods[key].body:
+                if isinstance(stmt, FunctionCall):
+                    callee = self.call_label(stmt).lower()
+                    registers |= self.clobbers(callee) if callee in self.methods or callee == PRINT_CALL else set()
+                elif isinstance(stmt.value, tuple) and stmt.value[0] in HELPER_OPERATORS:
+                    registers |= OPERAND_REGISTERS | HELPER_CLOBBERS[HELPER_OPERATORS[stmt.value[0]][0]]
+            self.clobber_sets[key] = registers
+        return self.clobber_sets[key]
+
+    def live_across_calls(self) -> set:
+        # Variables still read after some call or helper operator
+        crossing = set()
+        for m in self.methods.values():
+            for stmt, live in zip(m.body, self.liveness(m.body, set())):
+                if isinstance(stmt, FunctionCall):
+                    crossing |= live
+                elif stmt.var_type != "string" and isinstance(stmt.value, tuple) and stmt.value[0] in HELPER_OPERATORS:
+                    crossing |= live - {stmt.name}
+        return crossing
+
+    def restore(self, clobbered: set, assigned: str = None):
+        # Reload from RAM the variables still to be read whose home was overwritten
+        for name in sorted(self.live):
+            home = self.register_map.get(name)
+            if home in clobbered and name != assigned:
+                self.load_operand(name, int(home[1:]))
+
+    def is_recursive(self, key: str) -> bool:
+        # The AST is immutable, so each method is only walked once
+        if key not in self.recursive:
+            self.recursive[key] = self.reaches(key, key)
+        return self.recursive[key]
+
+    def reaches(self, start: str, target: str) -> bool:
+        seen = set()
+        pending = [start]
+        while pending:
+            for callee in self.callees[pending.pop()]:
+                if callee == target:
+                    return True
+                if callee in self.methods and callee not in seen:
+                    seen.add(callee)
+                    pending.append(callee)
+        return False
+
+    def mark(self, node):
+        # Profiling build: the pc of this label tells how often the node ran
+        if self.markers is not None and not self.measuring:
+            label = f".profile_{len(self.markers)}"
+            self.markers[label] = node
+            self.code.append(label)
+
+    def generate_statement(self, stmt):
+        self.mark(stmt)
+        generator = self.statement_generators.get(type(stmt))
+        if generator is None:
+            raise NotImplementedError(f"Unknown statement type: {stmt.kind}")
+        generator(stmt)
+
+    def generate_call(self, stmt: FunctionCall):
+        if self.call_label(stmt).lower() == PRINT_CALL:
+            self.generate_print()
+        elif self.evaluate_call(stmt):
+            pass
+        elif self.should_inline(stmt):
+            key = self.call_label(stmt).lower()
+            # The callee's strings are its own, as they are when it is called
+            live, current_string = self.live, self.current_string
+            self.current_string = None
+            self.inline_stack.append(key)
+            self.generate_body(self.methods[key].body, live)
+            self.inline_stack.pop()
+            self.live, self.current_string = live, current_string
+        else:
+            self.code.append(f"CAL .{self.call_label(stmt)}")
+            key = self.call_label(stmt).lower()
+            if key in self.methods:
+                self.restore(self.clobbers(key))
+                for name in self.defines(key):
+                    self.known.pop(name, None)
+
+    def evaluate_call(self, stmt: FunctionCall) -> bool:
+        # A pure call that only reads values known here runs at compile time;
+        # each variable it assigns gets its final value, unless it already has it
+        results = self.evaluator.call(self.call_label(stmt).lower(), self.known)
+        if results is None:
+            return False
+        for name, value in results.items():
+            if self.known.get(name) != value:
+                dst = self.alloc_reg(name)
+                self.code.append(f"LDI {dst} {value}")
+                self.store(name, dst)
+        self.known.update(results)
+        return True
+
+    def generate_print(self, tail: bool = False):
+        # r14 points at the string for PRINT_STR; in tail position its RET returns for us
+        if self.current_string is None:
+            raise ValueError("display.print_str() needs a string declared before it in the same method")
+        self.code.append(f"LDI r14 {self.mem_map[self.current_string]}")
+        self.helpers_used.add("PRINT_STR")
+        if tail:
+            self.code.append("JMP .PRINT_STR")
             return
+        self.code.append("CAL .PRINT_STR")
+        self.restore(self.clobbers(PRINT_CALL))
 
+    def generate_variable_declaration(self, stmt: VariableDeclaration):
         if stmt.var_type == "string":
-            def to_display_code(ch):
-                if ch == ' ':
-                    return 0
-                elif 'A' <= ch <= 'Z':
-                    return ord(ch) - 64
-                elif ch == '.':
-                    return 27
-                elif ch == '!':
-                    return 28
-                elif ch == '?':
-                    return 29
-                else:
-                    raise ValueError(f"Unsupported char: {ch}")
-
-            addr = self.alloc_mem(stmt.name)
-            self.code.append(f"LDI r14 {addr}")  # Load base address into r14
-            for i, ch in enumerate(stmt.value.upper()):  # uppercase for screen codes
-                code = to_display_code(ch)
-                self.code.append(f"LDI r1 {code}")
-                self.code.append(f"STR r14 r1 {i}")
-            self.code.append(f"LDI r1 0")  # Null terminator
-            self.code.append(f"STR r14 r1 {len(stmt.value)}")
+            # The literal is already in RAM (see emit_strings), so this generates no code
+            self.current_string = self.literal(stmt.value)
             return
 
-        assert isinstance(stmt, VariableDeclaration)
         dst = self.alloc_reg(stmt.name)
         val = stmt.value
-        if isinstance(val, tuple):
+        known = self.evaluator.value(val, self.known)
+        if known is not None:
+            # Every operand is known, so is the result: no helper call needed
+            self.code.append(f"LDI {dst} {known}")
+        elif isinstance(val, tuple):
             op, left, right = val
             if op == '+':
-                self.code.append(f"ADD {self.reg(left)} {self.reg(right)} {dst}")
+                self.code.append(f"ADD {self.reg(left)} {self.reg(right, 'r14')} {dst}")
             elif op == '-':
-                self.code.append(f"SUB {self.reg(left)} {self.reg(right)} {dst}")
-            elif op == '*':
-                self.call_mul(left, right, dst)
-            elif op == '/':
-                self.call_div(left, right, dst)
-            elif op == '%':
-                self.call_mod(left, right, dst)
+                self.code.append(f"SUB {self.reg(left)} {self.reg(right, 'r14')} {dst}")
+            elif op in HELPER_OPERATORS:
+                self.call_helper(op, left, right, dst, stmt.name)
             else:
                 raise NotImplementedError(f"Unknown operator {op}")
         else:
@@ -80,109 +443,150 @@ class CodeGenerator:
             if isinstance(val, int):
                 self.code.append(f"LDI {dst} {val}")
             else:
-                self.load_operand(val, dst)
+                self.load_operand(val, int(dst[1:]))
 
         # Store result to memory to preserve it
-        addr = self.alloc_mem(stmt.name)
-        self.code.append(f"STR r0 {dst} {addr}")
-
-    def call_mul(self, left, right, dst):
-        self.load_operand(left, 1)
-        self.load_operand(right, 2)
-        self.code.append("CAL .MUL")
-        self.code.append(f"MOV r3 {dst}")
-        addr = self.alloc_mem_by_reg(dst)
-        self.code.append(f"STR r0 {dst} {addr}")
-
-    def call_div(self, left, right, dst):
-        self.load_operand(left, 1)
-        self.load_operand(right, 2)
-        self.code.append("CAL .DIV")
-        self.code.append(f"MOV r3 {dst}")
-        addr = self.alloc_mem_by_reg(dst)
-        self.code.append(f"STR r0 {dst} {addr}")
+        self.store(stmt.name, dst)
+        if known is None:
+            self.known.pop(stmt.name, None)
+        else:
+            self.known[stmt.name] = known
 
-    def call_mod(self, left, right, dst):
+    def call_helper(self, op, left, right, dst, name):
+        helper, result = HELPER_OPERATORS[op]
         self.load_operand(left, 1)
         self.load_operand(right, 2)
-        self.code.append("CAL .MOD")
-        self.code.append(f"MOV r4 {dst}")
-        addr = self.alloc_mem_by_reg(dst)
-        self.code.append(f"STR r0 {dst} {addr}")
+        self.code.append(f"CAL .{helper}")
+        self.helpers_used.add(helper)
+        if result != dst:
+            self.code.append(f"MOV {result} {dst}")
+        self.restore(OPERAND_REGISTERS | HELPER_CLOBBERS[helper], name)
 
     def load_operand(self, op, reg):
         if isinstance(op, int):
             self.code.append(f"LDI r{reg} {op}")
+            return
+        addr = self.alloc_mem(op)
+        reach = self.layout.access(addr)
+        if reach:
+            self.code.append(f"LOD {reach[0]} r{reg} {reach[1]}")
         else:
-            addr = self.alloc_mem(op)
             self.code.append(f"LDI r14 {addr}")
             self.code.append(f"LOD r14 r{reg} 0")
 
-    def reg(self, operand):
+    def store(self, var_name, reg):
+        addr = self.alloc_mem(var_name)
+        reach = self.layout.access(addr)
+        if reach:
+            self.code.append(f"STR {reach[0]} {reg} {reach[1]}")
+        else:
+            self.code.append(f"LDI r14 {addr}")
+            self.code.append(f"STR r14 {reg} 0")
+
+    def reg(self, operand, scratch="r15"):
+        # Literals go in a scratch register; the two operands of one instruction use different ones
         if isinstance(operand, int):
-            self.code.append(f"LDI r15 {operand}")
-            return "r15"
+            self.code.append(f"LDI {scratch} {operand}")
+            return scratch
         return self.register_map[operand]
 
-    def alloc_reg(self, var_name):
+    def alloc_reg(self, var_name, avoid=()):
         if var_name not in self.register_map:
-            r = f"r{self.next_reg}"
-            self.register_map[var_name] = r
-            self.next_reg += 1
+            # r0 is zero, r13 is a pinned memory base, r14/r15 are address and literal scratch
+            free = [f"r{n}" for n in range(1, 13) if f"r{n}" not in self.register_map.values()]
+            if not free:
+                raise ValueError(f"Out of registers for {var_name}")
+            self.register_map[var_name] = next((r for r in free if r not in avoid), free[0])
         return self.register_map[var_name]
 
-    def alloc_mem(self, var_name):
-        if var_name not in self.mem_map:
-            self.mem_map[var_name] = self.next_mem
-            self.next_mem += 1
-        return self.mem_map[var_name]
+    def alloc_mem(self, var_name, size=1):
+        return self.layout.allocate(var_name, size)
 
-    def alloc_mem_by_reg(self, reg):
-        for var, r in self.register_map.items():
-            if r == reg:
-                return self.alloc_mem(var)
-        raise ValueError(f"No variable found for register {reg}")
+    def emit_strings(self):
+        # RAM starts out empty, so every interned literal is written once at startup,
+        # ending in STRING_END. Literals sit next to each other and one base in r14
+        # reaches 16 bytes, so r14 is only reloaded every 16 bytes and r1 only when
+        # the value changes.
+        values = {}
+        for name, codes in self.strings.items():
+            addr = self.mem_map[name]
+            for i, code in enumerate(codes + [STRING_END]):
+                values[addr + i] = code
+        base = value = None
+        for addr in sorted(values):
+            if base is None or not base - 8 <= addr <= base + 7:
+                # Base sits 8 bytes in so offsets -8..7 cover the next 16 bytes
+                base = addr + 8
+                self.code.append(f"LDI r14 {base}")
+            if values[addr] != value:
+                value = values[addr]
+                self.code.append(f"LDI r1 {value}")
+            self.code.append(f"STR r14 r1 {addr - base}")
 
     def emit_helpers(self):
         # Multiply
-        self.code += [
-            ".MUL",
-            "LDI r3 0",
-            ".MUL_LOOP",
-            "CMP r2 r0",
-            "BRH eq .MUL_END",
-            "ADD r3 r1 r3",
-            "DEC r2",
-            "JMP .MUL_LOOP",
-            ".MUL_END",
-            "MOV r3 r1",
-            "RET",
-        ]
+        if "MUL" in self.helpers_used:
+            self.code += [
+                ".MUL",
+                "LDI r3 0",
+                ".MUL_LOOP",
+                "CMP r2 r0",
+                "BRH eq .MUL_END",
+                "ADD r3 r1 r3",
+                "DEC r2",
+                "JMP .MUL_LOOP",
+                ".MUL_END",
+                "MOV r3 r1",
+                "RET",
+            ]
         # Divide (quotient)
-        self.code += [
-            ".DIV",
-            "LDI r3 0",
-            "MOV r1 r4",      # initialize r4 = dividend
-            ".DIV_LOOP",
-            "CMP r4 r2",
-            "BRH lt .DIV_END",
-            "ADI r3 1",
-            "SUB r4 r2 r4",
-            "JMP .DIV_LOOP",
-            ".DIV_END",
-            "MOV r3 r1",      # move quotient into r1
-            "RET",
-        ]
+        if "DIV" in self.helpers_used:
+            self.code += [
+                ".DIV",
+                "LDI r3 0",
+                "MOV r1 r4",      # initialize r4 = dividend
+                ".DIV_LOOP",
+                "CMP r4 r2",
+                "BRH lt .DIV_END",
+                "ADI r3 1",
+                "SUB r4 r2 r4",
+                "JMP .DIV_LOOP",
+                ".DIV_END",
+                "MOV r3 r1",      # move quotient into r1
+                "RET",
+            ]
         # Modulus (remainder)
-        self.code += [
-            ".MOD",
-            "MOV r1 r4",      # initialize r4 = dividend
-            ".MOD_LOOP",
-            "CMP r4 r2",
-            "BRH lt .MOD_END",
-            "SUB r4 r2 r4",
-            "JMP .MOD_LOOP",
-            ".MOD_END",
-            "MOV r4 r1",      # move remainder into r1
-            "RET",
-        ]
+        if "MOD" in self.helpers_used:
+            self.code += [
+                ".MOD",
+                "MOV r1 r4",      # initialize r4 = dividend
+                ".MOD_LOOP",
+                "CMP r4 r2",
+                "BRH lt .MOD_END",
+                "SUB r4 r2 r4",
+                "JMP .MOD_LOOP",
+                ".MOD_END",
+                "MOV r4 r1",      # move remainder into r1
+                "RET",
+            ]
+        # Print the string at r14: clear the character display, write each
+        # character until STRING_END, then show the result. r15 = 255 is both
+        # the terminator to compare against and the base of the character ports.
+        if "PRINT_STR" in self.helpers_used:
+            self.code += [
+                ".PRINT_STR",
+                f"LDI r15 {STRING_END}",
+                "STR r15 r0 -6",  # clear_chars_buffer
+                "LOD r14 r1 0",
+                "CMP r1 r15",
+                "BRH eq .PRINT_STR_END",
+                ".PRINT_STR_LOOP",
+                "STR r15 r1 -8",  # write_char
+                "INC r14",
+                "LOD r14 r1 0",
+                "CMP r1 r15",
+                "BRH ne .PRINT_STR_LOOP",
+                ".PRINT_STR_END",
+                "STR r15 r0 -7",  # buffer_chars
+                "RET",
+            ]
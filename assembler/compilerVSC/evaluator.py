@@ -0,0 +1,86 @@
+from typing import Callable, Dict, Iterable, Optional
+from .parser import Method, FunctionCall
+
+class Unknown(Exception):
+    # The evaluation read something not known at compile time
+    pass
+
+def apply(op: str, left: int, right: int) -> Optional[int]:
+    # What the generated code leaves in the destination: ADD/SUB and the
+    # MUL/DIV/MOD helpers, all on 8-bit values. DIV and MOD never return for a
+    # zero divisor, so those are not evaluated.
+    if op == '+':
+        return (left + right) & 255
+    if op == '-':
+        return (left - right) & 255
+    if op == '*':
+        return (left * right) & 255
+    if op in ('/', '%') and right:
+        return left // right if op == '/' else left % right
+    return None
+
+class Evaluator:
+    # Runs method bodies at compile time. Methods take no arguments and share
+    # their variables, so a call is a function of the variables it reads, and
+    # a pure one (no printing, nor a callee that prints) is fully described by
+    # the values it assigns. Bodies are straight-line, so a call that reads
+    # only known values always finishes; recursive ones never return and are
+    # left alone.
+    def __init__(self, methods: Dict[str, Method], call_key: Callable[[FunctionCall], str], effects: Iterable[str] = ()):
+        self.methods = methods      # lowercase label -> Method
+        self.call_key = call_key    # FunctionCall -> lowercase label
+        self.effects = set(effects) # calls that do more than assign variables
+        self.pure = {}              # lowercase label -> whether calls to it can be evaluated
+
+    def is_pure(self, key: str, seen: frozenset = frozenset()) -> bool:
+        # String declarations count as effects: they choose what a later print shows
+        if key in seen or key in self.effects or key not in self.methods:
+            return False
+        if key not in self.pure:
+            self.pure[key] = all(
+                self.is_pure(self.call_key(stmt), seen | {key}) if isinstance(stmt, FunctionCall)
+                else stmt.var_type != "string"
+                for stmt in self.methods[key].body)
+        return self.pure[key]
+
+    def call(self, key: str, known: Dict[str, int]) -> Optional[Dict[str, int]]:
+        # {variable: value} the call assigns, in the order first assigned, or
+        # None when it is not pure or reads something not in known
+        if not self.is_pure(key):
+            return None
+        values, assigned = dict(known), {}
+        try:
+            self.run(key, values, assigned)
+        except Unknown:
+            return None
+        return {name: values[name] for name in assigned}
+
+    def value(self, value, known: Dict[str, int]) -> Optional[int]:
+        # Value a declaration assigns, or None when it is not known here
+        try:
+            return self.evaluate(value, known)
+        except Unknown:
+            return None
+
+    def evaluate(self, value, values: Dict[str, int]) -> int:
+        if isinstance(value, tuple):
+            op, left, right = value
+            result = apply(op, self.evaluate(left, values), self.evaluate(right, values))
+            if result is None:
+                raise Unknown()
+            return result
+        if isinstance(value, int):
+            if not -128 <= value <= 255:
+                raise Unknown()  # no LDI can load it
+            return value & 255
+        if value not in values:
+            raise Unknown()
+        return values[value]
+
+    def run(self, key: str, values: Dict[str, int], assigned: Dict[str, None]):
+        for stmt in self.methods[key].body:
+            if isinstance(stmt, FunctionCall):
+                self.run(self.call_key(stmt), values, assigned)
+            else:
+                values[stmt.name] = self.evaluate(stmt.value, values)
+                assigned[stmt.name] = None
@@ -1,5 +1,5 @@
-import re
-from typing import List, Tuple
+from typing import Iterator
+from scanner import Scanner, Token
 
 # Token specification for VortexScript (.vsc)
 TOKEN_SPECIFICATION = [
@@ -28,27 +28,21 @@ TOKEN_SPECIFICATION = [
     ('NUMBER',      r'\d+'),
 ]
 
-# Compile into a single regex
-TOKEN_REGEX = '|'.join(f"(?P<{name}>{pattern})" for name, pattern in TOKEN_SPECIFICATION)
-_re = re.compile(TOKEN_REGEX)
+# Compiled once, shared by every call
+SCANNER = Scanner(
+    TOKEN_SPECIFICATION,
+    skip={'SKIP', 'NEWLINE', 'COMMENT', 'ML_COMMENT'},
+    convert={'NUMBER': int, 'STRING': lambda text: text[1:-1]},
+    intern={'KEYWORD', 'IDENTIFIER'},
+)
 
-Token = Tuple[str, str]
-
-def tokenize(code: str) -> List[Token]:
+def tokenize(code: str) -> Iterator[Token]:
     """
-    Convert VortexScript source code into a list of tokens.
+    Convert VortexScript source code into tokens, produced lazily as they are consumed.
     Skips comments and whitespace.
 
     Returns:
-        List of (token_type, value) tuples.
+        An iterator of Token(kind, value, offset, line, column) tuples.
+        STRING values have their quotes removed.
     """
-    tokens: List[Token] = []
-    for match in _re.finditer(code):
-        kind = match.lastgroup
-        value = match.group()
-        if kind in {'SKIP', 'NEWLINE', 'COMMENT', 'ML_COMMENT'}:
-            continue  # Ignore whitespace and comments
-        if kind == 'NUMBER':
-            value = int(value)
-        tokens.append((kind, value))
-    return tokens
+    return SCANNER.tokens(code)
@@ -1,51 +1,65 @@
-from typing import List, Tuple, Union
-from .lexer import Token
+from typing import Iterable, List, Optional, Tuple, Union
+from nodes import Node
+from scanner import Token, TokenStream, error_at
 
-# AST node definitions
-class Program:
-    def __init__(self):
-        self.namespaces: List[Namespace] = []
+# AST node definitions: slotted and immutable, children held in tuples
+class Program(Node):
+    __slots__ = ('namespaces', 'imports')
+    namespaces: Tuple['Namespace', ...]
+    imports: Tuple[str, ...]  # file names from import "file.vsc"; in source order
 
-class Namespace:
-    def __init__(self, name: str):
-        self.name = name
-        self.classes: List[Class] = []
+    def __init__(self, namespaces: Iterable['Namespace'] = (), imports: Iterable[str] = ()):
+        super().__init__(tuple(namespaces), tuple(imports))
 
-class Class:
-    def __init__(self, name: str):
-        self.name = name
-        self.methods: List[Method] = []
+class Namespace(Node):
+    __slots__ = ('name', 'classes')
+    classes: Tuple['Class', ...]
 
-class Method:
-    def __init__(self, name: str):
-        self.name = name
-        self.parameters: List[Tuple[str, str]] = []
-        self.body: List[Union[VariableDeclaration, FunctionCall]] = []
+    def __init__(self, name: str, classes: Iterable['Class'] = ()):
+        super().__init__(name, tuple(classes))
+
+class Class(Node):
+    __slots__ = ('name', 'methods')
+    methods: Tuple['Method', ...]
+
+    def __init__(self, name: str, methods: Iterable['Method'] = ()):
+        super().__init__(name, tuple(methods))
+
+class Method(Node):
+    __slots__ = ('name', 'parameters', 'body')
+    parameters: Tuple[Tuple[str, str], ...]
+    body: Tuple[Union['VariableDeclaration', 'FunctionCall'], ...]
+
+    def __init__(self, name: str, parameters: Iterable[Tuple[str, str]] = (),
+                 body: Iterable[Union['VariableDeclaration', 'FunctionCall']] = ()):
+        super().__init__(name, tuple(parameters), tuple(body))
+
+class VariableDeclaration(Node):
+    __slots__ = ('var_type', 'name', 'value')
 
-class VariableDeclaration:
     def __init__(self, var_type: str, name: str, value: Union[int, str, Tuple[str, Union[int,str], Union[int,str]]]):
-        self.var_type = var_type
-        self.name = name
-        self.value = value
+        super().__init__(var_type, name, value)
+
+class FunctionCall(Node):
+    __slots__ = ('name',)
 
-class FunctionCall:
     def __init__(self, name: str):
-        self.name = name
+        super().__init__(name)
 
 class Parser:
-    def __init__(self, tokens: List[Token]):
-        self.tokens = tokens
-        self.current = 0
+    def __init__(self, tokens: Iterable[Token]):
+        # Tokens are pulled from the iterable as the parser advances
+        self.tokens = TokenStream(tokens)
 
     def parse(self) -> Program:
-        program = Program()
-        ns = Namespace("Global")
+        imports: List[str] = []
+        classes: List[Class] = []
 
         while not self.is_at_end():
-            # 🔧 Skip over any import statements BEFORE parsing classes
+            # Record import statements BEFORE parsing classes; the driver loads them
             while self.check('KEYWORD', 'import'):
                 self.consume('KEYWORD', 'import')
-                self.consume('STRING')  # e.g., "math.vsc"
+                imports.append(self.consume('STRING').value)  # e.g., "math.vsc"
                 self.consume('SEMI')
 
             # Look for: public class ClassName {
@@ -53,7 +67,7 @@ class Parser:
                 self.consume('KEYWORD', 'public')
                 self.consume('KEYWORD', 'class')
                 class_name = self.consume('IDENTIFIER')[1]
-                cls = Class(class_name)
+                methods: List[Method] = []
                 self.consume('LBRACE')
 
                 # Parse all methods in this class
@@ -67,22 +81,20 @@ class Parser:
                     self.consume('RPAREN')
                     self.consume('LBRACE')
 
-                    method = Method(method_name)
-
+                    body = []
                     while not self.check('RBRACE') and not self.is_at_end():
                         stmt = self.parse_statement()
-                        method.body.append(stmt)
+                        body.append(stmt)
 
                     self.consume('RBRACE')  # end of method
-                    cls.methods.append(method)
+                    methods.append(Method(method_name, body=body))
 
                 self.consume('RBRACE')  # end of class
-                ns.classes.append(cls)
+                classes.append(Class(class_name, methods))
             else:
                 break
 
-        program.namespaces.append(ns)
-        return program
+        return Program([Namespace("Global", classes)], imports)
 
     def parse_statement(self) -> Union[VariableDeclaration, FunctionCall]:
         if self.check('KEYWORD', 'byte') or self.check('KEYWORD', 'string'):
@@ -98,7 +110,7 @@ class Parser:
             self.consume('SEMI')
             return FunctionCall(f"{class_name}.{method_name}")
 
-        raise SyntaxError(f"Unexpected token in statement: {self.peek()}")
+        raise error_at("Unexpected token in statement", self.peek())
 
     def parse_var_declaration(self) -> VariableDeclaration:
         var_type = self.consume('KEYWORD')[1]
@@ -107,7 +119,7 @@ class Parser:
 
         # Handle string literal directly
         if self.check('STRING'):
-            value = self.consume('STRING')[1].strip('"')
+            value = self.consume('STRING')[1]
         else:
             # Optional cast: (byte)
             if self.check('LPAREN') and self.check_next('KEYWORD', 'byte'):
@@ -141,26 +153,22 @@ class Parser:
     # Utility methods
     def consume(self, typ: str, val: str = None) -> Token:
         if self.check(typ, val):
-            tok = self.tokens[self.current]
-            self.current += 1
-            return tok
+            return self.tokens.advance()
         expected = f"{typ} '{val}'" if val else typ
-        raise SyntaxError(f"Expected {expected}, got {self.peek()}")
+        raise error_at(f"Expected {expected}", self.peek())
 
     def check(self, typ: str, val: str = None) -> bool:
-        if self.is_at_end():
-            return False
-        ttype, tval = self.peek()
-        return ttype == typ and (val is None or tval == val)
+        return self.matches(self.peek(), typ, val)
 
     def check_next(self, typ: str, val: str = None) -> bool:
-        if self.current + 1 >= len(self.tokens):
-            return False
-        ttype, tval = self.tokens[self.current+1]
-        return ttype == typ and (val is None or tval == val)
+        return self.matches(self.tokens.peek(1), typ, val)
+
+    @staticmethod
+    def matches(token: Optional[Token], typ: str, val: Optional[str]) -> bool:
+        return token is not None and token.kind == typ and (val is None or token.value == val)
 
-    def peek(self) -> Token:
-        return self.tokens[self.current]
+    def peek(self) -> Optional[Token]:
+        return self.tokens.peek()
 
     def is_at_end(self) -> bool:
-        return self.current >= len(self.tokens)
+        return self.tokens.at_end()
@@ -0,0 +1,275 @@
+# Disassembler and ROM analysis for BatPU-2 machine code.
+#
+# Decodes a whole ROM at once: the words are a NumPy array and every field
+# (opcode, registers, immediate, condition, 10-bit address, signed offset) is
+# extracted with one shift-and-mask over the array, so a stack of ROM dumps
+# shaped (n, 1024) decodes in the same call. From the decoded ROM it
+#   - names every jump, branch and call target as a label,
+#   - splits the ROM into basic blocks and builds the control flow graph,
+#   - builds the call graph (a jmp to a called routine counts as a tail call),
+#   - lists the words no path from pc 0 reaches.
+# Within a basic block it follows LDI constants, so a register used as the
+# base of a LOD/STR into the port range is loaded with the port's name and a
+# value written to write_char is loaded as a character literal, using the
+# assembler's PORTS and CHARACTERS tables. The output assembles back to the
+# same words.
+#
+# Needs NumPy. Usage: python disassembler.py program.mc... [--output FILE] [--report] [--json FILE]
+
+import argparse
+import json
+import sys
+import numpy as np
+from pathlib import Path
+from assembler import OPCODES, REGISTERS, CONDITIONS, PORTS, PORT_BASE, CHARACTERS
+from optimizer import ROM_SIZE
+
+OP = {name: index for index, name in enumerate(OPCODES)}
+BINARY_OPS = [OP['add'], OP['sub'], OP['nor'], OP['and'], OP['xor']]
+JUMPS = [OP['jmp'], OP['brh'], OP['cal']]
+# Instructions after which a new basic block starts
+BLOCK_ENDS = [OP['hlt'], OP['jmp'], OP['brh'], OP['cal'], OP['ret']]
+WRITE_CHAR = PORT_BASE + PORTS.index('write_char')
+
+def load_mc(path):
+    # One 16-bit binary string per line, as written by assembler.assemble
+    with open(path, 'r') as f:
+        return np.array([int(line, 2) for line in f if line.strip()], dtype=np.uint16)
+
+def decode(words):
+    # Field arrays of the same shape as words
+    words = np.asarray(words, dtype=np.uint16).astype(np.int32)
+    return {
+        'word': words,
+        'opcode': words >> 12,
+        'a': (words >> 8) & 15,
+        'b': (words >> 4) & 15,
+        'c': words & 15,
+        'immediate': words & 255,
+        'condition': (words >> 10) & 3,
+        'address': words & 1023,
+        'offset': ((words & 15) ^ 8) - 8,
+    }
+
+def program_length(fields):
+    # Words up to the last non-zero one; a ROM dump is padded with NOPs
+    nonzero = np.flatnonzero(fields['word'])
+    return int(nonzero[-1]) + 1 if len(nonzero) else 0
+
+def analyze(fields):
+    # Control flow of one decoded ROM: labels, basic blocks, successors,
+    # routines with their calls, and which words are reachable from pc 0
+    opcode, address = fields['opcode'], fields['address']
+    length = program_length(fields)
+    is_jump = np.isin(opcode[:length], JUMPS)
+    targets = np.unique(address[:length][is_jump])
+    call_targets = np.unique(address[:length][opcode[:length] == OP['cal']])
+
+    leaders = np.zeros(length + 1, dtype=bool)
+    leaders[0] = True
+    leaders[targets[targets < length]] = True
+    leaders[np.flatnonzero(np.isin(opcode[:length], BLOCK_ENDS)) + 1] = True
+    starts = np.flatnonzero(leaders[:length])
+    ends = np.append(starts[1:], length)
+    blocks = {int(start): int(end) for start, end in zip(starts, ends)}
+
+    # Successors within a routine; a cal continues after it and also calls
+    successors, calls = {}, {}
+    for start, end in blocks.items():
+        last = end - 1
+        op, target = int(opcode[last]), int(address[last])
+        if op == OP['jmp']:
+            successors[start] = [target]
+        elif op == OP['brh']:
+            successors[start] = [target, end]
+        elif op in (OP['hlt'], OP['ret']):
+            successors[start] = []
+        else:
+            successors[start] = [end] if end < length else []
+        if op == OP['cal']:
+            calls[start] = target
+
+    entries = sorted({0} | {int(pc) for pc in call_targets})
+    entry_set = set(entries)
+    routines = {}
+    for entry in entries:
+        seen, pending, callees = set(), [entry], set()
+        while pending:
+            start = pending.pop()
+            if start in seen or start not in blocks:
+                continue
+            seen.add(start)
+            if start in calls:
+                callees.add(calls[start])
+            for successor in successors[start]:
+                if successor in entry_set and successor != entry:
+                    callees.add(successor)  # tail call, or falling into the next routine
+                else:
+                    pending.append(successor)
+        routines[entry] = {'blocks': sorted(seen), 'calls': sorted(callees),
+                           'words': sum(blocks[start] - start for start in seen)}
+
+    reachable = np.zeros(length, dtype=bool)
+    seen, pending = set(), [0]
+    while pending:
+        entry = pending.pop()
+        if entry in seen or entry not in routines:
+            continue
+        seen.add(entry)
+        for start in routines[entry]['blocks']:
+            reachable[start:blocks[start]] = True
+        pending.extend(routines[entry]['calls'])
+
+    labels = {}
+    for pc in targets[targets < length]:
+        pc = int(pc)
+        labels[pc] = f".sub_{pc}" if pc in entry_set else f".label_{pc}"
+    return {
+        'length': length,
+        'labels': labels,
+        'blocks': blocks,
+        'successors': successors,
+        'routines': routines,
+        'reachable': reachable,
+    }
+
+def ranges(mask):
+    # [(first, last)] of the runs of True in a boolean array
+    padded = np.concatenate(([False], mask, [False])).astype(np.int8)
+    edges = np.flatnonzero(np.diff(padded))
+    return [(int(first), int(last) - 1) for first, last in zip(edges[::2], edges[1::2])]
+
+def constants(fields, analysis):
+    # Readable immediates for LDIs: pc -> port name or character literal,
+    # found by following LDI values through each basic block
+    opcode, a, b, c = fields['opcode'], fields['a'], fields['b'], fields['c']
+    immediate, offset = fields['immediate'], fields['offset']
+    names = {}
+    for start, end in analysis['blocks'].items():
+        known = {}  # register -> (pc of the ldi, value)
+        for pc in range(start, end):
+            op = int(opcode[pc])
+            if op in (OP['lod'], OP['str']) and int(a[pc]) in known:
+                base_pc, base = known[int(a[pc])]
+                port = base + int(offset[pc])
+                if base >= PORT_BASE and port >= PORT_BASE:
+                    names[base_pc] = PORTS[base - PORT_BASE]
+                if op == OP['str'] and port == WRITE_CHAR and int(b[pc]) in known:
+                    value_pc, value = known[int(b[pc])]
+                    if value < len(CHARACTERS):
+                        names[value_pc] = f'"{CHARACTERS[value]}"'
+            if op == OP['ldi'] and int(a[pc]):
+                known[int(a[pc])] = (pc, int(immediate[pc]))
+            elif op in BINARY_OPS or op == OP['rsh']:
+                known.pop(int(c[pc]), None)
+            elif op == OP['adi']:
+                known.pop(int(a[pc]), None)
+            elif op == OP['lod']:
+                known.pop(int(b[pc]), None)
+    return names
+
+def instruction(fields, pc, labels, names):
+    # Assembly text of one word; pseudo-ops where the encoding matches one
+    op = OPCODES[int(fields['opcode'][pc])]
+    a, b, c = (REGISTERS[int(fields[field][pc])] for field in ('a', 'b', 'c'))
+    immediate, offset = int(fields['immediate'][pc]), int(fields['offset'][pc])
+    address = int(fields['address'][pc])
+    target = labels.get(address, str(address))
+    if op in ('nop', 'hlt', 'ret'):
+        return op
+    if op == 'sub' and c == 'r0':
+        return f"cmp {a} {b}"
+    if op == 'sub' and a == 'r0':
+        return f"neg {b} {c}"
+    if op == 'add' and b == 'r0':
+        return f"mov {a} {c}"
+    if op == 'add' and a == b:
+        return f"lsh {a} {c}"
+    if op == 'nor' and b == 'r0':
+        return f"not {a} {c}"
+    if op in ('add', 'sub', 'nor', 'and', 'xor'):
+        return f"{op} {a} {b} {c}"
+    if op == 'rsh':
+        return f"rsh {a} {c}"
+    if op == 'ldi':
+        return f"ldi {a} {names.get(pc, immediate)}"
+    if op == 'adi':
+        if immediate == 1:
+            return f"inc {a}"
+        if immediate == 255:
+            return f"dec {a}"
+        return f"adi {a} {immediate - 256 if immediate > 127 else immediate}"
+    if op in ('jmp', 'cal'):
+        return f"{op} {target}"
+    if op == 'brh':
+        return f"brh {CONDITIONS[0][int(fields['condition'][pc])]} {target}"
+    return f"{op} {a} {b}" + (f" {offset}" if offset else "")
+
+def disassemble(words):
+    # Assembly lines for one ROM, with labels and comments for port accesses
+    fields = decode(words)
+    analysis = analyze(fields)
+    labels, names = analysis['labels'], constants(fields, analysis)
+    lines = []
+    for pc in range(analysis['length']):
+        if pc in labels:
+            lines.append(labels[pc])
+        text = instruction(fields, pc, labels, names)
+        if not analysis['reachable'][pc]:
+            text += "  // unreachable"
+        lines.append(text)
+    return lines, analysis
+
+def report(analysis):
+    # Summary of the control flow, as a dict for JSON output
+    unreachable = ranges(~analysis['reachable'])
+    return {
+        'words': analysis['length'],
+        'blocks': len(analysis['blocks']),
+        'edges': sum(len(successors) for successors in analysis['successors'].values()),
+        'routines': [{'entry': entry, 'label': analysis['labels'].get(entry, '(entry)'),
+                      'words': routine['words'], 'blocks': len(routine['blocks']),
+                      'calls': [analysis['labels'][callee] for callee in routine['calls']]}
+                     for entry, routine in analysis['routines'].items()],
+        'unreachable_words': int(np.count_nonzero(~analysis['reachable'])),
+        'unreachable': [[first, last] for first, last in unreachable],
+    }
+
+def format_report(summary):
+    lines = [f"{summary['words']}/{ROM_SIZE} words, {summary['blocks']} basic blocks, {summary['edges']} edges"]
+    lines.append("Call graph:")
+    for routine in summary['routines']:
+        calls = ", ".join(routine['calls']) or "-"
+        lines.append(f"  {routine['label']:<16}{routine['words']:>5} words {routine['blocks']:>4} blocks  calls {calls}")
+    lines.append(f"Unreachable: {summary['unreachable_words']} words"
+                 + "".join(f"\n  {first}..{last}" for first, last in summary['unreachable']))
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Disassemble BatPU-2 machine code and analyze its control flow")
+    parser.add_argument('files', nargs='+', type=Path, help=".mc files")
+    parser.add_argument('--output', type=Path, help="write the assembly here instead of printing it (one input only)")
+    parser.add_argument('--report', action='store_true', help="print the CFG, call graph and unreachable words")
+    parser.add_argument('--json', type=Path, help="write the reports of all inputs as JSON")
+    args = parser.parse_args()
+    if args.output and len(args.files) > 1:
+        sys.exit("--output takes a single input file")
+
+    summaries = {}
+    for path in args.files:
+        words = load_mc(path)
+        if len(words) > ROM_SIZE:
+            sys.exit(f"{path}: {len(words)} words, ROM holds {ROM_SIZE}")
+        lines, analysis = disassemble(words)
+        summaries[str(path)] = report(analysis)
+        if args.output:
+            args.output.write_text("\n".join(lines) + "\n")
+        elif not args.report and not args.json:
+            print("\n".join(lines))
+        if args.report:
+            print(f"{path}:\n{format_report(summaries[str(path)])}")
+    if args.json:
+        args.json.write_text(json.dumps(summaries, indent=1))
+
+if __name__ == '__main__':
+    main()
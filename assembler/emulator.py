@@ -0,0 +1,306 @@
+# BatPU-2 emulator for running assembled programs locally.
+#
+# Executes machine code words one instruction per cycle with the same
+# semantics as the hardware: 16 registers with r0 hardwired to zero, Z and C
+# flags set by ADD, SUB, NOR, AND, XOR and ADI, a 16 entry call stack, and
+# 240 bytes of RAM followed by the memory-mapped ports. Port reads of
+# controller_input and rng are fed from a script, so a run can be repeated
+# exactly, and every instruction executed is counted per pc.
+#
+# The complete machine state can be saved as a compact binary snapshot and
+# restored into an emulator running the same ROM with the same script.
+# record() runs while taking a snapshot every SNAPSHOT_INTERVAL cycles, and
+# seek() then reaches any cycle by restoring the nearest earlier snapshot and
+# replaying only the rest.
+
+import hashlib
+import json
+import math
+import random
+import struct
+import zlib
+from array import array
+from assembler import OPCODES, PORTS, PORT_BASE, assemble_lines
+from memory_layout import RAM_SIZE
+from optimizer import ROM_SIZE
+
+STACK_DEPTH = 16
+SCREEN_SIZE = 32
+CHAR_DISPLAY_SIZE = 10
+MAX_CYCLES = 200000
+
+PORT = {name: PORT_BASE + index for index, name in enumerate(PORTS)}
+
+SNAPSHOT_MAGIC = b'BPU2'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_INTERVAL = 100000
+# magic, version, ROM digest, pc, cycles, flags, stack depth, stack,
+# pixel x/y, number (256 = blank), chars buffered/shown, controller/rng reads.
+# The registers, RAM, screens, characters, RNG state and per-pc counts
+# follow, zlib compressed.
+SNAPSHOT_HEADER = struct.Struct(f'<4sB16sHQBB{STACK_DEPTH}HBBHBBII')
+NO_NUMBER = 256
+
+def decode(word):
+    # (opcode, reg A, reg B, reg C, immediate, address, condition, offset)
+    offset = word & 15
+    return (word >> 12, (word >> 8) & 15, (word >> 4) & 15, word & 15,
+            word & 255, word & 1023, (word >> 10) & 3, offset - 16 if offset > 7 else offset)
+
+def load_script(path):
+    # {"controller_input": [...], "rng": [...], "seed": 0, "cycles": 200000}, all optional
+    with open(path, 'r') as f:
+        return json.load(f)
+
+class Emulator:
+    def __init__(self, rom, controller_input=(), rng=(), seed=0):
+        if len(rom) > ROM_SIZE:
+            raise ValueError(f"Program is {len(rom)} words, ROM holds {ROM_SIZE}")
+        self.rom = [decode(word) for word in rom] + [decode(0)] * (ROM_SIZE - len(rom))
+        self.rom_digest = hashlib.blake2b(array('H', rom).tobytes(), digest_size=16).digest()
+        self.controller_input = list(controller_input)
+        self.rng_values = list(rng)
+        self.seed = seed
+        self.snapshots = {}  # cycle -> snapshot, kept across resets
+        self.reset()
+
+    def reset(self):
+        self.pc = 0
+        self.registers = [0] * 16
+        self.zero = False
+        self.carry = False
+        self.stack = []
+        self.memory = [0] * RAM_SIZE
+        self.halted = False
+        self.cycles = 0
+        self.counts = [0] * ROM_SIZE  # instructions executed at each pc
+        self.port_writes = []         # (cycle, port, value) in program order
+        self.controller_reads = 0
+        self.rng_reads = 0
+        self.random = random.Random(self.seed)
+        self.pixel_x = 0
+        self.pixel_y = 0
+        self.screen_buffer = [[0] * SCREEN_SIZE for _ in range(SCREEN_SIZE)]  # [y][x]
+        self.screen = [[0] * SCREEN_SIZE for _ in range(SCREEN_SIZE)]
+        self.chars_buffer = []
+        self.chars = []
+        self.number = None
+        self.signed = False
+
+    def run(self, max_cycles=MAX_CYCLES):
+        # Run until hlt or until max_cycles more instructions have executed
+        limit = self.cycles + max_cycles
+        while not self.halted and self.cycles < limit:
+            self.step()
+        return self.cycles
+
+    def record(self, max_cycles=MAX_CYCLES, interval=SNAPSHOT_INTERVAL):
+        # Like run, but keeps a snapshot every interval cycles for seek
+        limit = self.cycles + max_cycles
+        while not self.halted and self.cycles < limit:
+            if self.cycles % interval == 0:
+                self.snapshots[self.cycles] = self.snapshot()
+            self.run(min(interval - self.cycles % interval, limit - self.cycles))
+        return self.cycles
+
+    def seek(self, cycle):
+        # Machine state at the given cycle (or at hlt, if that comes first),
+        # replaying from the nearest snapshot at or before it
+        earlier = [taken for taken in self.snapshots if taken <= cycle]
+        nearest = max(earlier) if earlier else None
+        if self.cycles > cycle or (nearest is not None and nearest > self.cycles):
+            if nearest is None:
+                self.reset()
+            else:
+                self.restore(self.snapshots[nearest])
+        if self.cycles < cycle:
+            self.run(cycle - self.cycles)
+        return self.cycles
+
+    def snapshot(self):
+        # Complete machine state as bytes. port_writes is a log of the run
+        # rather than state, so it is not included.
+        flags = self.zero | self.carry << 1 | self.halted << 2 | self.signed << 3
+        header = SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.rom_digest, self.pc, self.cycles, flags,
+            len(self.stack), *self.stack, *[0] * (STACK_DEPTH - len(self.stack)),
+            self.pixel_x, self.pixel_y, NO_NUMBER if self.number is None else self.number,
+            len(self.chars_buffer), len(self.chars), self.controller_reads, self.rng_reads)
+        version, internal, gauss = self.random.getstate()
+        body = b''.join([
+            bytes(self.registers),
+            bytes(self.memory),
+            pack_screen(self.screen_buffer),
+            pack_screen(self.screen),
+            bytes(self.chars_buffer),
+            bytes(self.chars),
+            array('I', internal).tobytes(),
+            struct.pack('<d', math.nan if gauss is None else gauss),
+            array('Q', self.counts).tobytes(),
+        ])
+        return header + zlib.compress(body)
+
+    def restore(self, data):
+        fields = SNAPSHOT_HEADER.unpack_from(data)
+        magic, version, digest, self.pc, self.cycles, flags, depth = fields[:7]
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("Not a BatPU-2 emulator snapshot")
+        if digest != self.rom_digest:
+            raise ValueError("Snapshot was taken with a different ROM")
+        self.stack = list(fields[7:7 + depth])
+        self.pixel_x, self.pixel_y, number, buffered, shown, self.controller_reads, self.rng_reads = fields[7 + STACK_DEPTH:]
+        self.number = None if number == NO_NUMBER else number
+        self.zero, self.carry, self.halted, self.signed = (bool(flags >> bit & 1) for bit in range(4))
+
+        body = memoryview(zlib.decompress(data[SNAPSHOT_HEADER.size:]))
+        sizes = [16, RAM_SIZE, SCREEN_SIZE * 4, SCREEN_SIZE * 4, buffered, shown, 625 * 4, 8, ROM_SIZE * 8]
+        parts, start = [], 0
+        for size in sizes:
+            parts.append(body[start:start + size])
+            start += size
+        registers, memory, screen_buffer, screen, chars_buffer, chars, internal, gauss, counts = parts
+        self.registers = list(registers)
+        self.memory = list(memory)
+        self.screen_buffer = unpack_screen(screen_buffer)
+        self.screen = unpack_screen(screen)
+        self.chars_buffer = list(chars_buffer)
+        self.chars = list(chars)
+        gauss = struct.unpack('<d', gauss)[0]
+        self.random.setstate((self.random.VERSION, tuple(array('I', bytes(internal))), None if math.isnan(gauss) else gauss))
+        self.counts = list(array('Q', bytes(counts)))
+        self.port_writes = []
+
+    def step(self):
+        op, a, b, c, immediate, address, condition, offset = self.rom[self.pc]
+        regs = self.registers
+        self.counts[self.pc] += 1
+        self.cycles += 1
+        next_pc = (self.pc + 1) % ROM_SIZE
+        name = OPCODES[op]
+
+        if name == 'hlt':
+            self.halted = True
+            return
+        elif name in ['add', 'sub']:
+            result = regs[a] + regs[b] if name == 'add' else regs[a] + (~regs[b] & 255) + 1
+            self.set_flags(result)
+            self.write(c, result)
+        elif name in ['nor', 'and', 'xor']:
+            if name == 'nor':
+                result = ~(regs[a] | regs[b]) & 255
+            elif name == 'and':
+                result = regs[a] & regs[b]
+            else:
+                result = regs[a] ^ regs[b]
+            self.set_flags(result)
+            self.write(c, result)
+        elif name == 'rsh':
+            self.write(c, regs[a] >> 1)
+        elif name == 'ldi':
+            self.write(a, immediate)
+        elif name == 'adi':
+            result = regs[a] + immediate
+            self.set_flags(result)
+            self.write(a, result)
+        elif name == 'jmp':
+            next_pc = address
+        elif name == 'brh':
+            if [self.zero, not self.zero, self.carry, not self.carry][condition]:
+                next_pc = address
+        elif name == 'cal':
+            if len(self.stack) == STACK_DEPTH:
+                raise RuntimeError(f"Call stack overflow at pc {self.pc}")
+            self.stack.append(next_pc)
+            next_pc = address
+        elif name == 'ret':
+            if not self.stack:
+                raise RuntimeError(f"Return with an empty call stack at pc {self.pc}")
+            next_pc = self.stack.pop()
+        elif name == 'lod':
+            self.write(b, self.load((regs[a] + offset) & 255))
+        elif name == 'str':
+            self.store((regs[a] + offset) & 255, regs[b])
+        self.pc = next_pc
+
+    def set_flags(self, result):
+        self.zero = result & 255 == 0
+        self.carry = result > 255
+
+    def write(self, reg, value):
+        if reg != 0:
+            self.registers[reg] = value & 255
+
+    def load(self, address):
+        if address < RAM_SIZE:
+            return self.memory[address]
+        if address == PORT['load_pixel']:
+            return self.screen_buffer[self.pixel_y][self.pixel_x]
+        if address == PORT['rng']:
+            self.rng_reads += 1
+            if self.rng_reads <= len(self.rng_values):
+                return self.rng_values[self.rng_reads - 1] & 255
+            return self.random.randrange(256)
+        if address == PORT['controller_input']:
+            self.controller_reads += 1
+            if self.controller_reads <= len(self.controller_input):
+                return self.controller_input[self.controller_reads - 1] & 255
+            return 0
+        return 0  # write-only ports
+
+    def store(self, address, value):
+        if address < RAM_SIZE:
+            self.memory[address] = value
+            return
+        self.port_writes.append((self.cycles, address, value))
+        port = PORTS[address - PORT_BASE]
+        if port == 'pixel_x':
+            self.pixel_x = value % SCREEN_SIZE
+        elif port == 'pixel_y':
+            self.pixel_y = value % SCREEN_SIZE
+        elif port in ['draw_pixel', 'clear_pixel']:
+            self.screen_buffer[self.pixel_y][self.pixel_x] = int(port == 'draw_pixel')
+        elif port == 'buffer_screen':
+            self.screen = [row[:] for row in self.screen_buffer]
+        elif port == 'clear_screen_buffer':
+            self.screen_buffer = [[0] * SCREEN_SIZE for _ in range(SCREEN_SIZE)]
+        elif port == 'write_char':
+            # The oldest character drops off once all ten are in use
+            self.chars_buffer = (self.chars_buffer + [value])[-CHAR_DISPLAY_SIZE:]
+        elif port == 'buffer_chars':
+            self.chars = list(self.chars_buffer)
+        elif port == 'clear_chars_buffer':
+            self.chars_buffer = []
+        elif port == 'show_number':
+            self.number = value
+        elif port == 'clear_number':
+            self.number = None
+        elif port in ['signed_mode', 'unsigned_mode']:
+            self.signed = port == 'signed_mode'
+
+    def number_display(self):
+        if self.number is None:
+            return ""
+        return str(self.number - 256 if self.signed and self.number > 127 else self.number)
+
+def pack_screen(screen):
+    # One 32-bit row mask per row
+    return struct.pack(f'<{SCREEN_SIZE}I', *[sum(pixel << x for x, pixel in enumerate(row)) for row in screen])
+
+def unpack_screen(data):
+    return [[row >> x & 1 for x in range(SCREEN_SIZE)] for row in struct.unpack(f'<{SCREEN_SIZE}I', data)]
+
+def profile_counts(assembly_code, markers, script=None):
+    # Assemble and run a program built with profile markers, returning how many
+    # times the code at each marker ran: {AST node: count}. A node that was
+    # emitted in several places, e.g. through inlining, sums all of them.
+    script = dict(script or {})
+    cycles = script.pop('cycles', MAX_CYCLES)
+    rom, symbols = assemble_lines(assembly_code)
+    emulator = Emulator(rom, **script)
+    emulator.run(cycles)
+    counts = {}
+    for label, node in markers.items():
+        pc = symbols.get(label.lower())
+        if pc is not None and pc < ROM_SIZE:
+            counts[node] = counts.get(node, 0) + emulator.counts[pc]
+    return counts
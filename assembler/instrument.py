@@ -0,0 +1,103 @@
+# Build instrumentation shared by the compiler drivers.
+#
+# Each stage of a build runs inside `with metrics.stage(name) as counts:`,
+# which records its wall time and, when enabled, its peak traced memory and a
+# cProfile of just that stage. The body can add counts such as the number of
+# tokens or instructions. A stage entered more than once (e.g. the parser for
+# every imported file) accumulates into one record.
+
+import cProfile
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+class Instrumentation:
+    def __init__(self, trace_memory=False, profile_dir=None):
+        self.trace_memory = trace_memory
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self.stages = {}    # name -> {'seconds', 'peak_memory', 'counts'}
+        self.profiles = {}  # name -> cProfile.Profile
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        record = self.stages.setdefault(name, {'seconds': 0.0, 'peak_memory': None, 'counts': {}})
+        counts = {}
+        profile = None
+        if self.profile_dir:
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        if profile:
+            profile.enable()
+        try:
+            yield counts
+        finally:
+            if profile:
+                profile.disable()
+            record['seconds'] += time.perf_counter() - start
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                record['peak_memory'] = max(record['peak_memory'] or 0, peak)
+            for key, value in counts.items():
+                record['counts'][key] = record['counts'].get(key, 0) + value
+
+    def total_seconds(self):
+        return sum(record['seconds'] for record in self.stages.values())
+
+    def report(self):
+        # Machine-readable summary of every stage
+        return {
+            'total_seconds': self.total_seconds(),
+            'stages': [{'name': name, **record} for name, record in self.stages.items()],
+        }
+
+    def format_report(self):
+        lines = [f"{'stage':<12}{'ms':>10}{'peak KiB':>10}  counts"]
+        for name, record in self.stages.items():
+            peak = f"{record['peak_memory'] / 1024:>10.1f}" if record['peak_memory'] is not None else f"{'-':>10}"
+            counts = ", ".join(f"{key} {value}" for key, value in record['counts'].items())
+            lines.append(f"{name:<12}{record['seconds'] * 1000:>10.2f}{peak}  {counts}")
+        lines.append(f"{'total':<12}{self.total_seconds() * 1000:>10.2f}")
+        return "\n".join(lines)
+
+    def write_report(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+
+    def write_profiles(self):
+        # One .prof file per stage, for pstats or snakeviz
+        if not self.profile_dir:
+            return []
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        paths = []
+        for name, profile in self.profiles.items():
+            path = self.profile_dir / f"{name}.prof"
+            profile.dump_stats(path)
+            paths.append(path)
+        return paths
+
+def count_nodes(node):
+    # Number of AST nodes under node: objects with attributes, reached through
+    # their attributes and any lists or tuples they hold
+    if isinstance(node, (list, tuple)):
+        return sum(count_nodes(item) for item in node)
+    if not hasattr(node, '__dict__') and not hasattr(node, '__slots__'):
+        return 0
+    if hasattr(node, '__dict__'):
+        children = vars(node).values()
+    else:
+        children = [getattr(node, name) for name in node.__slots__ if hasattr(node, name)]
+    return 1 + sum(count_nodes(child) for child in children)
+
+def add_arguments(parser):
+    # Command-line flags shared by the drivers
+    parser.add_argument('--verbose', action='store_true', help="print tokens, the AST and the generated assembly")
+    parser.add_argument('--timing', action='store_true', help="print wall time and counts per stage")
+    parser.add_argument('--memory', action='store_true', help="track peak memory per stage with tracemalloc")
+    parser.add_argument('--cprofile', metavar='DIR', help="write a cProfile dump per stage into DIR")
+    parser.add_argument('--report', metavar='FILE', help="write the stage report as JSON")
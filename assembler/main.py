@@ -1,14 +1,45 @@
+import argparse
+import sys
 from compiler.lexer import tokenize
 from compiler.parser import Parser
 from compiler.codegen import CodeGenerator
 from assembler import assemble
+from optimizer import parse, render, optimize, rom_usage, format_rom_report
+from emulator import load_script, profile_counts
+from codecache import CodeCache
+from analysis import analyze_assembly, format_report, format_summary
+from validate import validate, format_validation
+from instrument import Instrumentation, count_nodes, add_arguments
 from schematic import make_schematic
 
+def build(ast, metrics, profile=None, instrument=False, stage_prefix="", cache=None):
+    with metrics.stage(f"{stage_prefix}codegen") as counts:
+        codegen = CodeGenerator(profile=profile, instrument=instrument, cache=cache)
+        assembly_code = codegen.generate(ast)
+        counts['lines'] = len(assembly_code.splitlines())
+    # Drop unreachable routines and compares whose flags are already known
+    with metrics.stage(f"{stage_prefix}optimize") as counts:
+        program = optimize(parse(assembly_code))
+        counts['instructions'] = rom_usage(program)['total']
+    return codegen, program, assembly_code
+
 def main():
-    program_name = "CSfunc"  # Replace with your desired filename (without extension)
+    parser = argparse.ArgumentParser(description="Compile a C# program in programs/ to a schematic")
+    parser.add_argument('program', nargs='?', default="CSfunc", help="file name in programs/ without extension")
+    # Recorded controller_input/rng script, e.g. programs/CSfunc.script.json. A first build
+    # runs on the emulator and its execution counts guide the real build.
+    parser.add_argument('--pgo', metavar='SCRIPT', help="optimize for a run of this input script")
+    parser.add_argument('--fresh', action='store_true', help="ignore the code cache of the previous build")
+    parser.add_argument('--no-validate', action='store_true', help="skip checking the optimized program against the unoptimized one")
+    add_arguments(parser)
+    args = parser.parse_args()
+    metrics = Instrumentation(trace_memory=args.memory, profile_dir=args.cprofile)
 
+    program_name = args.program
     source_file = f"programs/{program_name}.cs"
     asm_file = f"programs/{program_name}.as"
+    analysis_file = f"programs/{program_name}.analysis.txt"
+    cache_file = f"programs/{program_name}.cache.json"
     mc_file = f"programs/{program_name}.mc"
     schematic_file = f"programs/{program_name}program.schem"
 
@@ -16,38 +47,77 @@ def main():
     with open(source_file, 'r', encoding='utf-8-sig') as f:
         source_code = f.read()
 
-    # Step 2: Lexical Analysis
-    print("Step 2: Lexical Analysis")
-    tokens = tokenize(source_code)
-    print("Tokens:")
-    for token in tokens:
-        print(token)
-
-    # Step 3: Parsing
-    print("\nStep 3: Parsing")
-    parser = Parser(tokens)
-    ast = parser.parse()
-    print("Abstract Syntax Tree (AST):")
-    print(ast)
-
-    # Step 4: Generate Assembly
-    print("\nStep 4: Generate Assembly")
-    codegen = CodeGenerator()
-    assembly_code = codegen.generate(ast)
-    print("Generated Assembly Code:")
-    print(assembly_code)
+    # Step 2: Lexical Analysis and Parsing. Tokens are scanned as the parser
+    # consumes them, so the two run as one stage.
+    with metrics.stage('parser') as counts:
+        parser = Parser(tokenize(source_code))
+        ast = parser.parse()
+        counts['tokens'] = parser.tokens.count
+        counts['nodes'] = count_nodes(ast)
+    if args.verbose:
+        print("Tokens:")
+        for token in tokenize(source_code):
+            print(token)
+        print("\nAbstract Syntax Tree (AST):")
+        print(ast)
+
+    # Step 3: Generate Assembly
+    profile = None
+    if args.pgo:
+        codegen, program, _ = build(ast, metrics, instrument=True, stage_prefix="pgo ")
+        with metrics.stage('pgo run') as counts:
+            profile = profile_counts(render(program), codegen.markers, load_script(args.pgo))
+            counts['statements'] = len(profile)
+    # Methods unchanged since the last build reuse its code; PGO builds are not cached
+    cache = None if args.pgo else CodeCache(cache_file, fresh=args.fresh)
+    codegen, program, unoptimized = build(ast, metrics, profile, cache=cache)
+    if cache:
+        cache.save()
+        print(cache.summary())
+    assembly_code = render(program)
+    if args.verbose:
+        print("\nGenerated Assembly Code:")
+        print(assembly_code)
+    print(codegen.layout.report())
+    print(format_rom_report(rom_usage(program)))
 
     with open(asm_file, 'w') as f:
         f.write(assembly_code)
 
-    # Step 5: Assemble to Machine Code
-    print("\nStep 5: Assemble to Machine Code")
-    assemble(asm_file, mc_file)
+    # The optimized program must end with the same RAM as the generated one.
+    # C# has no port access, so input streams make no difference and one run
+    # of each covers every input.
+    if not args.no_validate:
+        with metrics.stage('validate') as counts:
+            result = validate(unoptimized, assembly_code, count=0)
+            counts['streams'] = result['runs']
+        if result['divergence']:
+            sys.exit(format_validation(result))
+        print(format_validation(result))
+
+    # Static cycle costs and call depth, written next to the assembly
+    with metrics.stage('analysis') as counts:
+        cost = analyze_assembly(assembly_code)
+        counts['routines'] = len(cost)
+    with open(analysis_file, 'w') as f:
+        f.write(format_report(cost) + "\n")
+    print(format_summary(cost))
 
-    # Step 6: Generate Schematic
-    print("\nStep 6: Generate Schematic")
-    make_schematic(mc_file, schematic_file)
+    # Step 4: Assemble to Machine Code
+    with metrics.stage('assemble'):
+        assemble(asm_file, mc_file)
+
+    # Step 5: Generate Schematic
+    with metrics.stage('schematic'):
+        make_schematic(mc_file, schematic_file)
     print(f"Schematic generated: {schematic_file}")
 
+    if args.timing or args.memory:
+        print(metrics.format_report())
+    if args.report:
+        metrics.write_report(args.report)
+    for path in metrics.write_profiles():
+        print(f"Profile written: {path}")
+
 if __name__ == "__main__":
     main()
@@ -1,57 +1,128 @@
+import argparse
 import logging
+import sys
 from pathlib import Path
 from compilerVSC.lexer import tokenize
 from compilerVSC.parser import Parser, Program
 from compilerVSC.codegen import CodeGenerator
 from assembler import assemble
+from optimizer import parse, render, optimize, rom_usage, format_rom_report
+from emulator import load_script, profile_counts
+from codecache import CodeCache
+from analysis import analyze_assembly, format_report, format_summary
+from validate import validate, format_validation
+from instrument import Instrumentation, count_nodes, add_arguments
 from schematic import make_schematic
 
 loaded_files = set()
 
-def process_file(file_path: Path, ast_root):
+def process_file(file_path: Path, namespaces: list, metrics=None):
+    # Appends the namespaces of the file and its imports, imports first
     if file_path in loaded_files:
         return
     loaded_files.add(file_path)
+    metrics = metrics or Instrumentation()
 
     logging.info(f"Processing: {file_path}")
     source = file_path.read_text(encoding='utf-8-sig')
-    tokens = tokenize(source)
-
-    # Handle import "file.vsc";
-    i = 0
-    while i < len(tokens):
-        if tokens[i] == ('KEYWORD', 'import') and tokens[i+1][0] == 'STRING':
-            imported_filename = tokens[i+1][1].strip('"')
-            imported_path = file_path.parent / imported_filename
-            process_file(imported_path, ast_root)
-            i += 2
-        else:
-            i += 1
-
-    parsed = Parser(tokens).parse()
-    ast_root.namespaces.extend(parsed.namespaces)
+    # The lexer runs lazily inside the parser, so both are timed as one stage
+    with metrics.stage('parser') as counts:
+        parser = Parser(tokenize(source))
+        parsed = parser.parse()
+        counts['tokens'] = parser.tokens.count
+        counts['nodes'] = count_nodes(parsed)
+
+    # Handle import "file.vsc"; imported code comes before the importing file
+    for imported_filename in parsed.imports:
+        process_file(file_path.parent / imported_filename, namespaces, metrics)
+    namespaces.extend(parsed.namespaces)
+
+def build(ast_root, metrics, profile=None, instrument=False, stage_prefix="", cache=None):
+    with metrics.stage(f"{stage_prefix}codegen") as counts:
+        codegen = CodeGenerator(profile=profile, instrument=instrument, cache=cache)
+        assembly_code = codegen.generate(ast_root)
+        counts['lines'] = len(assembly_code.splitlines())
+    # Drop routines unreachable from .Main_main and compares whose flags are already known
+    with metrics.stage(f"{stage_prefix}optimize") as counts:
+        program = optimize(parse(assembly_code))
+        counts['instructions'] = rom_usage(program)['total']
+    return codegen, program, assembly_code
 
 def main():
-    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Compile a VortexScript program to a schematic")
+    parser.add_argument('program', nargs='?', default="main", help="file name in VortexScript/ without extension")
+    # Recorded controller_input/rng script, e.g. VortexScript/main.script.json. A first build
+    # runs on the emulator and its execution counts guide the real build.
+    parser.add_argument('--pgo', metavar='SCRIPT', help="optimize for a run of this input script")
+    parser.add_argument('--fresh', action='store_true', help="ignore the code cache of the previous build")
+    parser.add_argument('--no-validate', action='store_true', help="skip checking the optimized program against the unoptimized one")
+    add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(message)s")
+    metrics = Instrumentation(trace_memory=args.memory, profile_dir=args.cprofile)
 
     base_path = Path("VortexScript")
-    program_name = "main" # Replace with your desired filename (without extension)
+    program_name = args.program
     main_file = base_path / f"{program_name}.vsc"
     asm_file = base_path / f"{program_name}.as"
     mc_file = base_path / f"{program_name}.mc"
+    analysis_file = base_path / f"{program_name}.analysis.txt"
+    cache_file = base_path / f"{program_name}.cache.json"
     schematic_file = base_path / f"{program_name}.schem"
 
-    full_ast = Program()
-    process_file(main_file, full_ast)
+    namespaces = []
+    process_file(main_file, namespaces, metrics)
+    full_ast = Program(namespaces)
 
-    codegen = CodeGenerator()
-    assembly_code = codegen.generate(full_ast)
-    logging.info("Generated Assembly:\n" + assembly_code)
+    profile = None
+    if args.pgo:
+        codegen, program, _ = build(full_ast, metrics, instrument=True, stage_prefix="pgo ")
+        with metrics.stage('pgo run') as counts:
+            profile = profile_counts(render(program), codegen.markers, load_script(args.pgo))
+            counts['statements'] = len(profile)
+    # Methods unchanged since the last build reuse its code; PGO builds are not cached
+    cache = None if args.pgo else CodeCache(cache_file, fresh=args.fresh)
+    codegen, program, unoptimized = build(full_ast, metrics, profile, cache=cache)
+    if cache:
+        cache.save()
+        logging.info(cache.summary())
+    assembly_code = render(program)
+    logging.debug("Generated Assembly:\n" + assembly_code)
+    logging.info(codegen.layout.report())
+    logging.info(format_rom_report(rom_usage(program)))
     asm_file.write_text(assembly_code, encoding='utf-8')
 
-    assemble(asm_file, mc_file)
-    make_schematic(mc_file, schematic_file)
+    # The optimized program must make the same port writes as the generated
+    # one, on the recorded input scripts and on random input
+    if not args.no_validate:
+        script_paths = {Path(path) for path in [args.pgo, base_path / f"{program_name}.script.json"] if path and Path(path).exists()}
+        scripts = [(str(path), load_script(path)) for path in sorted(script_paths)]
+        with metrics.stage('validate') as counts:
+            result = validate(unoptimized, assembly_code, scripts)
+            counts['streams'] = result['runs']
+        if result['divergence']:
+            sys.exit(format_validation(result))
+        logging.info(format_validation(result))
+
+    # Static cycle costs and call depth, written next to the assembly
+    with metrics.stage('analysis') as counts:
+        cost = analyze_assembly(assembly_code)
+        counts['routines'] = len(cost)
+    analysis_file.write_text(format_report(cost) + "\n", encoding='utf-8')
+    logging.info(format_summary(cost))
+
+    with metrics.stage('assemble'):
+        assemble(asm_file, mc_file)
+    with metrics.stage('schematic'):
+        make_schematic(mc_file, schematic_file)
     logging.info(f"Schematic generated: {schematic_file}")
 
+    if args.timing or args.memory:
+        logging.info(metrics.format_report())
+    if args.report:
+        metrics.write_report(args.report)
+    for path in metrics.write_profiles():
+        logging.info(f"Profile written: {path}")
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,94 @@
+# Data memory layout shared by both compilers.
+#
+# LOD/STR take a base register plus a signed 4-bit offset (-8..7), so a
+# variable can be reached in a single instruction only if its address is
+# within 8 bytes of a register that already holds a known base. r0 is always
+# zero and reaches 0..7; r13 is pinned to 16 at program start and reaches
+# 8..23. The most frequently accessed variables are placed in those windows,
+# everything else goes above them and needs an LDI of its address first.
+#
+# A layout from an earlier build can be passed to plan(): names still in use
+# keep their addresses, so editing one method does not move the data of the
+# others. Only new names are placed, the hottest into free window slots.
+
+RAM_SIZE = 240  # 240-255 are the memory-mapped ports
+
+PINNED_BASES = [('r0', 0), ('r13', 16)]
+
+class DataLayout:
+    def __init__(self):
+        self.addresses = {}  # name -> address
+        self.sizes = {}      # name -> bytes
+        self.windows = []    # (base register, base address, first address, last address)
+        self.occupied = set()
+        first = 0
+        for reg, base in PINNED_BASES:
+            self.windows.append((reg, base, first, base + 7))
+            first = base + 8
+        self.heap_start = first
+
+    def plan(self, access_counts, buffers=None, previous=None):
+        # access_counts: name -> estimated number of loads and stores
+        # buffers: name -> size, for strings and arrays that never go in a window
+        # previous: name -> (address, size) from an earlier build, or None
+        buffers = buffers or {}
+        for name, (address, size) in (previous or {}).items():
+            if (name in access_counts or name in buffers) and size == buffers.get(name, 1) and self.is_free(address, size):
+                self.place(name, address, size)
+        slots = [address for _, _, first, last in self.windows for address in range(first, last + 1)
+                 if self.is_free(address)]
+        hot = sorted((name for name in access_counts if name not in buffers and name not in self.addresses),
+                     key=lambda name: -access_counts[name])
+        for name, address in zip(hot, slots):
+            self.place(name, address)
+        for name in hot[len(slots):]:
+            self.allocate(name)
+        for name, size in buffers.items():
+            self.allocate(name, size)
+
+    def allocate(self, name, size=1):
+        # First free run of size bytes above the windows
+        if name not in self.addresses:
+            address = self.heap_start
+            while not self.is_free(address, size):
+                if address + size > RAM_SIZE:
+                    raise ValueError(f"Out of data memory allocating {name} ({size} bytes)")
+                address += 1
+            self.place(name, address, size)
+        return self.addresses[name]
+
+    def place(self, name, address, size=1):
+        self.addresses[name] = address
+        self.sizes[name] = size
+        self.occupied.update(range(address, address + size))
+
+    def is_free(self, address, size=1):
+        return 0 <= address and address + size <= RAM_SIZE and self.occupied.isdisjoint(range(address, address + size))
+
+    def assignments(self):
+        # name -> (address, size), the form plan() takes as previous
+        return {name: (address, self.sizes[name]) for name, address in self.addresses.items()}
+
+    def access(self, address):
+        # (base register, offset) reaching the address in one LOD/STR, or None
+        for reg, base, first, last in self.windows:
+            if first <= address <= last:
+                return reg, address - base
+        return None
+
+    def pinned_registers(self):
+        # Base registers that need initialising at program start, with their values
+        used = {self.access(address)[0] for address in self.addresses.values() if self.access(address)}
+        return [(reg, base) for reg, base in PINNED_BASES if reg in used and reg != 'r0']
+
+    def used(self):
+        return sum(self.sizes.values())
+
+    def report(self):
+        in_window = sum(1 for address in self.addresses.values() if self.access(address))
+        lines = [f"RAM usage: {self.used()}/{RAM_SIZE} bytes, {in_window} of {len(self.addresses)} variables in single-instruction range"]
+        for name, address in sorted(self.addresses.items(), key=lambda item: item[1]):
+            reach = self.access(address)
+            where = f"{reach[0]}{reach[1]:+d}" if reach else "ldi"
+            lines.append(f"  {address:>3} {name:<24} {self.sizes[name]:>3}  {where}")
+        return "\n".join(lines)
@@ -0,0 +1,53 @@
+# Base class for the AST nodes of both front ends.
+#
+# Nodes are slotted, so they carry no per-instance __dict__, and immutable
+# once built; child lists are stored as tuples. Equality and hashing stay by
+# identity, since profiles and unroll plans key on the node itself and two
+# identical statements in different places must stay distinct. Every node
+# type has an interned `kind` tag, its class name.
+
+import sys
+
+class Node:
+    __slots__ = ()
+    kind = sys.intern('Node')
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.kind = sys.intern(cls.__name__)
+
+    def __init__(self, *values):
+        # Values in __slots__ order
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self.kind} nodes are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{self.kind} nodes are immutable")
+
+    def __reduce__(self):
+        # Rebuild through __init__, whose arguments follow __slots__
+        return type(self), tuple(getattr(self, name) for name in self.__slots__)
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{self.kind}({fields})"
+
+def fingerprint(value):
+    # The structure of a tree as nested tuples of kinds and values, without
+    # identities: two trees that generate the same code have equal fingerprints
+    if isinstance(value, Node):
+        return (value.kind,) + tuple(fingerprint(getattr(value, name)) for name in value.__slots__)
+    if isinstance(value, (list, tuple)):
+        return tuple(fingerprint(item) for item in value)
+    return value
+
+def strings(value):
+    # Every string in a tree: names, operators and literals
+    if isinstance(value, Node):
+        value = tuple(getattr(value, name) for name in value.__slots__)
+    if isinstance(value, (list, tuple)):
+        return set().union(*map(strings, value))
+    return {value} if isinstance(value, str) else set()
@@ -0,0 +1,662 @@
+# Whole-program passes over assembly source.
+#
+# A program is a list of word lists, one per line, in the same form the
+# assembler works with: comments and blank lines removed, and a label that
+# shares a line with an instruction split onto its own line. Words keep their
+# original case; opcodes and labels are compared in lowercase like the
+# assembler does.
+
+import json
+from pathlib import Path
+from assembler import CONDITIONS, PORTS, PORT_BASE, CHARACTERS, REGISTERS, resolve_pseudo_instruction
+
+ROM_SIZE = 1024
+
+def parse(source):
+    if isinstance(source, str):
+        source = source.splitlines()
+    lines = (line.strip() for line in source)
+    for comment_symbol in ['/', ';', '#']:
+        lines = [line.split(comment_symbol)[0] for line in lines]
+
+    program = []
+    for line in lines:
+        words = line.split()
+        if not words:
+            continue
+        if is_label(words) and len(words) > 1:
+            program.append(words[:1])
+            program.append(words[1:])
+        else:
+            program.append(words)
+    return program
+
+def render(program):
+    return "\n".join(" ".join(words) for words in program)
+
+def opcode(words):
+    return words[0].lower()
+
+def is_label(words):
+    return words[0][0] == '.'
+
+def is_definition(words):
+    return opcode(words) == 'define'
+
+def is_instruction(words):
+    return not is_label(words) and not is_definition(words)
+
+def branch_target(words):
+    # Label operand of a jmp/brh/cal, or None
+    if opcode(words) in ['jmp', 'brh', 'cal'] and is_label(words[-1:]):
+        return words[-1].lower()
+    return None
+
+def label_indices(program):
+    return {words[0].lower(): index for index, words in enumerate(program) if is_label(words)}
+
+def data_labels(program):
+    # Labels used as plain operands (e.g. LDI r1 .table) rather than as branch targets
+    labels = set()
+    for words in program:
+        if is_instruction(words):
+            operands = words[1:-1] if branch_target(words) else words[1:]
+            labels.update(word.lower() for word in operands if word[0] == '.')
+    return labels
+
+def successors(program, index, labels):
+    words = program[index]
+    if not is_instruction(words):
+        return [index + 1]
+    op = opcode(words)
+    target = labels.get(branch_target(words))
+    if op == 'jmp':
+        return [target] if target is not None else []
+    if op in ['brh', 'cal']:
+        return [index + 1] + ([target] if target is not None else [])
+    if op in ['ret', 'hlt']:
+        return []
+    return [index + 1]
+
+def reachable(program):
+    # Indices reachable from the first line, following fall-through, jumps,
+    # branches and calls. Labels used as data are treated as extra roots.
+    labels = label_indices(program)
+    pending = [0] + [labels[label] for label in data_labels(program) if label in labels]
+    seen = set()
+    while pending:
+        index = pending.pop()
+        if index in seen or index >= len(program):
+            continue
+        seen.add(index)
+        pending.extend(successors(program, index, labels))
+    return seen
+
+def optimize(program):
+    program = eliminate_dead_code(program)
+    program = eliminate_redundant_compares(program)
+    program = apply_rewrites(program)
+    # Branches resolved by the flags pass can leave more code unreachable
+    return eliminate_dead_code(program)
+
+def eliminate_dead_code(program):
+    live = reachable(program)
+    kept = [index for index, words in enumerate(program)
+            if not is_instruction(words) or index in live]
+    referenced = data_labels(program)
+    for index in kept:
+        if is_instruction(program[index]) and branch_target(program[index]):
+            referenced.add(branch_target(program[index]))
+
+    result = []
+    for index in kept:
+        words = program[index]
+        if is_label(words):
+            # Keep labels still jumped to, or that still name live code
+            following = next((i for i in range(index + 1, len(program)) if is_instruction(program[i])), None)
+            if words[0].lower() not in referenced and following not in live:
+                continue
+        result.append(words)
+    return result
+
+def rom_usage(program):
+    # Instruction words per routine. Routines start at the entry point and at
+    # every call target; everything up to the next routine is counted against it.
+    calls = {branch_target(words) for words in program
+             if is_instruction(words) and opcode(words) == 'cal'}
+    routine = '(entry)'
+    routines = {routine: 0}
+    for words in program:
+        if is_label(words) and words[0].lower() in calls:
+            routine = words[0]
+            routines.setdefault(routine, 0)
+        elif is_instruction(words):
+            routines[routine] += 1
+    return {'total': sum(routines.values()), 'limit': ROM_SIZE, 'routines': routines}
+
+def format_rom_report(usage):
+    total, limit = usage['total'], usage['limit']
+    lines = [f"ROM usage: {total}/{limit} words ({100 * total / limit:.1f}%)"]
+    for name, size in sorted(usage['routines'].items(), key=lambda item: -item[1]):
+        lines.append(f"  {name:<24} {size:>5}")
+    if total > limit:
+        lines.append(f"WARNING: program exceeds ROM by {total - limit} words")
+    return "\n".join(lines)
+
+# Flag-aware compare elimination
+#
+# ADD, SUB, NOR, AND, XOR and ADI set the Z and C flags; everything else leaves
+# them alone. A forward pass tracks facts about what the flags currently say:
+#   ('cmp', a, b)     flags are exactly those of a - b
+#   ('zero', r)       Z is set iff r == 0
+#   ('carry',)        C is set (anything minus r0 never borrows)
+#   ('mem', off, r)   RAM[off] == r, for the r0-relative addresses 0..7
+# and a backward pass tracks which flags are still going to be read. A compare
+# is dropped when the facts already give the flags its branches read, or when
+# nothing reads its flags at all.
+
+FLAG_SETTERS = ['add', 'sub', 'nor', 'and', 'xor', 'adi']
+
+def base_instruction(words):
+    return resolve_pseudo_instruction([word.lower() for word in words])
+
+def condition_index(word):
+    for conditions in CONDITIONS:
+        if word.lower() in conditions:
+            return conditions.index(word.lower())
+    return None
+
+def condition_flag(word):
+    index = condition_index(word)
+    if index is None:
+        return None
+    return 'z' if index < 2 else 'c'
+
+def written_register(ins):
+    op = ins[0]
+    if op in ['add', 'sub', 'nor', 'and', 'xor', 'rsh']:
+        reg = ins[-1]
+    elif op in ['ldi', 'adi']:
+        reg = ins[1]
+    elif op == 'lod':
+        reg = ins[2]
+    else:
+        return None
+    return None if reg == 'r0' else reg
+
+def is_compare(ins):
+    return ins[0] == 'sub' and len(ins) == 4 and ins[3] == 'r0'
+
+def mem_offset(ins):
+    # Offset of an r0-relative lod/str that can only touch ordinary RAM
+    if ins[0] in ['lod', 'str'] and ins[1] == 'r0':
+        offset = ins[3] if len(ins) == 4 else '0'
+        if offset.lstrip('-').isdigit() and 0 <= int(offset) <= 7:
+            return int(offset)
+    return None
+
+def copy_facts(facts, source, dest):
+    # Facts about source also hold for dest once dest is a copy of it
+    return {tuple(dest if part == source else part for part in fact)
+            for fact in facts if source in fact[1:]}
+
+def transfer_facts(facts, words):
+    if not is_instruction(words):
+        return facts
+    ins = base_instruction(words)
+    op = ins[0]
+    if op == 'cal':
+        return frozenset()
+    dest = written_register(ins)
+    facts = set(facts)
+    copied = set()
+    if op == 'lod' and dest and mem_offset(ins) is not None:
+        offset = mem_offset(ins)
+        copied = {('mem', offset, dest)}
+        for fact in facts:
+            if fact[0] == 'mem' and fact[1] == offset and fact[2] != dest:
+                copied |= copy_facts(facts, fact[2], dest)
+    if op == 'str':
+        offset = mem_offset(ins)
+        facts = {fact for fact in facts if fact[0] != 'mem' or (offset is not None and fact[1] != offset)}
+        if offset is not None:
+            facts.add(('mem', offset, ins[2]))
+    if op in FLAG_SETTERS:
+        facts = {fact for fact in facts if fact[0] == 'mem'}
+    if dest:
+        facts = {fact for fact in facts if dest not in fact[1:]}
+    if op in ['add', 'sub', 'nor', 'and', 'xor']:
+        a, b, c = ins[1:4]
+        if dest:
+            facts.add(('zero', dest))
+        if op == 'sub' and (c == 'r0' or c not in (a, b)):
+            facts.add(('cmp', a, b))
+        if op == 'sub' and b == 'r0':
+            facts.add(('carry',))
+        if op == 'add' and b == 'r0' and dest and a != dest:
+            facts.add(('zero', a))
+            copied |= copy_facts(facts, a, dest)
+    elif op == 'adi' and dest:
+        facts.add(('zero', dest))
+    return frozenset(facts | copied)
+
+def flag_facts(program):
+    labels = label_indices(program)
+    facts = [None] * len(program)
+    entries = [0] + [labels[label] for label in data_labels(program) if label in labels]
+    for index in entries:
+        if index < len(program):
+            facts[index] = frozenset()
+    pending = [index for index in entries if index < len(program)]
+    while pending:
+        index = pending.pop()
+        out = transfer_facts(facts[index], program[index])
+        for successor in successors(program, index, labels):
+            if successor >= len(program):
+                continue
+            merged = out if facts[successor] is None else facts[successor] & out
+            if merged != facts[successor]:
+                facts[successor] = merged
+                pending.append(successor)
+    return facts
+
+def flag_liveness(program):
+    # Flags each line may read before they are next written. A ret reads
+    # whatever any return site reads, since flags survive the return.
+    labels = label_indices(program)
+    return_sites = [index + 1 for index, words in enumerate(program)
+                    if is_instruction(words) and opcode(words) == 'cal' and index + 1 < len(program)]
+    live = [set() for _ in program]
+    changed = True
+    while changed:
+        changed = False
+        for index in range(len(program) - 1, -1, -1):
+            words = program[index]
+            out = set()
+            for successor in successors(program, index, labels):
+                if successor < len(program):
+                    out |= live[successor]
+            if is_instruction(words):
+                ins = base_instruction(words)
+                if ins[0] in FLAG_SETTERS:
+                    out = set()
+                if ins[0] == 'ret':
+                    for site in return_sites:
+                        out |= live[site]
+                elif ins[0] == 'brh':
+                    out.add(condition_flag(ins[1]))
+            if out != live[index]:
+                live[index] = out
+                changed = True
+    return live
+
+def live_after(program, index, live, labels):
+    out = set()
+    for successor in successors(program, index, labels):
+        if successor < len(program):
+            out |= live[successor]
+    return out
+
+def eliminate_redundant_compares(program):
+    program = [list(words) for words in program]
+    changed = True
+    while changed:
+        changed = (remove_known_compares(program) or resolve_known_branches(program)
+                   or swap_zero_compares(program) or remove_dead_compares(program))
+        program = [words for words in program if words]
+    return program
+
+def remove_known_compares(program):
+    # The flags already hold what this compare would compute. When only Z
+    # matches, later facts derived from the full compare no longer hold, so
+    # stop after one such removal and let the analysis run again.
+    facts, live, labels = flag_facts(program), flag_liveness(program), label_indices(program)
+    changed = False
+    for index, words in enumerate(program):
+        if not is_instruction(words) or facts[index] is None:
+            continue
+        ins = base_instruction(words)
+        if not is_compare(ins):
+            continue
+        a, b = ins[1], ins[2]
+        if ('cmp', a, b) in facts[index]:
+            program[index] = []
+            changed = True
+        elif 'c' not in live_after(program, index, live, labels) and (
+                ('cmp', b, a) in facts[index] or (b == 'r0' and ('zero', a) in facts[index])):
+            program[index] = []
+            return True
+    return changed
+
+def resolve_known_branches(program):
+    # With C known to be set, "ge" always branches and "lt" never does
+    facts = flag_facts(program)
+    changed = False
+    for index, words in enumerate(program):
+        if not is_instruction(words) or facts[index] is None or ('carry',) not in facts[index]:
+            continue
+        ins = base_instruction(words)
+        if ins[0] == 'brh' and condition_index(ins[1]) == 2:
+            program[index] = ['jmp', words[-1]]
+            changed = True
+        elif ins[0] == 'brh' and condition_index(ins[1]) == 3:
+            program[index] = []
+            changed = True
+    return changed
+
+def swap_zero_compares(program):
+    # cmp r0 x sets C exactly when x == 0, so branches on C can test Z of
+    # cmp x r0 instead, which earlier arithmetic on x may already provide
+    live, labels = flag_liveness(program), label_indices(program)
+    changed = False
+    for index, words in enumerate(program):
+        if not is_instruction(words):
+            continue
+        ins = base_instruction(words)
+        if not is_compare(ins) or ins[1] != 'r0' or ins[2] == 'r0':
+            continue
+        branches = []
+        after = index + 1
+        while after < len(program) and is_instruction(program[after]) and opcode(program[after]) == 'brh':
+            branches.append(after)
+            after += 1
+        targets = [labels.get(branch_target(program[branch])) for branch in branches]
+        if (not branches or None in targets
+                or any(condition_flag(program[branch][1]) != 'c' for branch in branches)
+                or any(live[target] for target in targets)
+                or (after < len(program) and live[after])):
+            continue
+        program[index] = [words[0], ins[2], 'r0']
+        for branch in branches:
+            program[branch] = [program[branch][0], 'eq' if condition_index(program[branch][1]) == 2 else 'ne', program[branch][2]]
+        changed = True
+    return changed
+
+def remove_dead_compares(program):
+    live, labels = flag_liveness(program), label_indices(program)
+    changed = False
+    for index, words in enumerate(program):
+        if is_instruction(words) and is_compare(base_instruction(words)) and not live_after(program, index, live, labels):
+            program[index] = []
+            changed = True
+    return changed
+
+# Superoptimizer rewrites
+#
+# superopt.py searches offline for shorter equivalents of straight-line
+# register-only sequences and stores them in superopt.json. A sequence is
+# looked up with its registers renamed r1, r2, ... in order of first use and
+# its immediates resolved to 0..255, so one entry covers every register
+# assignment. An entry may only hold when the flags, or some registers the
+# sequence writes, are not read afterwards.
+
+REWRITE_DATABASE = Path(__file__).with_name('superopt.json')
+REWRITE_OPCODES = ['add', 'sub', 'nor', 'and', 'xor', 'rsh', 'ldi', 'adi']
+REWRITE_MAX_REGISTERS = 3
+
+def load_rewrites(path=REWRITE_DATABASE):
+    # pattern key -> entries, shortest replacement first; no database, no rewrites
+    try:
+        with open(path, 'r') as f:
+            entries = json.load(f)['rewrites']
+    except FileNotFoundError:
+        return {}
+    database = {}
+    for entry in sorted(entries, key=lambda entry: len(entry['replacement'])):
+        database.setdefault(tuple(entry['pattern']), []).append(entry)
+    return database
+
+def definitions(program):
+    return {words[1].lower(): int(words[2], 0) for words in program if is_definition(words)}
+
+def immediate_value(word, symbols=None):
+    # An immediate as the 8-bit value the hardware sees, or None if unknown
+    word = word.lower()
+    if word[0] in '-0123456789':
+        return int(word, 0) & 255
+    if word in PORTS:
+        return PORTS.index(word) + PORT_BASE
+    if len(word) == 3 and word[0] == word[2] and word[0] in '\'"' and word[1] in CHARACTERS:
+        return CHARACTERS.index(word[1])
+    if symbols and word in symbols:
+        return symbols[word] & 255
+    return None
+
+def canonical_sequence(instructions, symbols=None):
+    # (pattern, renaming) for base instructions that only touch registers,
+    # where renaming maps each canonical register back to the real one
+    renaming = {'r0': 'r0'}
+    pattern = []
+    for ins in instructions:
+        op = ins[0]
+        if op not in REWRITE_OPCODES or len(ins) != (4 if op in ['add', 'sub', 'nor', 'and', 'xor'] else 3):
+            return None
+        operands = []
+        for position, word in enumerate(ins[1:]):
+            if op in ['ldi', 'adi'] and position == 1:
+                value = immediate_value(word, symbols)
+                if value is None:
+                    return None
+                operands.append(str(value))
+            elif word in REGISTERS:
+                renaming.setdefault(word, f"r{len(renaming)}")
+                operands.append(renaming[word])
+            else:
+                return None
+        pattern.append(" ".join([op] + operands))
+    if len(renaming) - 1 > REWRITE_MAX_REGISTERS:
+        return None
+    return tuple(pattern), {canonical: real for real, canonical in renaming.items()}
+
+def register_effects(ins):
+    # (registers read, registers written) by a base instruction
+    op = ins[0]
+    if op in ['add', 'sub', 'nor', 'and', 'xor']:
+        return {ins[1], ins[2]}, {ins[3]}
+    if op == 'rsh':
+        return {ins[1]}, {ins[2]}
+    if op == 'ldi':
+        return set(), {ins[1]}
+    if op == 'adi':
+        return {ins[1]}, {ins[1]}
+    if op == 'lod':
+        return {ins[1]}, {ins[2]}
+    if op == 'str':
+        return {ins[1], ins[2]}, set()
+    return set(), set()
+
+def register_liveness(program):
+    # Registers each line may read before they are next written. As with the
+    # flags, a cal reads what its callee and its return site read, and a ret
+    # reads whatever any return site reads.
+    labels = label_indices(program)
+    return_sites = [index + 1 for index, words in enumerate(program)
+                    if is_instruction(words) and opcode(words) == 'cal' and index + 1 < len(program)]
+    live = [set() for _ in program]
+    changed = True
+    while changed:
+        changed = False
+        for index in range(len(program) - 1, -1, -1):
+            words = program[index]
+            out = live_after(program, index, live, labels)
+            if is_instruction(words):
+                ins = base_instruction(words)
+                if ins[0] == 'ret':
+                    for site in return_sites:
+                        out |= live[site]
+                reads, writes = register_effects(ins)
+                out = (out - writes) | reads
+            out.discard('r0')
+            if out != live[index]:
+                live[index] = out
+                changed = True
+    return live
+
+def apply_rewrites(program, database=None):
+    # Replace sequences found in the rewrite database, longest pattern first,
+    # one at a time since each rewrite can change what is live around it
+    database = load_rewrites() if database is None else database
+    if not database:
+        return program
+    longest = max(len(pattern) for pattern in database)
+    symbols = definitions(program)
+    while True:
+        rewrite = find_rewrite(program, database, longest, symbols)
+        if rewrite is None:
+            return program
+        index, length, replacement = rewrite
+        program = program[:index] + replacement + program[index + length:]
+
+def find_rewrite(program, database, longest, symbols):
+    flags_live, registers_live = flag_liveness(program), register_liveness(program)
+    labels = label_indices(program)
+    for index in range(len(program)):
+        for length in range(longest, 1, -1):
+            window = program[index:index + length]
+            if len(window) < length or not all(is_instruction(words) for words in window):
+                continue
+            canonical = canonical_sequence([base_instruction(words) for words in window], symbols)
+            if canonical is None or canonical[0] not in database:
+                continue
+            pattern, renaming = canonical
+            last = index + length - 1
+            flags_after = live_after(program, last, flags_live, labels)
+            registers_after = live_after(program, last, registers_live, labels)
+            for entry in database[pattern]:
+                if entry['flags_dead'] and flags_after:
+                    continue
+                if any(renaming[reg] in registers_after for reg in entry['dead']):
+                    continue
+                replacement = [[word if word not in renaming else renaming[word] for word in line.split()]
+                               for line in entry['replacement']]
+                return index, length, replacement
+    return None
+
+# Jump threading for hand-written assembly
+#
+# Rewrites that only touch control flow, for .as files written by hand (see
+# `assembler.py --optimize`):
+#   - a jmp, brh or cal whose target starts with a jmp goes straight to where
+#     the chain ends, and a jmp to a ret or hlt becomes that instruction,
+#   - a jmp or brh to the very next instruction is dropped,
+#   - "brh c .a / jmp .b / .a" becomes "brh !c .b / .a",
+#   - code no path reaches is dropped.
+# The value of a label is its pc, so a label used as data (LDI r1 .table)
+# must keep its value: nothing before the last such label is removed, and
+# retargeting, which never changes sizes, is all that happens there. A jump
+# to a number or a define can land anywhere, so such programs only get
+# retargeted. Definitions take no space and are left alone.
+
+def thread_jumps(program):
+    # (program, rewrites), each rewrite a line describing what changed where
+    program = [list(words) for words in program]
+    rewrites = []
+    while True:
+        labels, first, where = label_indices(program), first_removable(program), locations(program)
+        changed = False
+        for index, words in enumerate(program):
+            if words and is_instruction(words):
+                rewrite = (retarget(program, index, labels)
+                           or (index >= first and (drop_fall_through(program, index, labels)
+                                                  or invert_branch_over_jump(program, index, labels))))
+                if rewrite:
+                    rewrites.append(f"{where[index]}: {rewrite}")
+                    changed = True
+        program = [words for words in program if words]
+        first = first_removable(program)
+        if first < len(program):
+            live, where = reachable(program), locations(program)
+            for index, words in enumerate(program):
+                if is_instruction(words) and index >= first and index not in live:
+                    rewrites.append(f"{where[index]}: dropped unreachable {' '.join(words)}")
+                    program[index] = []
+                    changed = True
+            program = [words for words in program if words]
+        if not changed:
+            return program, rewrites
+
+def first_removable(program):
+    # Index of the first line whose removal keeps every label value that matters:
+    # past the last label used as data, or none at all if a jump goes to a number
+    if any(is_instruction(words) and opcode(words) in ['jmp', 'brh', 'cal'] and branch_target(words) is None
+           for words in program):
+        return len(program)
+    labels = label_indices(program)
+    return max([labels[label] + 1 for label in data_labels(program) if label in labels], default=0)
+
+def next_instruction(program, index):
+    # Index of the first instruction at or after index, or None
+    for following in range(index, len(program)):
+        if program[following] and is_instruction(program[following]):
+            return following
+    return None
+
+def retarget(program, index, labels):
+    words = program[index]
+    target = branch_target(words)
+    if target not in labels:
+        return None
+    final, seen = words[-1], {target}
+    landing = next_instruction(program, labels[target])
+    while landing is not None and opcode(program[landing]) == 'jmp':
+        following = branch_target(program[landing])
+        if following not in labels or following in seen:
+            break
+        final = program[landing][-1]
+        seen.add(following)
+        landing = next_instruction(program, labels[following])
+    old = " ".join(words)
+    if opcode(words) == 'jmp' and landing is not None and opcode(program[landing]) in ['ret', 'hlt']:
+        program[index] = list(program[landing])
+    elif final.lower() != target:
+        program[index] = words[:-1] + [final]
+    else:
+        return None
+    return f"{old} -> {' '.join(program[index])}"
+
+def drop_fall_through(program, index, labels):
+    words = program[index]
+    target = branch_target(words)
+    if opcode(words) not in ['jmp', 'brh'] or target not in labels:
+        return None
+    if labels[target] <= index or next_instruction(program, index + 1) != next_instruction(program, labels[target]):
+        return None
+    program[index] = []
+    return f"dropped {' '.join(words)} to the next instruction"
+
+def invert_branch_over_jump(program, index, labels):
+    words = program[index]
+    target = branch_target(words)
+    if opcode(words) != 'brh' or target not in labels or index + 1 >= len(program):
+        return None
+    jump = program[index + 1]
+    # The jmp must directly follow, with no label that would make it a target itself
+    if not jump or not is_instruction(jump) or opcode(jump) != 'jmp' or branch_target(jump) is None:
+        return None
+    if labels[target] <= index + 1 or next_instruction(program, index + 2) != next_instruction(program, labels[target]):
+        return None
+    inverted = invert_condition(words[1])
+    if inverted is None:
+        return None
+    old = f"{' '.join(words)} / {' '.join(jump)}"
+    program[index] = [words[0], inverted, jump[-1]]
+    program[index + 1] = []
+    return f"{old} -> {' '.join(program[index])}"
+
+def invert_condition(word):
+    # The opposite condition, spelled the same way as word
+    for conditions in CONDITIONS:
+        if word.lower() in conditions:
+            return conditions[conditions.index(word.lower()) ^ 1]
+    return None
+
+def locations(program):
+    # For each line, the nearest label above it and how many instructions past it
+    names, label, offset = [], "(start)", 0
+    for words in program:
+        names.append(f"{label}+{offset}")
+        if words and is_label(words):
+            label, offset = words[0], 0
+        elif words and is_instruction(words):
+            offset += 1
+    return names
@@ -0,0 +1,12 @@
+void B(int x) {
+    int y = x + 1;
+    B(y);
+}
+
+void A() {
+    B(1);
+}
+
+void Main() {
+    A();
+}
@@ -0,0 +1,155 @@
+# Golden-output regression runner.
+#
+# Builds every program the toolchain can produce: done/*.as assembled as is,
+# programs/*.cs and VortexScript/main.vsc through the same codegen and
+# optimizer passes as main.py and mainVSC.py. Each one then runs on the
+# emulator in a process pool, with an instruction budget and the
+# controller_input/rng script found next to its source (<name>.script.json,
+# see emulator.load_script; without one there is no input and seed 0). The
+# programs in done/ that read the controller have a recorded script that
+# plays them; the others only read rng, if anything. Samples the C# compiler
+# cannot build yet (UNSUPPORTED) are left out.
+#
+# What a run shows is hashed, not how fast it gets there: every frame pushed
+# to the screen, every string pushed to the character display and every
+# value shown on the number display, with repeats of the same picture
+# collapsed. A run matches its golden file in golden/ when each of the three
+# sequences is equal, or, when neither run halted inside the budget, when
+# one is a prefix of the other, so a faster build that gets further still
+# passes. A build that reads its input a different number of times sees a
+# different input stream and will show up as a mismatch.
+#
+# Usage: python regression.py [names...] [--update] [--jobs N] [--golden DIR]
+
+import argparse
+import hashlib
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from assembler import assemble_lines
+from emulator import Emulator, PORT, MAX_CYCLES, load_script
+from instrument import Instrumentation
+from optimizer import render
+
+GOLDEN = Path(__file__).with_name('golden')
+DISPLAYS = ['screen', 'chars', 'number']
+# CS.cs wraps Main in a namespace and class; CSfunc.cs compares two variables
+# and returns a value. The parser supports neither.
+UNSUPPORTED = {'CS.cs', 'CSfunc.cs'}
+
+class RecordingEmulator(Emulator):
+    # Hashes what the displays show each time they change
+    def reset(self):
+        super().reset()
+        self.shown = {display: [] for display in DISPLAYS}
+
+    def store(self, address, value):
+        super().store(address, value)
+        if address == PORT['buffer_screen']:
+            self.show('screen', bytes(pixel for row in self.screen for pixel in row))
+        elif address == PORT['buffer_chars']:
+            self.show('chars', bytes(self.chars))
+        elif address in (PORT['show_number'], PORT['clear_number'], PORT['signed_mode'], PORT['unsigned_mode']):
+            self.show('number', self.number_display().encode())
+
+    def show(self, display, content):
+        digest = hashlib.blake2b(content, digest_size=8).hexdigest()
+        if not self.shown[display] or self.shown[display][-1] != digest:
+            self.shown[display].append(digest)
+
+def assembly(path):
+    # Assembly text for a workload, built the way its driver builds it
+    if path.suffix == '.as':
+        return path.read_text()
+    metrics = Instrumentation()
+    if path.suffix == '.cs':
+        import main
+        from compiler.lexer import tokenize
+        from compiler.parser import Parser
+        ast = Parser(tokenize(path.read_text(encoding='utf-8-sig'))).parse()
+        return render(main.build(ast, metrics)[1])
+    import mainVSC
+    from compilerVSC.parser import Program
+    mainVSC.loaded_files.clear()
+    namespaces = []
+    mainVSC.process_file(path, namespaces, metrics)
+    return render(mainVSC.build(Program(namespaces), metrics)[1])
+
+def workloads():
+    # name -> source path
+    paths = sorted(Path('done').glob('*.as')) + sorted(Path('programs').glob('*.cs'))
+    paths.append(Path('VortexScript/main.vsc'))
+    return {path.name: path for path in paths if path.name not in UNSUPPORTED}
+
+def run(path):
+    # Build and run one workload; returns its outputs or the error that stopped it
+    script_path = path.with_name(f"{path.stem}.script.json")
+    script = load_script(script_path) if script_path.exists() else {}
+    cycles = script.pop('cycles', MAX_CYCLES)
+    try:
+        rom, symbols = assemble_lines(assembly(path))
+        emulator = RecordingEmulator(rom, **script)
+        emulator.run(cycles)
+    except (SyntaxError, NotImplementedError, ValueError, KeyError, IndexError, RuntimeError, SystemExit) as error:
+        # SystemExit: the assembler reports bad source with exit()
+        return {'error': f"{type(error).__name__}: {error}"}
+    return {'halted': emulator.halted, 'cycles': emulator.cycles, **emulator.shown}
+
+def compare(golden, result):
+    # Differences of a result from its golden outputs, as printable lines
+    if 'error' in golden or 'error' in result:
+        return [] if golden.get('error') == result.get('error') else [f"{golden.get('error')} -> {result.get('error')}"]
+    differences = []
+    if golden['halted'] != result['halted']:
+        differences.append(f"halted {golden['halted']} -> {result['halted']}")
+    for display in DISPLAYS:
+        expected, actual = golden[display], result[display]
+        if golden['halted'] or result['halted']:
+            same = expected == actual
+        else:
+            shorter = min(len(expected), len(actual))
+            same = expected[:shorter] == actual[:shorter]
+        if not same:
+            index = next((i for i, (a, b) in enumerate(zip(expected, actual)) if a != b), min(len(expected), len(actual)))
+            differences.append(f"{display} differs at update {index} ({len(expected)} -> {len(actual)} updates)")
+    return differences
+
+def main():
+    parser = argparse.ArgumentParser(description="Run every program on the emulator and compare with golden outputs")
+    parser.add_argument('names', nargs='*', help="workloads to run, e.g. tetris.as (default: all)")
+    parser.add_argument('--update', action='store_true', help="write the current outputs as the golden files")
+    parser.add_argument('--jobs', type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument('--golden', type=Path, default=GOLDEN)
+    args = parser.parse_args()
+
+    paths = workloads()
+    unknown = [name for name in args.names if name not in paths]
+    if unknown:
+        sys.exit(f"Unknown workloads: {', '.join(unknown)}")
+    names = args.names or list(paths)
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        results = dict(zip(names, pool.map(run, [paths[name] for name in names])))
+
+    failed = 0
+    for name, result in results.items():
+        golden_file = args.golden / f"{name}.json"
+        summary = result.get('error') or f"{result['cycles']} cycles{', halted' if result['halted'] else ''}, " + \
+            ", ".join(f"{len(result[display])} {display}" for display in DISPLAYS)
+        if args.update:
+            args.golden.mkdir(exist_ok=True)
+            golden_file.write_text(json.dumps(result, indent=1) + "\n")
+            print(f"{'UPDATED':<9}{name:<18}{summary}")
+        elif not golden_file.exists():
+            failed += 1
+            print(f"{'MISSING':<9}{name:<18}{summary}")
+        else:
+            differences = compare(json.loads(golden_file.read_text()), result)
+            failed += bool(differences)
+            print(f"{'FAIL' if differences else 'ok':<9}{name:<18}{summary}")
+            for line in differences:
+                print(f"{'':<9}  {line}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
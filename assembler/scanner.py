@@ -0,0 +1,89 @@
+# Regex scanner shared by the C# and VortexScript front ends.
+#
+# Each lexer builds one Scanner from its token specification at import time,
+# so the alternation pattern is compiled once. Scanning is lazy: tokens are
+# produced as the parser asks for them, so a large source is never held as a
+# full token list. Tokens are small named tuples that remember where they
+# start, and any character no rule matches is reported with its position.
+
+import re
+import sys
+from collections import deque
+from typing import NamedTuple, Union
+
+class Token(NamedTuple):
+    kind: str
+    value: Union[str, int, float]
+    offset: int
+    line: int
+    column: int
+
+def position(token):
+    return f"line {token.line}, column {token.column}" if token else "end of input"
+
+def error_at(message, token):
+    # A SyntaxError naming where the token starts
+    found = f"{token.kind} {token.value!r}" if token else "nothing"
+    error = SyntaxError(f"{message}, found {found} at {position(token)}")
+    if token:
+        error.lineno, error.offset = token.line, token.column
+    return error
+
+class Scanner:
+    def __init__(self, specification, skip, convert=None, intern=()):
+        # specification: (kind, pattern) pairs, earlier ones win
+        # skip: kinds that are matched but not produced (whitespace, comments)
+        # convert: kind -> function turning the matched text into the token value
+        # intern: kinds whose text is interned, e.g. identifiers used as dict keys
+        self.pattern = re.compile('|'.join(f'(?P<{kind}>{pattern})' for kind, pattern in specification))
+        self.kinds = {kind: sys.intern(kind) for kind, _ in specification}
+        self.skip = frozenset(skip)
+        self.convert = convert or {}
+        self.intern = frozenset(intern)
+
+    def tokens(self, code):
+        match = self.pattern.match
+        line, line_start, offset = 1, 0, 0
+        while offset < len(code):
+            found = match(code, offset)
+            if not found or found.end() == offset:
+                raise SyntaxError(f"Unexpected character {code[offset]!r} at line {line}, column {offset - line_start + 1}")
+            kind, text = found.lastgroup, found.group()
+            if kind not in self.skip:
+                value = text
+                if kind in self.convert:
+                    value = self.convert[kind](text)
+                elif kind in self.intern:
+                    value = sys.intern(text)
+                yield Token(self.kinds[kind], value, offset, line, offset - line_start + 1)
+            newlines = text.count('\n')
+            if newlines:
+                line += newlines
+                line_start = offset + text.rindex('\n') + 1
+            offset = found.end()
+
+class TokenStream:
+    # Lookahead over a token iterator, so a parser pulls tokens only as it needs them
+    def __init__(self, tokens):
+        self.source = iter(tokens)
+        self.buffer = deque()
+        self.previous = None
+        self.count = 0  # tokens consumed so far
+
+    def peek(self, ahead=0):
+        while len(self.buffer) <= ahead:
+            token = next(self.source, None)
+            if token is None:
+                return None
+            self.buffer.append(token)
+        return self.buffer[ahead]
+
+    def advance(self):
+        if self.peek() is None:
+            return None
+        self.previous = self.buffer.popleft()
+        self.count += 1
+        return self.previous
+
+    def at_end(self):
+        return self.peek() is None
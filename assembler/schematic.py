@@ -1,4 +1,5 @@
 import mcschematic
+from pathlib import Path
 
 def make_schematic(mc_filename, schem_filename):
     mc_file = open(mc_filename, 'r')
@@ -157,7 +158,6 @@ def make_schematic(mc_filename, schem_filename):
             x[1] -= 2
 
     # === Save schematic ===
-    if schem_filename.suffix == '.schem':
-        schem_filename = schem_filename.stem
-
-    schem.save('.', schem_filename, version=mcschematic.Version.JE_1_18_2)
+    # mcschematic takes a folder and a name without the .schem extension
+    schem_filename = Path(schem_filename)
+    schem.save(str(schem_filename.parent), schem_filename.stem, version=mcschematic.Version.JE_1_18_2)
@@ -0,0 +1,228 @@
+# Local device server: runs a program in the emulator and lets live
+# controllers and viewers attach to its memory-mapped ports over a socket.
+#
+# The emulator runs at full speed (or --ips instructions per second) on its
+# own thread. Clients connect over TCP on a loopback address or over a Unix
+# socket; nothing is reachable from another machine. Any number of clients
+# can attach, and each one first receives the complete display state, then
+# every change as it is pushed to the displays.
+#
+# Messages in both directions are a 1-byte type, a 2-byte little-endian
+# payload length and the payload. From the server:
+#   SCREEN  rows that changed on buffer_screen: (row u8, 32-bit row mask) each,
+#           bit x set when pixel x is lit, as in emulator.pack_screen
+#   CHARS   the characters shown after buffer_chars, one byte each
+#   NUMBER  the number display: value u16 (256 = blank), signed mode u8
+#   HALTED  cycles run u64, then why it stopped as UTF-8 (empty after hlt)
+# From a client:
+#   BUTTONS the controller_input byte it holds down. The program reads the
+#           buttons of all clients ORed together, and a client's buttons are
+#           released when it disconnects.
+# A viewer that falls behind skips screen updates and gets the whole screen
+# again once it has caught up.
+#
+# Usage: python server.py program.as [--host HOST] [--port PORT | --unix PATH]
+#        [--ips N] [--seed N]
+
+import argparse
+import asyncio
+import ipaddress
+import socket
+import struct
+import sys
+import threading
+import time
+from assembler import assemble_lines
+from emulator import Emulator, PORT, SCREEN_SIZE, NO_NUMBER, pack_screen
+
+DEFAULT_PORT = 2048
+CHUNK_CYCLES = 10000        # cycles run between checks for a stop or a rate limit
+MAX_CLIENT_BUFFER = 65536   # bytes queued for a viewer before screen updates are skipped
+
+SCREEN, CHARS, NUMBER, HALTED = 1, 2, 3, 4  # server -> client
+BUTTONS = 1                                 # client -> server
+HEADER = struct.Struct('<BH')
+ROW = struct.Struct('<BI')
+NUMBER_STATE = struct.Struct('<HB')
+CYCLES = struct.Struct('<Q')
+NUMBER_PORTS = (PORT['show_number'], PORT['clear_number'], PORT['signed_mode'], PORT['unsigned_mode'])
+
+def message(kind, payload=b''):
+    return HEADER.pack(kind, len(payload)) + payload
+
+def screen_rows(screen):
+    return struct.unpack(f'<{SCREEN_SIZE}I', pack_screen(screen))
+
+def screen_message(rows, changed):
+    return message(SCREEN, b''.join(ROW.pack(y, rows[y]) for y in changed))
+
+class LiveEmulator(Emulator):
+    # Reads controller_input from the buttons clients hold and reports each
+    # display push through publish(message), called on the emulator thread
+    def __init__(self, rom, publish, seed=0):
+        self.publish = publish
+        self.buttons = 0
+        super().__init__(rom, seed=seed)
+
+    def reset(self):
+        super().reset()
+        self.rows = (0,) * SCREEN_SIZE
+
+    def load(self, address):
+        if address == PORT['controller_input']:
+            self.controller_reads += 1
+            return self.buttons & 255
+        return super().load(address)
+
+    def store(self, address, value):
+        super().store(address, value)
+        if address == PORT['buffer_screen']:
+            rows = screen_rows(self.screen)
+            changed = [y for y in range(SCREEN_SIZE) if rows[y] != self.rows[y]]
+            self.rows = rows
+            if changed:
+                self.publish(screen_message(rows, changed))
+        elif address == PORT['buffer_chars']:
+            self.publish(message(CHARS, bytes(self.chars)))
+        elif address in NUMBER_PORTS:
+            self.publish(message(NUMBER, NUMBER_STATE.pack(NO_NUMBER if self.number is None else self.number, self.signed)))
+
+class DeviceServer:
+    def __init__(self, rom, seed=0, ips=None):
+        self.emulator = LiveEmulator(rom, self.publish_threadsafe, seed)
+        self.ips = ips
+        self.loop = None
+        self.stopping = threading.Event()
+        self.clients = {}     # StreamWriter -> buttons it holds
+        self.behind = set()   # writers that skipped a screen update
+        # What the displays show, for clients that attach later
+        self.rows = (0,) * SCREEN_SIZE
+        self.chars = message(CHARS)
+        self.number = message(NUMBER, NUMBER_STATE.pack(NO_NUMBER, 0))
+        self.halted = None
+
+    async def serve(self, host='127.0.0.1', port=DEFAULT_PORT, path=None):
+        self.loop = asyncio.get_running_loop()
+        if path:
+            server = await asyncio.start_unix_server(self.attach, path)
+        else:
+            server = await asyncio.start_server(self.attach, host, port)
+        thread = threading.Thread(target=self.run_emulator, name='emulator', daemon=True)
+        thread.start()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.stopping.set()
+
+    def run_emulator(self):
+        emulator = self.emulator
+        chunk = CHUNK_CYCLES if not self.ips else max(1, min(CHUNK_CYCLES, int(self.ips) // 100))
+        start = time.perf_counter()
+        reason = ""
+        try:
+            while not emulator.halted and not self.stopping.is_set():
+                emulator.run(chunk)
+                emulator.port_writes.clear()  # nothing reads the log, and the run does not end
+                if self.ips:
+                    delay = start + emulator.cycles / self.ips - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+        except RuntimeError as error:  # call stack overflow or underflow
+            reason = str(error)
+        if not self.stopping.is_set():
+            self.publish_threadsafe(message(HALTED, CYCLES.pack(emulator.cycles) + reason.encode()))
+
+    def publish_threadsafe(self, data):
+        self.loop.call_soon_threadsafe(self.publish, data)
+
+    def publish(self, data):
+        kind = data[0]
+        if kind == SCREEN:
+            rows = list(self.rows)
+            for offset in range(HEADER.size, len(data), ROW.size):
+                y, mask = ROW.unpack_from(data, offset)
+                rows[y] = mask
+            self.rows = tuple(rows)
+        elif kind == CHARS:
+            self.chars = data
+        elif kind == NUMBER:
+            self.number = data
+        elif kind == HALTED:
+            self.halted = data
+        for writer in list(self.clients):
+            if writer.is_closing():
+                continue
+            if writer.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+                if kind == SCREEN:
+                    self.behind.add(writer)
+                    continue
+            elif writer in self.behind:
+                self.behind.discard(writer)
+                writer.write(screen_message(self.rows, range(SCREEN_SIZE)))
+                if kind == SCREEN:
+                    continue
+            writer.write(data)
+
+    async def attach(self, reader, writer):
+        writer.write(screen_message(self.rows, range(SCREEN_SIZE)) + self.chars + self.number + (self.halted or b''))
+        self.clients[writer] = 0
+        try:
+            while True:
+                kind, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+                payload = await reader.readexactly(length)
+                if kind == BUTTONS and length == 1:
+                    self.clients[writer] = payload[0]
+                    self.update_buttons()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self.clients[writer]
+            self.behind.discard(writer)
+            self.update_buttons()
+            writer.close()
+
+    def update_buttons(self):
+        buttons = 0
+        for held in self.clients.values():
+            buttons |= held
+        self.emulator.buttons = buttons
+
+def load_rom(path):
+    # Assembly, or machine code with one 16-bit binary string per line
+    with open(path, 'r') as f:
+        text = f.read()
+    if path.endswith('.mc'):
+        return [int(line, 2) for line in text.splitlines() if line.strip()]
+    rom, symbols = assemble_lines(text)
+    return rom
+
+def check_local(host):
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except socket.gaierror as error:
+        sys.exit(f"Cannot resolve {host}: {error}")
+    if not all(ipaddress.ip_address(address.split('%')[0]).is_loopback for address in addresses):
+        sys.exit(f"{host} is not a loopback address; the server only accepts local clients")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a program and serve its displays and controller to local clients")
+    parser.add_argument('file', help=".as or .mc file")
+    parser.add_argument('--host', default='127.0.0.1', help="loopback address to listen on")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="TCP port to listen on")
+    parser.add_argument('--unix', metavar='PATH', help="listen on a Unix socket instead of TCP")
+    parser.add_argument('--ips', type=float, help="instructions per second (default: as fast as possible)")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the rng port")
+    args = parser.parse_args()
+    if args.unix is None:
+        check_local(args.host)
+    server = DeviceServer(load_rom(args.file), args.seed, args.ips)
+    where = args.unix or f"{args.host}:{args.port}"
+    print(f"Serving {args.file} on {where}", flush=True)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+# Superoptimizer for short straight-line BatPU-2 sequences.
+#
+# Offline tool that builds the rewrite database used by optimizer.py:
+#   1. Mine idioms: every run of 2..3 register-only instructions (ADD, SUB,
+#      NOR, AND, XOR, RSH, LDI, ADI and the pseudo-ops built on them) in
+#      done/*.as and in compiler output, weighted by how often the emulator
+#      executes it. LOD/STR, branches, calls and labels end a run, so memory
+#      and port side effects never take part in a rewrite.
+#   2. For the hottest idioms, enumerate every shorter sequence over the same
+#      registers, r0 and the idiom's immediates plus a few common constants.
+#   3. Reject candidates on a fingerprint of random inputs, then prove the
+#      survivors equal on every 8-bit value of every register involved and
+#      both input flags.
+# A candidate may also be accepted on the condition that the flags, or one
+# register the idiom writes, are dead afterwards; the optimizer checks that
+# with its liveness passes before rewriting.
+#
+# Needs NumPy. Usage: python superopt.py [--top N] [--output superopt.json]
+
+import argparse
+import itertools
+import json
+import sys
+import numpy as np
+from pathlib import Path
+from assembler import assemble_lines
+from emulator import Emulator
+from optimizer import (REWRITE_DATABASE, parse, render, is_instruction, base_instruction,
+                       canonical_sequence, definitions)
+
+MAX_LENGTH = 3
+EXTRA_IMMEDIATES = [0, 1, 255]
+FINGERPRINT_SIZE = 64
+MINING_CYCLES = 50000
+BINARY_OPS = ['add', 'sub', 'nor', 'and', 'xor']
+
+# Evaluation: a state is (registers, zero, carry) where registers maps each
+# canonical register name to an int32 array holding one value per test input
+
+def execute(sequence, state):
+    registers, zero, carry = state
+    registers = dict(registers)
+    for line in sequence:
+        ins = line.split()
+        op = ins[0]
+        if op in BINARY_OPS:
+            a, b = registers[ins[1]], registers[ins[2]]
+            if op == 'add':
+                result = a + b
+                carry = result > 255
+            elif op == 'sub':
+                result = a + (255 - b) + 1
+                carry = result > 255
+            else:
+                result = ~(a | b) if op == 'nor' else (a & b if op == 'and' else a ^ b)
+                carry = np.zeros_like(carry)
+            result &= 255
+            zero = result == 0
+            dest = ins[3]
+        elif op == 'rsh':
+            result, dest = registers[ins[1]] >> 1, ins[2]
+        elif op == 'ldi':
+            result, dest = np.full_like(registers['r0'], int(ins[2])), ins[1]
+        else:  # adi
+            result = registers[ins[1]] + int(ins[2])
+            carry = result > 255
+            result &= 255
+            zero = result == 0
+            dest = ins[1]
+        if dest != 'r0':
+            registers[dest] = result
+    return registers, zero, carry
+
+def equal_outputs(expected, actual, names, flags_dead, dead):
+    # Whether two final states agree on everything still read afterwards
+    registers, zero, carry = actual
+    for name in names:
+        if name not in dead and not np.array_equal(expected[0][name], registers[name]):
+            return False
+    return flags_dead or (np.array_equal(expected[1], zero) and np.array_equal(expected[2], carry))
+
+def random_state(names, size, rng):
+    # Random inputs with the values most likely to expose an edge case mixed in
+    edges = np.array([0, 1, 127, 128, 255])
+    registers = {'r0': np.zeros(size, dtype=np.int32)}
+    for name in names:
+        values = rng.integers(0, 256, size, dtype=np.int32)
+        values[:len(edges)] = np.roll(edges, len(registers))
+        registers[name] = values
+    return registers, rng.integers(0, 2, size).astype(bool), rng.integers(0, 2, size).astype(bool)
+
+def exhaustive_states(names):
+    # Every combination of 8-bit register values and input flags, in chunks of
+    # all values of the first register so three registers fit in memory
+    others = max(len(names) - 1, 0)
+    grid = np.indices((256,) * others + (2, 2), dtype=np.int32).reshape(others + 2, -1)
+    for first in range(256 if names else 1):
+        registers = {'r0': np.zeros(grid.shape[1], dtype=np.int32)}
+        if names:
+            registers[names[0]] = np.full(grid.shape[1], first, dtype=np.int32)
+        for name, values in zip(names[1:], grid):
+            registers[name] = values
+        yield registers, grid[-2].astype(bool), grid[-1].astype(bool)
+
+def verify(pattern, candidate, names, flags_dead, dead):
+    for state in exhaustive_states(names):
+        if not equal_outputs(execute(pattern, state), execute(candidate, state), names, flags_dead, dead):
+            return False
+    return True
+
+# Search
+
+def pattern_registers(pattern):
+    names = []
+    for line in pattern:
+        for word in line.split()[1:]:
+            if word.startswith('r') and word != 'r0' and word not in names:
+                names.append(word)
+    return names
+
+def written_registers(pattern):
+    written = []
+    for line in pattern:
+        ins = line.split()
+        dest = ins[-1] if ins[0] in BINARY_OPS + ['rsh'] else ins[1]
+        if dest != 'r0' and dest not in written:
+            written.append(dest)
+    return written
+
+def instructions(names, immediates):
+    # Every single instruction over the given registers and immediates, the
+    # plainest first so that of two equally short rewrites the readable one wins
+    sources = ['r0'] + names
+    for a, value in itertools.product(names, immediates):
+        yield f"ldi {a} {value}"
+        yield f"adi {a} {value}"
+    for op in BINARY_OPS:
+        # Writing r0 still sets the flags, as cmp does
+        for a, b, c in itertools.product(sources, sources, sources):
+            yield f"{op} {a} {b} {c}"
+    for a, c in itertools.product(sources, names):
+        yield f"rsh {a} {c}"
+
+def search(pattern):
+    # Shortest replacement for each liveness condition the pattern could be
+    # rewritten under: [(flags_dead, dead registers, replacement)]
+    names = pattern_registers(pattern)
+    # Immediates: the pattern's own, their pairwise sums (two adds folding into
+    # one) and a few constants that often stand in for other instructions
+    own = [int(line.split()[2]) for line in pattern if line.split()[0] in ['ldi', 'adi']]
+    immediates = sorted(set(own) | {(a + b) & 255 for a, b in itertools.combinations(own, 2)} | set(EXTRA_IMMEDIATES))
+    conditions = [(flags_dead, dead) for flags_dead in [False, True]
+                  for dead in [()] + [(name,) for name in written_registers(pattern)]]
+    rng = np.random.default_rng(0)
+    state = random_state(names, FINGERPRINT_SIZE, rng)
+    expected = execute(pattern, state)
+    alphabet = list(instructions(names, immediates))
+    found = {}
+
+    def sequences(length):
+        # (candidate, fingerprint state after it) for every sequence of this length
+        if length == 0:
+            yield [], state
+            return
+        for prefix, prefix_state in sequences(length - 1):
+            for line in alphabet:
+                yield prefix + [line], execute([line], prefix_state)
+
+    # Shortest first, so the first candidate found for a condition is the best
+    for length in range(len(pattern)):
+        for candidate, final in sequences(length):
+            same = {name: np.array_equal(expected[0][name], final[0][name]) for name in names}
+            same_flags = np.array_equal(expected[1], final[1]) and np.array_equal(expected[2], final[2])
+            for flags_dead, dead in conditions:
+                if ((flags_dead, dead) not in found and (flags_dead or same_flags)
+                        and all(same[name] for name in names if name not in dead)
+                        and verify(pattern, candidate, names, flags_dead, dead)):
+                    found[(flags_dead, dead)] = candidate
+        if len(found) == len(conditions):
+            break
+    # A condition is pointless if a weaker one already allows as short a rewrite
+    results = []
+    for (flags_dead, dead), candidate in sorted(found.items(), key=lambda item: (item[0][0], len(item[0][1]))):
+        weaker = [other for (other_flags, other_dead), other in found.items()
+                  if (other_flags, other_dead) != (flags_dead, dead)
+                  and other_flags <= flags_dead and set(other_dead) <= set(dead)]
+        if all(len(other) > len(candidate) for other in weaker):
+            results.append((flags_dead, list(dead), candidate))
+    return results
+
+# Mining
+
+def compiled_sources():
+    # Assembly produced by both compilers for the bundled example programs.
+    # Sources the compilers cannot handle yet are skipped.
+    from compiler.lexer import tokenize
+    from compiler.parser import Parser
+    from compiler.codegen import CodeGenerator
+    for path in sorted(Path('programs').glob('*.cs')):
+        try:
+            ast = Parser(tokenize(path.read_text(encoding='utf-8-sig'))).parse()
+            yield path.name, CodeGenerator().generate(ast)
+        except (SyntaxError, NotImplementedError, ValueError, IndexError) as error:
+            print(f"Skipping {path}: {error}", file=sys.stderr)
+    from mainVSC import process_file
+    from compilerVSC.parser import Program
+    from compilerVSC.codegen import CodeGenerator as CodeGeneratorVSC
+    namespaces = []
+    process_file(Path('VortexScript/main.vsc'), namespaces)
+    yield 'main.vsc', CodeGeneratorVSC().generate(Program(namespaces))
+
+def mine(sources):
+    # pattern -> weight: 1 per occurrence plus the executions of its first
+    # instruction in a short emulator run of the program
+    idioms = {}
+    for name, source in sources:
+        program = parse(source)
+        rom, symbols = assemble_lines(render(program))
+        emulator = Emulator(rom)
+        try:
+            emulator.run(MINING_CYCLES)
+        except RuntimeError as error:
+            print(f"{name}: {error}", file=sys.stderr)
+        constants = definitions(program)
+        pcs, pc = [], 0
+        for words in program:
+            pcs.append(pc)
+            pc += is_instruction(words)
+        for index in range(len(program)):
+            for length in range(2, MAX_LENGTH + 1):
+                window = program[index:index + length]
+                if len(window) < length or not all(is_instruction(words) for words in window):
+                    break
+                canonical = canonical_sequence([base_instruction(words) for words in window], constants)
+                if canonical is None:
+                    break
+                weight = 1 + (emulator.counts[pcs[index]] if pcs[index] < len(emulator.counts) else 0)
+                idioms[canonical[0]] = idioms.get(canonical[0], 0) + weight
+    return idioms
+
+def main():
+    parser = argparse.ArgumentParser(description="Search for shorter equivalents of hot BatPU-2 idioms")
+    parser.add_argument('--top', type=int, default=60, help="number of hottest idioms to search")
+    parser.add_argument('--output', type=Path, default=REWRITE_DATABASE)
+    args = parser.parse_args()
+
+    sources = [(path.name, path.read_text()) for path in sorted(Path('done').glob('*.as'))]
+    sources += list(compiled_sources())
+    idioms = mine(sources)
+    hottest = sorted(idioms, key=lambda pattern: -idioms[pattern])[:args.top]
+
+    rewrites = []
+    for number, pattern in enumerate(hottest, 1):
+        for flags_dead, dead, replacement in search(list(pattern)):
+            rewrites.append({'pattern': list(pattern), 'replacement': replacement,
+                             'flags_dead': flags_dead, 'dead': dead, 'weight': idioms[pattern]})
+            print(f"[{number}/{len(hottest)}] {' ; '.join(pattern)}  =>  {' ; '.join(replacement) or '(nothing)'}"
+                  f"{'  if flags dead' if flags_dead else ''}{''.join(f'  if {reg} dead' for reg in dead)}")
+
+    with open(args.output, 'w') as f:
+        json.dump({'searched': len(hottest), 'rewrites': rewrites}, f, indent=1)
+    print(f"{len(rewrites)} rewrites for {len(hottest)} idioms written to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+# Translation validation of optimized ROMs.
+#
+# The optimizer may make a program faster but must not change what it does.
+# This checks that by running, not by proof: the program as it was before the
+# passes and as it is after them run side by side on the same
+# controller_input/rng streams, the recorded scripts first and then random
+# ones, and the two runs of each stream must make the same port writes
+# (pixels, characters, numbers, every write with its value) in the same order.
+# Registers and RAM are free to differ. Runs that stop at the cycle budget
+# only need to agree as far as both got, as in regression.py; a run that
+# halts, or fails on the call stack, must end the same way as its partner.
+# A program that makes no port writes at all, such as anything the C#
+# compiler builds, is compared by its final RAM instead, for the pairs of
+# runs that both halt; when none do, nothing could be checked and the
+# result says so.
+#
+# "Before" is the assembly handed to optimizer.optimize, so what is checked
+# is those passes. Transforms the compilers make while generating code
+# (unrolling, inlining, hoisting, compile-time evaluation) are already in it.
+#
+# All runs go in one batch. BatchEmulator keeps the machine state of every
+# run in NumPy arrays, one row per run, and steps them all at once over the
+# ROMs decoded by disassembler.decode; only port accesses are handled run by
+# run. A stream is a fixed list of values read in order: a script's values,
+# then zeros for controller_input and its seed's random numbers for rng like
+# emulator.Emulator, and it starts over at its end.
+#
+# The first divergence is reported with the pc and the assembly line of the
+# write on each side, and the label it comes after.
+#
+# Needs NumPy. Usage: python validate.py before.as after.as [--script FILE...] [--streams N] [--cycles N]
+
+import argparse
+import random
+import sys
+import numpy as np
+from assembler import PORTS, PORT_BASE, assemble_lines
+from disassembler import OP, BINARY_OPS, decode
+from emulator import PORT, STACK_DEPTH, SCREEN_SIZE, load_script
+from memory_layout import RAM_SIZE
+from optimizer import ROM_SIZE
+
+# One step of a batch costs about as much as 150 steps of emulator.Emulator,
+# so batches pay off with hundreds of runs: in a batch of 500 a run costs
+# about half as much as on its own
+STREAMS = 255            # random streams besides the recorded ones
+VALIDATE_CYCLES = 10000  # budget of every run
+STREAM_LENGTH = 4096     # values per stream before it starts over
+
+# Per opcode: whether it sets the flags, which column of a decoded row holds
+# the register it writes (ZERO_COLUMN: none) and which result it writes
+FIELDS = ['opcode', 'a', 'b', 'c', 'immediate', 'address', 'condition', 'offset']
+ZERO_COLUMN = len(FIELDS)
+FLAG_SETTERS = np.isin(np.arange(16), BINARY_OPS + [OP['adi']])
+DESTINATION = np.full(16, ZERO_COLUMN)
+DESTINATION[BINARY_OPS + [OP['rsh']]] = FIELDS.index('c')
+DESTINATION[[OP['ldi'], OP['adi']]] = FIELDS.index('a')
+DESTINATION[OP['lod']] = FIELDS.index('b')
+RESULT = np.zeros(16, dtype=np.int64)
+for index, name in enumerate(['add', 'sub', 'nor', 'and', 'xor', 'rsh', 'ldi', 'adi', 'lod']):
+    RESULT[OP[name]] = index
+
+class BatchEmulator:
+    # Run i executes roms[rom_of[i]] and reads controller_input[i] and rng[i]
+    def __init__(self, roms, rom_of, controller_input, rng):
+        words = np.zeros((len(roms), ROM_SIZE), dtype=np.uint16)
+        for index, rom in enumerate(roms):
+            if len(rom) > ROM_SIZE:
+                raise ValueError(f"Program is {len(rom)} words, ROM holds {ROM_SIZE}")
+            words[index, :len(rom)] = rom
+        fields = decode(words)
+        # One row per ROM word: the FIELDS, then a zero
+        self.rows = np.stack([fields[name] for name in FIELDS] + [np.zeros_like(words, dtype=np.int32)], axis=-1).reshape(-1, len(FIELDS) + 1)
+        self.rom_of = np.asarray(rom_of)
+        self.controller_input = np.asarray(controller_input, dtype=np.int32)
+        self.rng = np.asarray(rng, dtype=np.int32)
+        runs = len(self.rom_of)
+        self.pc = np.zeros(runs, dtype=np.int32)
+        self.registers = np.zeros((runs, 16), dtype=np.int32)
+        self.zero = np.zeros(runs, dtype=bool)
+        self.carry = np.zeros(runs, dtype=bool)
+        self.stack = np.zeros((runs, STACK_DEPTH), dtype=np.int32)
+        self.depth = np.zeros(runs, dtype=np.int32)
+        self.memory = np.zeros((runs, RAM_SIZE), dtype=np.int32)
+        self.halted = np.zeros(runs, dtype=bool)
+        self.cycles = np.zeros(runs, dtype=np.int64)
+        self.controller_reads = np.zeros(runs, dtype=np.int64)
+        self.rng_reads = np.zeros(runs, dtype=np.int64)
+        self.pixel = np.zeros((runs, 2), dtype=np.int32)  # x, y
+        self.screen_buffer = np.zeros((runs, SCREEN_SIZE, SCREEN_SIZE), dtype=np.int8)  # [run, y, x]
+        self.faults = {}     # run -> error message
+        self.write_log = []  # per step with port writes: their runs, ports, values and pcs
+
+    def step(self, runs):
+        # One instruction of each of the given runs, none of them halted.
+        # Work that only some instructions do is done for just the runs that
+        # need it.
+        pc = self.pc[runs]
+        rows = self.rows[self.rom_of[runs] * ROM_SIZE + pc]
+        op, a, b, c, immediate, address, condition, offset = rows[:, :ZERO_COLUMN].T
+        registers = self.registers.reshape(-1)
+        base = runs * 16
+        value_a, value_b = registers[base + a], registers[base + b]
+        self.cycles[runs] += 1
+        everyone = np.arange(len(runs))
+
+        # Every candidate result, then the one each opcode writes
+        memory_address = (value_a + offset) & 255
+        loaded = self.memory.reshape(-1)[runs * RAM_SIZE + np.minimum(memory_address, RAM_SIZE - 1)]
+        result = np.stack([value_a + value_b, value_a + 256 - value_b, 255 - (value_a | value_b), value_a & value_b,
+                           value_a ^ value_b, value_a >> 1, immediate, value_a + immediate, loaded])[RESULT[op], everyone]
+        sets_flags = FLAG_SETTERS[op]
+        zero = np.where(sets_flags, result & 255 == 0, self.zero[runs])
+        carry = np.where(sets_flags, result > 255, self.carry[runs])
+        self.zero[runs], self.carry[runs] = zero, carry
+
+        # Memory: RAM and ports, each for the runs that use it
+        ports = memory_address >= RAM_SIZE
+        reads = np.flatnonzero((op == OP['lod']) & ports)
+        if len(reads):
+            result[reads] = self.load_ports(runs[reads], memory_address[reads])
+        stores = op == OP['str']
+        written = np.flatnonzero(stores & ~ports)
+        if len(written):
+            self.memory[runs[written], memory_address[written]] = value_b[written]
+        port_writes = np.flatnonzero(stores & ports)
+        if len(port_writes):
+            self.store_ports(runs[port_writes], memory_address[port_writes], value_b[port_writes], pc[port_writes])
+
+        # Instructions that write no register write r0, which is then cleared
+        registers[base + rows[everyone, DESTINATION[op]]] = result & 255
+        self.registers[:, 0] = 0
+
+        # Control flow
+        taken = np.where(condition < 2, zero, carry) != (condition & 1).astype(bool)
+        next_pc = np.where((op == OP['jmp']) | ((op == OP['brh']) & taken), address, (pc + 1) % ROM_SIZE)
+        calls = np.flatnonzero(op == OP['cal'])
+        if len(calls):
+            for index in calls[self.depth[runs[calls]] == STACK_DEPTH]:
+                self.fault(runs[index], f"Call stack overflow at pc {pc[index]}")
+            calls = calls[self.depth[runs[calls]] < STACK_DEPTH]
+            self.stack[runs[calls], self.depth[runs[calls]]] = next_pc[calls]
+            self.depth[runs[calls]] += 1
+            next_pc[calls] = address[calls]
+        returns = np.flatnonzero(op == OP['ret'])
+        if len(returns):
+            for index in returns[self.depth[runs[returns]] == 0]:
+                self.fault(runs[index], f"Return with an empty call stack at pc {pc[index]}")
+            returns = returns[self.depth[runs[returns]] > 0]
+            self.depth[runs[returns]] -= 1
+            next_pc[returns] = self.stack[runs[returns], self.depth[runs[returns]]]
+        halts = np.flatnonzero(op == OP['hlt'])
+        if len(halts):
+            self.halted[runs[halts]] = True
+            next_pc[halts] = pc[halts]
+        self.pc[runs] = next_pc
+
+    def fault(self, run, message):
+        # Like the exception emulator.Emulator raises: the run stops there
+        self.faults[run] = message
+        self.halted[run] = True
+
+    def load_ports(self, runs, addresses):
+        # Values the runs read from the ports at addresses
+        values = np.zeros(len(runs), dtype=np.int32)  # write-only ports read 0
+        for port, stream, reads in [('rng', self.rng, self.rng_reads),
+                                    ('controller_input', self.controller_input, self.controller_reads)]:
+            reading = runs[addresses == PORT[port]]
+            if len(reading):
+                reads[reading] += 1
+                values[addresses == PORT[port]] = stream[reading, (reads[reading] - 1) % stream.shape[1]]
+        reading = addresses == PORT['load_pixel']
+        if reading.any():
+            x, y = self.pixel[runs[reading]].T
+            values[reading] = self.screen_buffer[runs[reading], y, x]
+        return values
+
+    def store_ports(self, runs, addresses, values, pcs):
+        self.write_log.append(np.stack([runs, addresses, values, pcs]))
+        for port in ['pixel_x', 'pixel_y', 'draw_pixel', 'clear_pixel', 'clear_screen_buffer']:
+            writing = addresses == PORT[port]
+            if not writing.any():
+                continue
+            if port in ['pixel_x', 'pixel_y']:
+                self.pixel[runs[writing], int(port == 'pixel_y')] = values[writing] % SCREEN_SIZE
+            elif port == 'clear_screen_buffer':
+                self.screen_buffer[runs[writing]] = 0
+            else:
+                x, y = self.pixel[runs[writing]].T
+                self.screen_buffer[runs[writing], y, x] = port == 'draw_pixel'
+
+    def port_writes(self):
+        # Per run, an array of (port, value, pc) rows in program order
+        log = np.concatenate(self.write_log, axis=1) if self.write_log else np.zeros((4, 0), dtype=np.int64)
+        log = log[:, np.argsort(log[0], kind='stable')]
+        counts = np.bincount(log[0], minlength=len(self.rom_of))
+        return np.split(log[1:].T, np.cumsum(counts)[:-1])
+
+def streams(scripts=(), count=STREAMS, seed=0):
+    # [(description, controller_input values, rng values)]: the scripts, each
+    # continued the way the emulator continues it, then count random streams
+    result = []
+    for name, script in [("no input", {})] + list(scripts):
+        controller_input = list(script.get('controller_input', []))
+        rng = list(script.get('rng', []))
+        length = max(STREAM_LENGTH, len(controller_input), len(rng))
+        generator = random.Random(script.get('seed', 0))
+        controller_input += [0] * (length - len(controller_input))
+        rng += [generator.randrange(256) for _ in range(length - len(rng))]
+        result.append((name, np.array(controller_input), np.array(rng)))
+    generator = np.random.default_rng(seed)
+    # Buttons are held about half the time
+    buttons = generator.integers(0, 256, (count, STREAM_LENGTH)) * (generator.random((count, STREAM_LENGTH)) < 0.5)
+    rng = generator.integers(0, 256, (count, STREAM_LENGTH))
+    result += [(f"random stream {index}", buttons[index], rng[index]) for index in range(count)]
+    return result
+
+def validate(before, after, scripts=(), count=STREAMS, cycles=VALIDATE_CYCLES, seed=0):
+    # before, after: assembly text; scripts: [(name, script)] as load_script
+    # reads them. Returns {'runs', 'cycles', 'checked', 'divergence'}:
+    # checked is 'port writes', 'final RAM' or None when no pair of runs could
+    # be compared, and divergence is None when every pair of runs agreed.
+    roms = [assemble_lines(before)[0], assemble_lines(after)[0]]
+    inputs = streams(scripts, count, seed)
+    length = max(len(values) for _, values, _ in inputs)
+    # Runs 2k and 2k+1 are before and after on stream k; np.resize repeats
+    # shorter streams up to the longest
+    controller_input = [np.resize(values, length) for _, values, _ in inputs for _ in roms]
+    rng = [np.resize(values, length) for _, _, values in inputs for _ in roms]
+    emulator = BatchEmulator(roms, [0, 1] * len(inputs), controller_input, rng)
+    for _ in range(cycles):
+        runs = np.flatnonzero(~emulator.halted)
+        if not len(runs):
+            break
+        emulator.step(runs)
+
+    port_writes = emulator.port_writes()
+    # Without port writes, how a run ends is all there is to compare
+    by_memory = not any(len(writes) for writes in port_writes)
+    diverged = {}  # stream -> index of the first port write that differs
+    memory = {}    # stream -> first RAM address that differs at the end
+    compared = 0
+    for stream in range(len(inputs)):
+        first, second = 2 * stream, 2 * stream + 1
+        writes = [port_writes[run][:, :2] for run in (first, second)]
+        common = min(map(len, writes))
+        differ = np.flatnonzero((writes[0][:common] != writes[1][:common]).any(axis=1))
+        index = int(differ[0]) if len(differ) else common
+        ended = [bool(emulator.halted[run]) for run in (first, second)]
+        # A run that ended must have made every write its partner made, and
+        # two ended runs must have ended the same way
+        if index < common or any(ended[run] and len(writes[1 - run]) > common for run in (0, 1)) \
+                or (all(ended) and emulator.faults.get(first) != emulator.faults.get(second)):
+            diverged[stream] = index
+        elif by_memory and all(ended):
+            differ = np.flatnonzero(emulator.memory[first] != emulator.memory[second])
+            if len(differ):
+                memory[stream] = int(differ[0])
+        compared += not by_memory or all(ended)
+
+    divergence = None
+    if diverged or memory:
+        stream = min(diverged.keys() | memory.keys())
+        if stream in diverged:
+            divergence = {'stream': inputs[stream][0], 'write': None if by_memory else diverged[stream],
+                          'before': outcome(emulator, port_writes, 2 * stream, diverged[stream], before),
+                          'after': outcome(emulator, port_writes, 2 * stream + 1, diverged[stream], after)}
+        else:
+            address = memory[stream]
+            divergence = {'stream': inputs[stream][0], 'address': address,
+                          **{side: {'end': f"halted with {emulator.memory[2 * stream + run, address]} at RAM address {address}"}
+                             for run, side in enumerate(['before', 'after'])}}
+    checked = None if not compared else 'final RAM' if by_memory else 'port writes'
+    return {'runs': len(inputs), 'cycles': int(emulator.cycles.max()), 'checked': checked, 'divergence': divergence}
+
+def outcome(emulator, port_writes, run, index, source):
+    # What a run did at port write index: the write and where it came from,
+    # or how the run ended instead
+    writes = port_writes[run]
+    if index < len(writes):
+        address, value, pc = (int(field) for field in writes[index])
+        return {'port': PORTS[address - PORT_BASE], 'value': value, 'pc': pc, **source_line(source, pc)}
+    if run in emulator.faults:
+        return {'end': emulator.faults[run]}
+    if emulator.halted[run]:
+        return {'end': f"halted after {emulator.cycles[run]} cycles"}
+    return {'end': f"no more writes in {emulator.cycles[run]} cycles"}
+
+def source_line(source, pc):
+    # {'line', 'text', 'label'} of the instruction at pc, counted the way the
+    # assembler counts: comments, blank lines, definitions and labels take no pc
+    if isinstance(source, str):
+        source = source.splitlines()
+    label, count = None, 0
+    for number, line in enumerate(source, start=1):
+        code = line
+        for comment_symbol in ['/', ';', '#']:
+            code = code.split(comment_symbol)[0]
+        words = code.split()
+        if not words or words[0].lower() == 'define':
+            continue
+        if words[0][0] == '.':
+            label = words[0]
+            words = words[1:]
+            if not words:
+                continue
+        if count == pc:
+            return {'line': number, 'text': line.strip(), 'label': label}
+        count += 1
+    return {'line': None, 'text': "", 'label': label}
+
+def format_validation(result):
+    divergence = result['divergence']
+    if divergence is None and result['checked'] is None:
+        return f"Validation: not applicable, no port writes and no run halted within {result['cycles']} cycles"
+    if divergence is None:
+        streams = f"{result['runs']} input stream" + ("s" if result['runs'] != 1 else "")
+        return f"Validation of the optimizer passes: {streams}, {result['checked']} match ({result['cycles']} cycles)"
+    if 'address' in divergence:
+        where = f"in final RAM at address {divergence['address']}"
+    elif divergence['write'] is None:
+        where = "in how it ends"
+    else:
+        where = f"at port write {divergence['write']}"
+    lines = [f"Validation FAILED: the optimized program differs on {divergence['stream']} {where}"]
+    for side in ['before', 'after']:
+        event = divergence[side]
+        if 'end' in event:
+            lines.append(f"  {side + ':':<8}{event['end']}")
+        else:
+            where = f"line {event['line']} `{event['text']}`" + (f" after {event['label']}" if event['label'] else "")
+            lines.append(f"  {side + ':':<8}{event['port']} {event['value']} at pc {event['pc']}, {where}")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that an optimized program makes the same port writes, or ends with the same RAM, as the original")
+    parser.add_argument('before', help="assembly before optimization")
+    parser.add_argument('after', help="assembly after optimization")
+    parser.add_argument('--script', action='append', default=[], help="controller_input/rng script to run as well")
+    parser.add_argument('--streams', type=int, default=STREAMS, help="random input streams")
+    parser.add_argument('--cycles', type=int, default=VALIDATE_CYCLES, help="cycle budget of every run")
+    args = parser.parse_args()
+    with open(args.before, 'r') as f:
+        before = f.read()
+    with open(args.after, 'r') as f:
+        after = f.read()
+    scripts = [(path, load_script(path)) for path in args.script]
+    result = validate(before, after, scripts, args.streams, args.cycles)
+    print(format_validation(result))
+    sys.exit(1 if result['divergence'] else 0)
+
+if __name__ == '__main__':
+    main()